@@ -47,7 +47,7 @@ def getTestSuite(testclass, testdict, select="unit"):
     # Named test only
     if select[0:3] not in ["uni","com","all","int","pen"]:
         if not hasattr(testclass, select):
-            print "%s: no test named '%s'"%(testclass.__name__, select)
+            print( "%s: no test named '%s'"%(testclass.__name__, select) )
             return None
         suite.addTest(testclass(select))
         return suite
@@ -67,7 +67,7 @@ def getTestSuite(testclass, testdict, select="unit"):
     for c in testclasses:
         for t in testdict.get(c,[]):
             if not hasattr(testclass, t):
-                print "%s: in '%s' tests, no test named '%s'"%(testclass.__name__, c, t)
+                print( "%s: in '%s' tests, no test named '%s'"%(testclass.__name__, c, t) )
                 return None
             suite.addTest(testclass(t))
     return suite
@@ -87,8 +87,8 @@ def runTests(logname, getSuite, args):
     if sel == "xml":
         # Run with XML test output for use in Jenkins environment
         if not junitxml_present:
-            print "junitxml module not available for XML test output"
-            raise ValueError, "junitxml module not available for XML test output"
+            print( "junitxml module not available for XML test output" )
+            raise ValueError("junitxml module not available for XML test output")
         with open('xmlresults.xml', 'w') as report:
             result = junitxml.JUnitXmlResult(report)
             result.startTestRun()
@@ -0,0 +1,418 @@
+"""
+On-disk caches for data retrieved from the web
+
+DiskCache keeps entries in a directory, each as a data file and a JSON metadata
+file named by a hash of the entry key.  The total size of the data files is
+bounded:  a running total is kept as entries are added, and when it exceeds
+the limit the least recently used entries are removed until the cache is
+comfortably within it.  Entry data is written to a temporary file
+and renamed into place when complete, so that a cache shared by several
+processes never exposes partial data.
+
+HttpCache uses a DiskCache to hold copies of resources retrieved by HTTP,
+which are revalidated using conditional requests.
+
+ResultCache uses a DiskCache to hold SPARQL endpoint query responses, which
+are used without contacting the endpoint until they expire.
+"""
+
+import os, os.path
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import logging
+import urllib.request
+import urllib.error
+import email.utils
+
+log = logging.getLogger(__name__)
+
+# Default maximum total size of cached data, in megabytes
+
+CACHESIZE = 512
+
+# Default lifetime of cached query results, in seconds
+
+CACHETTL = 3600
+
+# Maximum amount of unread data read from a query response when it is closed,
+# so that the response can be cached if the reader has stopped just short of
+# the end (e.g. before trailing white space)
+
+TEEDRAINSIZE = 65536
+
+# Fraction of the size limit to which the cache is reduced when the limit is
+# exceeded, so that the cache directory is not scanned each time an entry is
+# added to a full cache
+
+EVICTLEVEL = 0.9
+
+class CacheWriter(object):
+    """
+    File-like object to which the data for a new cache entry is written.  The
+    entry is added to the cache by commit(), or discarded by abort().
+    """
+    def __init__(self, cache, key, meta):
+        self._cache = cache
+        self._key   = key
+        self._meta  = meta
+        (fd, self._tmpname) = tempfile.mkstemp(dir=cache.cachedir, suffix=".tmp")
+        self._file  = os.fdopen(fd, "wb")
+        return
+
+    def write(self, data):
+        self._file.write(data)
+        return len(data)
+
+    def commit(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self._cache._commitEntry(self._key, self._meta, self._tmpname)
+        return
+
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.unlink(self._tmpname)
+        return
+
+class DiskCache(object):
+    """
+    Class implements a size-bounded cache of data files in a directory, with
+    least-recently-used eviction.
+    """
+    def __init__(self, cachedir, maxsize=CACHESIZE*1024*1024):
+        self.cachedir = cachedir
+        self.maxsize  = maxsize
+        self._total   = None    # Running total size of data files, once known
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        return
+
+    def _paths(self, key):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cachedir, name)
+        return (base+".data", base+".meta")
+
+    def get(self, key):
+        """
+        Return (metadata, data filename) for cache entry, or None if there is
+        no entry for the key.  The entry is marked as recently used.
+        """
+        (datapath, metapath) = self._paths(key)
+        try:
+            with open(metapath, "r") as f:
+                meta = json.load(f)
+            if meta.get("key") != key or not os.path.isfile(datapath):
+                return None
+            os.utime(metapath)
+        except (OSError, ValueError):
+            return None
+        return (meta, datapath)
+
+    def put(self, key, meta):
+        """
+        Return CacheWriter for new data for an entry, which replaces any existing
+        entry when committed.
+        """
+        return CacheWriter(self, key, meta)
+
+    def remove(self, key):
+        (datapath, metapath) = self._paths(key)
+        size = self._dataSize(datapath)
+        for path in (datapath, metapath):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        if self._total is not None:
+            self._total -= size
+        return
+
+    def _dataSize(self, datapath):
+        try:
+            return os.path.getsize(datapath)
+        except OSError:
+            return 0
+
+    def _writeMeta(self, metapath, meta):
+        (fd, tmpname) = tempfile.mkstemp(dir=self.cachedir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmpname, metapath)
+        return
+
+    def _commitEntry(self, key, meta, tmpname):
+        (datapath, metapath) = self._paths(key)
+        oldsize = self._dataSize(datapath)
+        os.replace(tmpname, datapath)
+        self._writeMeta(metapath, dict(meta, key=key))
+        if self._total is None:
+            self.evict()
+        else:
+            self._total += self._dataSize(datapath) - oldsize
+            if self._total > self.maxsize:
+                self.evict()
+        return
+
+    def evict(self):
+        """
+        Scan the cache directory to find the total size of cached data, which
+        may include entries added by other processes, and if it exceeds the
+        cache size limit remove least recently used entries until it is within
+        EVICTLEVEL of the limit.
+        """
+        entries = []
+        total   = 0
+        for name in os.listdir(self.cachedir):
+            if not name.endswith(".meta"):
+                continue
+            base = os.path.join(self.cachedir, name[:-5])
+            try:
+                used = os.path.getmtime(base+".meta")
+                size = os.path.getsize(base+".data")
+            except OSError:
+                continue
+            entries.append((used, size, base))
+            total += size
+        limit = self.maxsize if total <= self.maxsize else self.maxsize*EVICTLEVEL
+        for (used, size, base) in sorted(entries):
+            if total <= limit:
+                break
+            log.debug("DiskCache: evict %s"%(base))
+            for path in (base+".data", base+".meta"):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            total -= size
+        self._total = total
+        return
+
+class HttpCache(object):
+    """
+    Class implements a cache of resources retrieved by HTTP.
+
+    A cached copy is revalidated with a conditional request using the ETag and
+    Last-Modified values returned with it, and is used if the server responds
+    that it has not changed.  In offline mode, cached copies are used without
+    revalidation, and resources that are not cached cannot be retrieved.
+    """
+    def __init__(self, cachedir, maxsize=CACHESIZE*1024*1024, offline=False):
+        self._cache  = DiskCache(cachedir, maxsize)
+        self.offline = offline
+        return
+
+    def open(self, uri, headers={}):
+        """
+        Return binary stream for resource at URI, from the cache if possible.
+        Raises an exception if the resource cannot be retrieved.
+        """
+        entry = self._cache.get(uri)
+        if self.offline:
+            if entry is None:
+                raise IOError("Resource %s is not cached, and offline mode is selected"%(uri))
+            log.debug("HttpCache: offline %s"%(uri))
+            return open(entry[1], "rb")
+        reqheaders = dict(headers)
+        if entry:
+            (meta, datapath) = entry
+            if meta.get("etag"):
+                reqheaders["If-None-Match"] = meta["etag"]
+            if meta.get("last-modified"):
+                reqheaders["If-Modified-Since"] = meta["last-modified"]
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(uri, headers=reqheaders))
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and entry:
+                log.debug("HttpCache: not modified %s"%(uri))
+                e.close()
+                return open(entry[1], "rb")
+            raise
+        if ( "no-store" in (response.headers.get("Cache-Control") or "").lower() or
+             int(response.headers.get("Content-Length") or 0) > self._cache.maxsize ):
+            return response
+        meta = (
+            { "uri":           uri
+            , "etag":          response.headers.get("ETag")
+            , "last-modified": response.headers.get("Last-Modified")
+            , "retrieved":     email.utils.formatdate(time.time(), usegmt=True)
+            })
+        writer = self._cache.put(uri, meta)
+        try:
+            with response:
+                shutil.copyfileobj(response, writer)
+        except:
+            writer.abort()
+            raise
+        writer.commit()
+        log.debug("HttpCache: stored %s"%(uri))
+        entry = self._cache.get(uri)
+        if entry is None:
+            # Evicted at once:  larger than the cache
+            return urllib.request.urlopen(urllib.request.Request(uri, headers=headers))
+        return open(entry[1], "rb")
+
+class CachedResponse(object):
+    """
+    File-like object that reads a cached query response, with the same
+    interface as a streamed endpoint response.
+    """
+    def __init__(self, datapath, meta):
+        self._file  = open(datapath, "rb")
+        self._meta  = meta
+        self.status = 200
+        self.reason = "OK (cached)"
+        return
+
+    def getheader(self, name, default=None):
+        if name.lower() == "content-type":
+            return self._meta.get("content-type") or default
+        return default
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def close(self):
+        self._file.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excval, exctraceback):
+        self.close()
+        return False
+
+class TeeResponse(object):
+    """
+    File-like wrapper for a streamed query response, which copies the data read
+    to a new cache entry.  The entry is added when the response has been read
+    to the end.
+    """
+    def __init__(self, response, writer):
+        self._response = response
+        self._writer   = writer
+        self.status    = response.status
+        self.reason    = response.reason
+        return
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, size=-1):
+        try:
+            data = self._response.read(size)
+        except:
+            self._writer.abort()
+            raise
+        if data:
+            self._writer.write(data)
+        if not data or size is None or size < 0:
+            self._writer.commit()
+        return data
+
+    def close(self):
+        try:
+            data = self._response.read(TEEDRAINSIZE)
+            if data:
+                self._writer.write(data)
+            if not data or not self._response.read(1):
+                self._writer.commit()
+        except Exception as e:
+            log.debug("TeeResponse: %s"%(repr(e)))
+        self._writer.abort()
+        self._response.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excval, exctraceback):
+        self.close()
+        return False
+
+class ResultCache(object):
+    """
+    Class implements a cache of SPARQL endpoint query responses, indexed by
+    endpoint URI, requested response type and query text.
+
+    Each entry expires after the lifetime in effect when it was stored, or
+    sooner if the cache is used with a shorter lifetime.
+    """
+    def __init__(self, cachedir, maxsize=CACHESIZE*1024*1024, ttl=CACHETTL):
+        self._cache = DiskCache(cachedir, maxsize)
+        self.ttl    = ttl
+        return
+
+    def resultKey(self, endpoint, query, accept):
+        return "\n".join([endpoint, accept, query])
+
+    def open(self, endpoint, query, accept):
+        """
+        Return file-like object that reads cached response, or None if there
+        is no current cached response for the query.
+        """
+        key   = self.resultKey(endpoint, query, accept)
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        (meta, datapath) = entry
+        now = time.time()
+        if meta.get("expires", 0) <= now or meta.get("stored", 0)+self.ttl <= now:
+            log.debug("ResultCache: expired %s"%(datapath))
+            self._cache.remove(key)
+            return None
+        try:
+            return CachedResponse(datapath, meta)
+        except OSError:
+            # Evicted by another process
+            return None
+
+    def tee(self, endpoint, query, accept, response):
+        """
+        Return file-like object that reads the supplied query response, and
+        adds it to the cache.
+        """
+        now  = time.time()
+        meta = (
+            { "endpoint":     endpoint
+            , "content-type": response.getheader("Content-Type")
+            , "stored":       now
+            , "expires":      now+self.ttl
+            })
+        writer = self._cache.put(self.resultKey(endpoint, query, accept), meta)
+        return TeeResponse(response, writer)
+
+# Caches in use, indexed by cache directory and settings
+
+_httpcaches   = {}
+_resultcaches = {}
+
+def getHttpCache(cachedir, maxsize=CACHESIZE*1024*1024, offline=False):
+    """
+    Return HTTP cache for the supplied directory, creating it if needed.
+    """
+    cachedir = os.path.expanduser(cachedir)
+    key      = (cachedir, maxsize, offline)
+    if key not in _httpcaches:
+        _httpcaches[key] = HttpCache(cachedir, maxsize, offline)
+    return _httpcaches[key]
+
+def getResultCache(cachedir, maxsize=CACHESIZE*1024*1024, ttl=CACHETTL):
+    """
+    Return query result cache for the supplied directory, creating it if needed.
+    """
+    cachedir = os.path.expanduser(cachedir)
+    key      = (cachedir, maxsize, ttl)
+    if key not in _resultcaches:
+        _resultcaches[key] = ResultCache(cachedir, maxsize, ttl)
+    return _resultcaches[key]
+
+# End.
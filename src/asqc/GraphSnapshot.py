@@ -0,0 +1,350 @@
+"""
+Binary snapshot of an RDF graph, for fast reloading
+
+A snapshot holds a dictionary-encoded copy of a graph:  a table of distinct
+terms, sorted by their encoded form (see TermCodec), and three arrays of
+triples of term numbers sorted in subject-predicate-object, predicate-object-
+subject and object-subject-predicate order.  The snapshot file is memory-mapped
+when it is opened, so nothing is read until a query needs it:  terms are found
+by binary search of the term table, and triples matching a pattern by binary
+search of the appropriate triple array.
+
+The snapshot records the size and modification time of the files from which it
+was created, and is not used if any of these have changed.
+
+File layout:
+
+    magic       8 bytes "ASQSNAP1"
+    header      offset and length of header, as 8-byte little-endian unsigned integers
+    offsets     offsets of the encoded terms in the term data, in term number
+                order, with a final entry for the end of the term data
+    terms       UTF-8 encoded terms
+    spo/pos/osp triple arrays, in native byte order
+    header      JSON object describing the snapshot, including the offset and
+                length of each of the preceding sections
+"""
+
+import os
+import sys
+import json
+import mmap
+import array
+import struct
+import logging
+import tempfile
+import functools
+import itertools
+
+import rdflib
+from rdflib.store import Store
+
+from .TermCodec import encodeTerm, decodeTerm
+
+log = logging.getLogger(__name__)
+
+SNAPSHOTMAGIC   = b"ASQSNAP1"
+SNAPSHOTVERSION = 1
+SNAPSHOTPREFIX  = struct.Struct("<8sQQ")
+
+# Number of triples read from a triple array at a time
+
+READBATCHSIZE = 4096
+
+# Triple orderings, each given as the triple positions (0=subject, 1=predicate,
+# 2=object) stored in successive columns of a row
+
+ORDERINGS = (
+    { "spo": (0, 1, 2)
+    , "pos": (1, 2, 0)
+    , "osp": (2, 0, 1)
+    })
+
+def snapshotSources(rdfsources, rdfformat):
+    """
+    Return description of the RDF sources of a graph that is used to check if a
+    snapshot is current, or None if the sources are not all local files.
+    """
+    sources = []
+    for r in rdfsources or ["-"]:
+        if r == "-" or not os.path.isfile(r):
+            return None
+        st = os.stat(r)
+        sources.append([os.path.abspath(r), st.st_size, st.st_mtime])
+    return { "format": rdfformat, "files": sources }
+
+def _align(f):
+    pad = -f.tell() % 8
+    f.write(b"\0"*pad)
+    return f.tell()
+
+def writeSnapshot(graph, path, sources):
+    """
+    Write snapshot of graph to file, replacing any existing file.
+    """
+    termids = {}
+    for triple in graph:
+        for t in triple:
+            termids[t] = None
+    encoded = sorted( (encodeTerm(t).encode("utf-8"), t) for t in termids )
+    for (i, (e, t)) in enumerate(encoded):
+        termids[t] = i
+    idtype = "I" if len(encoded) < 2**32 else "Q"
+    rows   = [ (termids[s], termids[p], termids[o]) for (s, p, o) in graph ]
+    header = (
+        { "version":    SNAPSHOTVERSION
+        , "sources":    sources
+        , "byteorder":  sys.byteorder
+        , "idtype":     idtype
+        , "nterms":     len(encoded)
+        , "ntriples":   len(rows)
+        , "namespaces": [ [p, str(u)] for (p, u) in graph.namespaces() ]
+        , "sections":   {}
+        })
+    sections = header["sections"]
+    (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"\0"*SNAPSHOTPREFIX.size)
+            offsets = array.array("Q", [0])
+            for (e, t) in encoded:
+                offsets.append(offsets[-1]+len(e))
+            start = _align(f)
+            offsets.tofile(f)
+            sections["offsets"] = [start, len(offsets)*offsets.itemsize]
+            start = _align(f)
+            for (e, t) in encoded:
+                f.write(e)
+            sections["terms"] = [start, offsets[-1]]
+            for (name, order) in ORDERINGS.items():
+                ordered = sorted( tuple(r[i] for i in order) for r in rows )
+                data    = array.array(idtype, itertools.chain.from_iterable(ordered))
+                start   = _align(f)
+                data.tofile(f)
+                sections[name] = [start, len(data)*data.itemsize]
+            headerdata = json.dumps(header).encode("utf-8")
+            start = f.tell()
+            f.write(headerdata)
+            f.seek(0)
+            f.write(SNAPSHOTPREFIX.pack(SNAPSHOTMAGIC, start, len(headerdata)))
+        os.replace(tmpname, path)
+    except:
+        os.unlink(tmpname)
+        raise
+    return
+
+class GraphSnapshot(object):
+    """
+    Memory-mapped graph snapshot
+    """
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            self._file.close()
+            raise ValueError("Invalid graph snapshot %s"%path)
+        (magic, headerstart, headerlen) = (None, 0, 0)
+        if len(self._mmap) >= SNAPSHOTPREFIX.size:
+            (magic, headerstart, headerlen) = SNAPSHOTPREFIX.unpack(self._mmap[:SNAPSHOTPREFIX.size])
+        if magic != SNAPSHOTMAGIC:
+            self.close()
+            raise ValueError("Invalid graph snapshot %s"%path)
+        self.header   = json.loads(self._mmap[headerstart:headerstart+headerlen].decode("utf-8"))
+        self.nterms   = self.header["nterms"]
+        self.ntriples = self.header["ntriples"]
+        view = memoryview(self._mmap)
+        def section(name, fmt):
+            (start, length) = self.header["sections"][name]
+            return view[start:start+length].cast(fmt)
+        idtype = self.header["idtype"]
+        self._offsets = section("offsets", "Q")
+        self._terms   = section("terms", "B")
+        self._triples = dict( (name, section(name, idtype)) for name in ORDERINGS )
+        self.term     = functools.lru_cache(maxsize=65536)(self._decodeTerm)
+        return
+
+    def close(self):
+        self._offsets = self._terms = self._triples = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Views still in use will be released when garbage-collected
+            pass
+        self._file.close()
+        return
+
+    def isCurrent(self, sources):
+        return ( self.header.get("version") == SNAPSHOTVERSION and
+                 self.header.get("byteorder") == sys.byteorder and
+                 self.header.get("sources") == sources )
+
+    def namespaces(self):
+        return [ (p, rdflib.URIRef(u)) for (p, u) in self.header["namespaces"] ]
+
+    def _termBytes(self, i):
+        return self._terms[self._offsets[i]:self._offsets[i+1]].tobytes()
+
+    def _decodeTerm(self, i):
+        return decodeTerm(self._termBytes(i).decode("utf-8"))
+
+    def termId(self, term):
+        """
+        Return number of term in snapshot, or None if it does not appear.
+        """
+        try:
+            key = encodeTerm(term).encode("utf-8")
+        except ValueError:
+            return None
+        lo = 0
+        hi = self.nterms
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self._termBytes(mid) < key:
+                lo = mid+1
+            else:
+                hi = mid
+        if lo < self.nterms and self._termBytes(lo) == key:
+            return lo
+        return None
+
+    def _lowerBound(self, rows, key):
+        """
+        Return index of first row in the sorted triple array that is not less than key
+        """
+        k  = len(key)
+        lo = 0
+        hi = self.ntriples
+        while lo < hi:
+            mid = (lo+hi)//2
+            if tuple(rows[mid*3:mid*3+k]) < key:
+                lo = mid+1
+            else:
+                hi = mid
+        return lo
+
+    def tripleIds(self, s, p, o):
+        """
+        Generate triples of term numbers matching a pattern of term numbers,
+        with None for unbound positions.
+        """
+        if s is not None and p is not None:
+            (name, key) = ("spo", (s, p) if o is None else (s, p, o))
+        elif s is not None and o is not None:
+            (name, key) = ("osp", (o, s))
+        elif s is not None:
+            (name, key) = ("spo", (s,))
+        elif p is not None:
+            (name, key) = ("pos", (p,) if o is None else (p, o))
+        elif o is not None:
+            (name, key) = ("osp", (o,))
+        else:
+            (name, key) = ("spo", ())
+        rows  = self._triples[name]
+        order = ORDERINGS[name]
+        (si, pi, oi) = [ order.index(i) for i in range(3) ]
+        if key:
+            start = self._lowerBound(rows, key)
+            end   = self._lowerBound(rows, key[:-1]+(key[-1]+1,))
+        else:
+            (start, end) = (0, self.ntriples)
+        for b in range(start, end, READBATCHSIZE):
+            batch = rows[b*3:min(end, b+READBATCHSIZE)*3].tolist()
+            for i in range(0, len(batch), 3):
+                yield (batch[i+si], batch[i+pi], batch[i+oi])
+        return
+
+    def triples(self, s, p, o):
+        """
+        Generate triples of rdflib terms matching a pattern, with None for
+        unbound positions.
+        """
+        ids = []
+        for t in (s, p, o):
+            if t is None:
+                ids.append(None)
+            else:
+                i = self.termId(t)
+                if i is None:
+                    return
+                ids.append(i)
+        term = self.term
+        for (si, pi, oi) in self.tripleIds(*ids):
+            yield (term(si), term(pi), term(oi))
+        return
+
+class SnapshotStore(Store):
+    """
+    Read-only rdflib store that accesses a graph snapshot.
+    """
+    context_aware = False
+    formula_aware = False
+    graph_aware   = False
+    # Snapshot data is read-only, so queries may be run concurrently
+    concurrent_reads = True
+
+    def __init__(self, snapshot, identifier=None):
+        Store.__init__(self, configuration=None, identifier=identifier)
+        self._snapshot   = snapshot
+        self._namespaces = dict(snapshot.namespaces())
+        return
+
+    def triples(self, triple_pattern, context=None):
+        (s, p, o) = [ t if isinstance(t, rdflib.term.Identifier) and
+                           not isinstance(t, rdflib.Variable) else None
+                      for t in triple_pattern ]
+        for triple in self._snapshot.triples(s, p, o):
+            yield (triple, iter([None]))
+        return
+
+    def __len__(self, context=None):
+        return self._snapshot.ntriples
+
+    def add(self, triple, context=None, quoted=False):
+        raise TypeError("Graph snapshot is read-only")
+
+    def remove(self, triple, context=None):
+        raise TypeError("Graph snapshot is read-only")
+
+    def bind(self, prefix, namespace, override=True, **kwargs):
+        if override or prefix not in self._namespaces:
+            self._namespaces[prefix] = rdflib.URIRef(namespace)
+        return
+
+    def namespace(self, prefix):
+        return self._namespaces.get(prefix, None)
+
+    def prefix(self, namespace):
+        for (p, u) in self._namespaces.items():
+            if u == namespace:
+                return p
+        return None
+
+    def namespaces(self):
+        for (p, u) in self._namespaces.items():
+            yield (p, u)
+        return
+
+    def close(self, commit_pending_transaction=False):
+        self._snapshot.close()
+        return
+
+def openSnapshot(path, sources):
+    """
+    Return graph that accesses a snapshot file, or None if the snapshot does
+    not exist or is not current for the given sources.
+    """
+    if not os.path.isfile(path):
+        return None
+    try:
+        snapshot = GraphSnapshot(path)
+    except (ValueError, OSError, KeyError) as e:
+        log.debug("openSnapshot: %s: %s"%(path, repr(e)))
+        return None
+    if not snapshot.isCurrent(sources):
+        log.debug("openSnapshot: %s is out of date"%(path))
+        snapshot.close()
+        return None
+    return rdflib.Graph(store=SnapshotStore(snapshot))
+
+# End.
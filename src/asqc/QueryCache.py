@@ -0,0 +1,194 @@
+"""
+Cache of prepared (parsed and translated) SPARQL queries
+
+Parsing a query with rdflib's pyparsing grammar and translating it to SPARQL
+algebra is a significant fixed cost for each query evaluated.  This module
+keeps recently used prepared queries in memory, keyed by the full query text,
+and can optionally save them in a directory so that later runs of the same
+query skip parsing altogether.  The directory is a size-bounded DiskCache.
+
+Prepared queries are saved with pickle, and loading a pickle can run arbitrary
+code, so saved queries are only loaded from a directory that is owned by the
+current user and not writable by anyone else.  A new directory is created with
+these permissions.
+
+The rdflib SPARQL parser is not safe for use by several threads at once (its
+pyparsing grammar is modified as it is first used), so all query parsing is
+done holding parselock;  evaluating a prepared query does not need the lock.
+"""
+
+import os, os.path
+import types
+import io
+import pickle
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import rdflib
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.parserutils import CompValue
+
+from .DiskCache import DiskCache
+
+log = logging.getLogger(__name__)
+
+# Maximum number of prepared queries kept in memory
+
+QUERYCACHESIZE = 256
+
+# Default maximum total size of prepared queries saved on disk, in megabytes
+
+QUERYCACHEDISKSIZE = 64
+
+# Lock held while any SPARQL query text is parsed
+
+parselock = threading.Lock()
+
+def prepareQueryText(query, initNs={}):
+    """
+    Parse and translate query text, holding parselock, and return the prepared
+    query.  Use this, rather than Graph.query with query text, for a query that
+    is not cached.
+    """
+    with parselock:
+        return prepareQuery(query, initNs=initNs)
+
+# Prepared query algebra is built from CompValue objects, which cannot be
+# pickled as they stand:  they are OrderedDict subclasses with a required
+# constructor argument, and expression nodes hold a bound evaluation method.
+
+def _rebuildCompValue(cls, attrs, methods, items):
+    c = cls.__new__(cls)
+    OrderedDict.__init__(c)
+    c.__dict__.update(attrs)
+    for (k, f) in methods.items():
+        c.__dict__[k] = types.MethodType(f, c)
+    for (k, v) in items:
+        OrderedDict.__setitem__(c, k, v)
+    return c
+
+class _QueryPickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        if isinstance(obj, CompValue):
+            attrs   = {}
+            methods = {}
+            for (k, v) in obj.__dict__.items():
+                if isinstance(v, types.MethodType) and v.__self__ is obj:
+                    methods[k] = v.__func__
+                else:
+                    attrs[k] = v
+            return (_rebuildCompValue, (type(obj), attrs, methods, list(OrderedDict.items(obj))))
+        return NotImplemented
+
+def isPrivateDir(path):
+    """
+    Test if directory is owned by the current user, and not writable by others
+    """
+    st = os.stat(path)
+    return st.st_uid == os.getuid() and not (st.st_mode & 0o022)
+
+class QueryCache(object):
+    """
+    Class implements a least-recently-used cache of prepared SPARQL queries,
+    with optional on-disk persistence.  The cache may be used by several
+    threads at once (e.g. by --serve).
+    """
+    def __init__(self, cachedir=None, size=QUERYCACHESIZE, disksize=QUERYCACHEDISKSIZE*1024*1024):
+        self._size    = size
+        self._queries = OrderedDict()
+        self._disk    = None
+        self._lock    = threading.Lock()
+        self.hits     = 0
+        self.misses   = 0
+        if cachedir:
+            try:
+                if not os.path.isdir(cachedir):
+                    os.makedirs(cachedir, mode=0o700)
+                if isPrivateDir(cachedir):
+                    self._disk = DiskCache(cachedir, disksize)
+                else:
+                    log.warning("QueryCache: %s is not private to the current user; not used"%(cachedir))
+            except OSError as e:
+                log.warning("QueryCache: cannot use %s: %s"%(cachedir, e))
+        return
+
+    def queryKey(self, query, initNs={}):
+        """
+        Return cache key for query text and namespace prefixes.
+        """
+        keytext = "\n".join(
+            [rdflib.__version__, query] +
+            [ "%s: %s"%(p, u) for (p, u) in sorted(initNs.items()) ]
+            )
+        return hashlib.sha1(keytext.encode("utf-8")).hexdigest()
+
+    def getQuery(self, query, initNs={}):
+        """
+        Return prepared query for supplied query text.
+        """
+        key = self.queryKey(query, initNs)
+        with self._lock:
+            prepared = self._queries.get(key)
+            if prepared is not None:
+                self.hits += 1
+                self._queries.move_to_end(key)
+                return prepared
+        prepared = self._loadQuery(key)
+        loaded   = prepared is not None
+        if not loaded:
+            prepared = prepareQueryText(query, initNs)
+            self._saveQuery(key, prepared)
+        with self._lock:
+            if loaded:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._queries[key] = prepared
+            if len(self._queries) > self._size:
+                self._queries.popitem(last=False)
+        return prepared
+
+    def _loadQuery(self, key):
+        if not self._disk:
+            return None
+        entry = self._disk.get(key)
+        if entry is None:
+            return None
+        try:
+            with open(entry[1], "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            log.debug("QueryCache: failed to load %s: %s"%(key, repr(e)))
+            self._disk.remove(key)
+        return None
+
+    def _saveQuery(self, key, prepared):
+        if not self._disk:
+            return
+        try:
+            buf = io.BytesIO()
+            _QueryPickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump(prepared)
+            writer = self._disk.put(key, {})
+            writer.write(buf.getvalue())
+            writer.commit()
+        except Exception as e:
+            log.debug("QueryCache: failed to save %s: %s"%(key, repr(e)))
+        return
+
+# Query caches in use, indexed by cache directory (None for memory-only cache)
+
+_querycaches = {}
+
+def getQueryCache(cachedir=None):
+    """
+    Return query cache for the supplied directory, creating it if needed.
+    """
+    if cachedir:
+        cachedir = os.path.expanduser(cachedir)
+    if cachedir not in _querycaches:
+        _querycaches[cachedir] = QueryCache(cachedir)
+    return _querycaches[cachedir]
+
+# End.
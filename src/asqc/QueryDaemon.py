@@ -0,0 +1,226 @@
+"""
+Query daemon that keeps RDF data loaded between asq invocations
+
+The daemon loads the RDF data specified by -r options once, then serves queries
+received over a Unix domain socket.  An asq command run with --socket sends its
+query, prefixes, incoming bindings and output format options to the daemon, and
+copies the results it returns to stdout.
+
+Requests are handled one at a time, as rdflib query evaluation is not thread-safe.
+
+The socket is accessible only to the user running the daemon (mode 0600).  The
+daemon will not start if the socket path exists, unless it is a socket left by
+a daemon that is no longer running.
+
+Protocol:  the client sends a single line containing a JSON object with the query
+details.  The daemon responds with a sequence of frames, each consisting of a
+one-byte frame type, a 4-byte big-endian length and the frame data:
+
+    O   output data (UTF-8)
+    S   query status, as a decimal integer (final frame)
+"""
+
+import os
+import io
+import sys
+import stat
+import copy
+import json
+import codecs
+import socket
+import struct
+import signal
+import logging
+import traceback
+import socketserver
+
+from .StdoutContext import SwitchStdout
+from .asqc import getRdfData, runQuery, bindingToJSON, parseJsonBindings
+
+log = logging.getLogger(__name__)
+
+# Output format options that may be supplied with each request
+
+REQUESTOPTIONS = ["verbose", "format_var_out", "format_rdf_out"]
+
+FRAMEHEADER = struct.Struct(">cI")
+
+def writeFrame(sock, frametype, data):
+    sock.sendall(FRAMEHEADER.pack(frametype, len(data)) + data)
+    return
+
+def readFrame(instr):
+    """
+    Read frame from daemon response stream; returns (frametype, data), or
+    (None, None) if the stream ends.
+    """
+    header = instr.read(FRAMEHEADER.size)
+    if len(header) < FRAMEHEADER.size:
+        return (None, None)
+    (frametype, length) = FRAMEHEADER.unpack(header)
+    data = instr.read(length)
+    if len(data) < length:
+        return (None, None)
+    return (frametype, data)
+
+class FrameWriter(io.RawIOBase):
+    """
+    Raw binary stream that sends data written to it as output frames on a socket.
+    """
+    def __init__(self, sock):
+        self._sock = sock
+        return
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        if data:
+            writeFrame(self._sock, b"O", data)
+        return len(data)
+
+class QueryRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handle a single query request received by the daemon
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Connection closed without a request (e.g. by isStaleSocket)
+            return
+        outstr = io.TextIOWrapper(
+            io.BufferedWriter(FrameWriter(self.connection), buffer_size=65536),
+            encoding="utf-8", newline="\n")
+        status = 2
+        try:
+            request = json.loads(line.decode("utf-8"))
+            options = copy.copy(self.server.options)
+            for k in REQUESTOPTIONS:
+                if k in request.get("options", {}):
+                    setattr(options, k, request["options"][k])
+            bindings = request["bindings"]
+            bindings['results']['bindings'] = parseJsonBindings(bindings['results']['bindings'])
+            with SwitchStdout(outstr):
+                status = runQuery(self.server.progname, options,
+                    request["prefixes"], request["query"], bindings,
+                    rdfgraph=self.server.rdfgraph, outstr=outstr)
+        except Exception as e:
+            log.debug("traceback: %s"%(traceback.format_exc()))
+            outstr.write("%s: query failed in daemon: %s\n"%(self.server.progname, e))
+        outstr.flush()
+        writeFrame(self.connection, b"S", str(status).encode("ascii"))
+        return
+
+class QueryDaemon(socketserver.UnixStreamServer):
+    """
+    Unix domain socket server that evaluates queries against a loaded RDF graph
+    """
+    def __init__(self, socketpath, progname, options, rdfgraph):
+        self.progname = progname
+        self.options  = options
+        self.rdfgraph = rdfgraph
+        socketserver.UnixStreamServer.__init__(self, socketpath, QueryRequestHandler)
+        return
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        # Restrict access before listening, so no connection can be made until then
+        os.chmod(self.server_address, 0o600)
+        return
+
+def isStaleSocket(socketpath):
+    """
+    Test if path is a Unix domain socket on which no process is listening.
+    """
+    try:
+        if not stat.S_ISSOCK(os.lstat(socketpath).st_mode):
+            return False
+    except OSError:
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketpath)
+    except ConnectionRefusedError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+    return False
+
+def runDaemon(progname, options):
+    """
+    Load RDF data and serve queries on the socket given by --daemon, until
+    interrupted or terminated.
+    """
+    socketpath = options.daemon
+    rdfgraph   = getRdfData(options)
+    if not rdfgraph:
+        print( "%s: Could not read RDF data, or syntax error in input"%progname )
+        return 2
+    if os.path.lexists(socketpath):
+        if not isStaleSocket(socketpath):
+            print( "%s: %s is in use, or is not a socket"%(progname, socketpath) )
+            return 2
+        os.unlink(socketpath)
+    server = QueryDaemon(socketpath, progname, options, rdfgraph)
+    print( "%s: serving %i triples on %s"%(progname, len(rdfgraph), socketpath) )
+    sys.stdout.flush()
+    # Stop cleanly on SIGTERM as well as on interrupt
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socketpath)
+    return 0
+
+def runClient(progname, options, prefixes, query, bindings):
+    """
+    Send query to the daemon listening on the socket given by --socket, and
+    copy the results to stdout.  Returns the query status.
+    """
+    request = (
+        { "query":    query
+        , "prefixes": prefixes
+        , "bindings":
+            { "head":    bindings["head"]
+            , "results": { "bindings": [ bindingToJSON(b) for b in bindings['results']['bindings'] ] }
+            }
+        , "options":  dict([ (k, getattr(options, k, None)) for k in REQUESTOPTIONS ])
+        })
+    outstr = sys.stdout
+    sock   = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(options.socket)
+    except (OSError, socket.error) as e:
+        print( "%s: Could not connect to query daemon at %s: %s"%(progname, options.socket, e) )
+        return 2
+    status = 2
+    with sock:
+        sock.sendall(json.dumps(request).encode("utf-8")+b"\n")
+        instr   = sock.makefile("rb")
+        outbuf  = getattr(outstr, "buffer", None)
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        outstr.flush()
+        while True:
+            (frametype, data) = readFrame(instr)
+            if frametype == b"O":
+                if outbuf:
+                    outbuf.write(data)
+                else:
+                    outstr.write(decoder.decode(data))
+            elif frametype == b"S":
+                status = int(data)
+                break
+            else:
+                print( "%s: Incomplete response from query daemon"%progname )
+                break
+    if outbuf:
+        outbuf.flush()
+    return status
+
+# End.
@@ -0,0 +1,220 @@
+"""
+Compact binary format for query variable bindings
+
+This format is used to pass query results between asq processes in a pipeline,
+at less cost than JSON to write and read.  Each term is written once, when it is
+first used, and is then referred to by number:
+
+    signature                   MAGIC
+    records                     tag byte, payload length, payload
+
+All numbers are unsigned LEB128 variable-length integers, and all strings are
+UTF-8.  The records are:
+
+    V   variable names, each preceded by its length (first record)
+    B   single byte 0 or 1:  ASK query result
+    T   term string (see TermCodec), which is given the next term number
+    R   result bindings:  pairs of variable index and term number
+    C   term numbers are reset, to limit the memory used for long streams
+    E   end of results
+
+Result bindings are written one at a time as they are taken from the results,
+which may be an iterator, and read one at a time as they are used.
+"""
+
+from .TermCodec import encodeJsonTerm, decodeJsonTerm
+
+MAGIC = b"\x89ASQB01\n"
+
+# Maximum number of terms numbered before the numbering is reset
+
+TERMDICTSIZE = 1000000
+
+# Number of results written in one block, if not otherwise specified
+
+BLOCKROWS = 1000
+
+VARINTS = [ bytes((i,)) for i in range(128) ]
+
+def encodeVarint(n):
+    if n < 128:
+        return VARINTS[n]
+    data = bytearray()
+    while n >= 128:
+        data.append((n & 0x7f) | 0x80)
+        n >>= 7
+    data.append(n)
+    return bytes(data)
+
+def decodeVarints(data):
+    """
+    Return list of numbers encoded in the supplied bytes
+    """
+    vals  = []
+    val   = 0
+    shift = 0
+    for b in data:
+        if b < 128:
+            vals.append(val | (b << shift))
+            val   = 0
+            shift = 0
+        else:
+            val   |= (b & 0x7f) << shift
+            shift += 7
+    return vals
+
+def readVarint(stream):
+    val   = 0
+    shift = 0
+    while True:
+        b = stream.read(1)
+        if not b:
+            raise EOFError("Unexpected end of binary bindings")
+        if b[0] < 128:
+            return val | (b[0] << shift)
+        val   |= (b[0] & 0x7f) << shift
+        shift += 7
+
+def encodeRecord(tag, payload):
+    return tag + encodeVarint(len(payload)) + payload
+
+def encodeStrings(strings):
+    data = []
+    for s in strings:
+        b = s.encode("utf-8")
+        data.append(encodeVarint(len(b)))
+        data.append(b)
+    return b"".join(data)
+
+def decodeStrings(data):
+    strings = []
+    pos     = 0
+    while pos < len(data):
+        length = 0
+        shift  = 0
+        while data[pos] >= 128:
+            length |= (data[pos] & 0x7f) << shift
+            shift  += 7
+            pos    += 1
+        length |= data[pos] << shift
+        pos    += 1
+        strings.append(data[pos:pos+length].decode("utf-8"))
+        pos    += length
+    return strings
+
+def isBinaryResults(stream):
+    """
+    Test if a binary stream with a peek method starts with binary bindings.
+    """
+    return stream.peek(len(MAGIC))[:1] == MAGIC[:1]
+
+def writeResultsBinary(outbuf, results, flushrows=None):
+    """
+    Write SPARQL results in binary format to a binary stream.  Result bindings
+    are written one at a time as they are taken from results["results"]["bindings"],
+    which may be an iterator, and the output is flushed after every flushrows
+    bindings.
+
+    Returns the number of result bindings written, or None if the results have
+    no bindings (e.g. ASK query results).
+    """
+    qvars = [ str(v) for v in results["head"].get("vars", []) ]
+    block = [MAGIC, encodeRecord(b"V", encodeStrings(qvars))]
+    if "results" not in results:
+        block.append(encodeRecord(b"B", b"\x01" if results.get("boolean") else b"\x00"))
+        block.append(encodeRecord(b"E", b""))
+        outbuf.write(b"".join(block))
+        outbuf.flush()
+        return None
+    varindex  = dict( (v, encodeVarint(i)) for (i, v) in enumerate(qvars) )
+    termids   = {}
+    blockrows = flushrows or BLOCKROWS
+    count     = 0
+    for bindings in results["results"]["bindings"]:
+        row = []
+        if len(termids)+len(bindings) > TERMDICTSIZE:
+            # Reset between rows, so all terms of a row are numbered together
+            block.append(encodeRecord(b"C", b""))
+            termids = {}
+        for (var, val) in bindings.items():
+            var = str(var)
+            if var not in varindex:
+                # Variable not declared in header
+                varindex[var] = encodeVarint(len(qvars))
+                qvars.append(var)
+                block.append(encodeRecord(b"V", encodeStrings(qvars)))
+            text = encodeJsonTerm(val)
+            termid = termids.get(text)
+            if termid is None:
+                termid = encodeVarint(len(termids))
+                termids[text] = termid
+                block.append(encodeRecord(b"T", text.encode("utf-8")))
+            row.append(varindex[var])
+            row.append(termid)
+        block.append(encodeRecord(b"R", b"".join(row)))
+        count += 1
+        if count % blockrows == 0:
+            outbuf.write(b"".join(block))
+            block = []
+            if flushrows:
+                outbuf.flush()
+    block.append(encodeRecord(b"E", b""))
+    outbuf.write(b"".join(block))
+    outbuf.flush()
+    return count
+
+def iterRecords(stream):
+    """
+    Generate (tag, payload) for each record in a binary bindings stream
+    """
+    while True:
+        tag = stream.read(1)
+        if not tag:
+            raise EOFError("Unexpected end of binary bindings")
+        payload = stream.read(readVarint(stream))
+        yield (tag, payload)
+        if tag == b"E":
+            return
+
+def readResultsBinary(stream, termfactory=None):
+    """
+    Read SPARQL results in binary format from a binary stream, returning a
+    structure like that returned by readResultsJSON:  the value of
+    ["results"]["bindings"] is an iterator that reads result bindings from the
+    stream as they are used.
+
+    Result terms are JSON-style dictionaries, or the values returned by
+    termfactory when it is applied to these, which is done once for each
+    distinct term.
+    """
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not binary bindings data")
+    records = iterRecords(stream)
+    (tag, payload) = next(records)
+    if tag != b"V":
+        raise ValueError("Binary bindings data has no variables record")
+    qvars  = decodeStrings(payload)
+    result = { "head": { "vars": qvars } }
+    (tag, payload) = next(records)
+    if tag == b"B":
+        result["boolean"] = payload == b"\x01"
+        return result
+    def iterBindings(tag, payload):
+        terms = []
+        while tag != b"E":
+            if tag == b"R":
+                vals = decodeVarints(payload)
+                yield dict( (qvars[vals[i]], terms[vals[i+1]]) for i in range(0, len(vals), 2) )
+            elif tag == b"T":
+                term = decodeJsonTerm(payload.decode("utf-8"))
+                terms.append(termfactory(term) if termfactory else term)
+            elif tag == b"V":
+                qvars[:] = decodeStrings(payload)
+            elif tag == b"C":
+                terms = []
+            (tag, payload) = next(records)
+        return
+    result["results"] = { "bindings": iterBindings(tag, payload) }
+    return result
+
+# End.
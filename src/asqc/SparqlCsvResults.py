@@ -0,0 +1,198 @@
+# This module provides writers for SPARQL query results in CSV and TSV
+# formats, and a reader for TSV results.  Result bindings are formatted a row
+# at a time as they are taken from the results, and written in large blocks.
+#
+# CSV output follows the form used by earlier versions of asqc:  terms are
+# written in Turtle-like syntax, with non-ASCII characters escaped as \uXXXX.
+#
+# TSV follows http://www.w3.org/TR/sparql11-results-csv-tsv/
+
+import io
+import re
+
+# Number of rows written in one block, if not otherwise specified
+
+BLOCKROWS = 1000
+
+NONASCII = re.compile(u"[^\x00-\x7f]")
+
+def escapeCSV(s):
+    s = s.replace('"', '""')
+    if not s.isascii():
+        s = NONASCII.sub(lambda m: "\\u%04x"%ord(m.group(0)), s)
+    return s
+
+def termToCSV(term):
+    """
+    Format JSON-style result term for CSV output
+    """
+    termtype = term['type']
+    if termtype == "uri":
+        return "<" + term['value'] + ">"
+    if termtype == "bnode":
+        return "_:" + term['value']
+    strval = '"' + escapeCSV(term['value']) + '"'
+    if termtype == "literal":
+        if 'xml:lang' in term:
+            return strval + '@' + term['xml:lang']
+        return strval
+    if termtype == "typed-literal":
+        return strval + '^^' + term['datatype']
+    raise ValueError('Unknown term type: %s'%(termtype))
+
+TSVESCAPES = (
+    { ord("\\"): "\\\\"
+    , ord('"'):  '\\"'
+    , ord("\t"): "\\t"
+    , ord("\n"): "\\n"
+    , ord("\r"): "\\r"
+    })
+
+def termToTSV(term):
+    """
+    Format JSON-style result term for TSV output
+    """
+    termtype = term['type']
+    if termtype == "uri":
+        return "<" + term['value'] + ">"
+    if termtype == "bnode":
+        return "_:" + term['value']
+    strval = '"' + term['value'].translate(TSVESCAPES) + '"'
+    if 'xml:lang' in term:
+        return strval + '@' + term['xml:lang']
+    if 'datatype' in term:
+        return strval + '^^<' + term['datatype'] + '>'
+    if termtype in ["literal", "typed-literal"]:
+        return strval
+    raise ValueError('Unknown term type: %s'%(termtype))
+
+def writeRows(outstr, header, rows, flushrows):
+    """
+    Write header and rows, in blocks of flushrows rows, flushing the output
+    after each block.  Returns the number of rows written.
+    """
+    blockrows = flushrows or BLOCKROWS
+    block = [header]
+    count = 0
+    for row in rows:
+        block.append(row)
+        count += 1
+        if count % blockrows == 0:
+            outstr.write("".join(block))
+            block = []
+            if flushrows:
+                outstr.flush()
+    outstr.write("".join(block))
+    outstr.flush()
+    return count
+
+def writeBoolean(outstr, results):
+    outstr.write("true\n" if results.get("boolean") else "false\n")
+    outstr.flush()
+    return None
+
+def writeResultsCSV(outstr, results, flushrows=None):
+    """
+    Write SPARQL results as CSV.  Result bindings are formatted one at a time
+    as they are taken from results["results"]["bindings"], which may be an
+    iterator, and written in blocks of flushrows rows, after each of which the
+    output is flushed.
+
+    Returns the number of result bindings written, or None if the results have
+    no bindings (e.g. ASK query results).
+    """
+    if "results" not in results:
+        return writeBoolean(outstr, results)
+    qvars   = [ str(v) for v in results["head"]["vars"] ]
+    unbound = '""'
+    def rows():
+        for bindings in results["results"]["bindings"]:
+            yield ", ".join(
+                [ termToCSV(bindings[v]) if v in bindings else unbound for v in qvars ]
+                ) + "\n"
+    return writeRows(outstr, ", ".join(qvars)+"\n", rows(), flushrows)
+
+def writeResultsTSV(outstr, results, flushrows=None):
+    """
+    Write SPARQL results as TSV, as writeResultsCSV.
+    """
+    if "results" not in results:
+        return writeBoolean(outstr, results)
+    qvars = [ str(v) for v in results["head"]["vars"] ]
+    def rows():
+        for bindings in results["results"]["bindings"]:
+            yield "\t".join(
+                [ termToTSV(bindings[v]) if v in bindings else "" for v in qvars ]
+                ) + "\n"
+    return writeRows(outstr, "\t".join([ "?"+v for v in qvars ])+"\n", rows(), flushrows)
+
+# TSV reader
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+TSVTERM = re.compile(
+    r'<([^>]*)>$'                                           # 1: IRI
+    r'|_:(\S+)$'                                            # 2: blank node
+    r'|"((?:[^"\\]|\\.)*)"(?:@([A-Za-z0-9-]+)|\^\^<([^>]*)>)?$'   # 3,4,5: literal
+    r'|([+-]?\d+)$'                                         # 6: integer
+    r'|([+-]?\d*\.\d+)$'                                    # 7: decimal
+    r'|([+-]?(?:\d+\.?\d*|\.\d+)[eE][+-]?\d+)$'             # 8: double
+    r'|(true|false)$'                                       # 9: boolean
+    )
+
+TSVUNESCAPE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+
+TSVUNESCAPES = { "t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f" }
+
+def unescapeTSV(s):
+    if "\\" not in s:
+        return s
+    def unescape(m):
+        if m.group(3):
+            return TSVUNESCAPES.get(m.group(3), m.group(3))
+        return chr(int(m.group(1) or m.group(2), 16))
+    return TSVUNESCAPE.sub(unescape, s)
+
+def parseTSVTerm(cell):
+    """
+    Return JSON-style result term for a TSV result cell
+    """
+    m = TSVTERM.match(cell)
+    if not m:
+        raise ValueError("Invalid term in TSV results: %s"%(cell))
+    if m.group(1) is not None:
+        return { 'type': 'uri', 'value': m.group(1) }
+    if m.group(2) is not None:
+        return { 'type': 'bnode', 'value': m.group(2) }
+    if m.group(3) is not None:
+        value = unescapeTSV(m.group(3))
+        if m.group(4):
+            return { 'type': 'literal', 'value': value, 'xml:lang': m.group(4) }
+        if m.group(5):
+            return { 'type': 'typed-literal', 'value': value, 'datatype': m.group(5) }
+        return { 'type': 'literal', 'value': value }
+    for (group, datatype) in [(6, "integer"), (7, "decimal"), (8, "double"), (9, "boolean")]:
+        if m.group(group) is not None:
+            return { 'type': 'typed-literal', 'value': m.group(group), 'datatype': XSD+datatype }
+
+def readResultsTSV(stream):
+    """
+    Read SPARQL TSV results from a binary (UTF-8) or text stream, returning a
+    structure like that returned by readResultsJSON:  the value of
+    ["results"]["bindings"] is an iterator that reads result bindings from the
+    stream as they are used.
+    """
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    header = stream.readline().rstrip("\r\n")
+    qvars  = [ v[1:] if v[:1] in "?$" else v for v in header.split("\t") ] if header else []
+    def iterBindings():
+        for line in stream:
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            yield dict( (v, parseTSVTerm(cell))
+                        for (v, cell) in zip(qvars, line.split("\t")) if cell )
+    return { "head": { "vars": qvars }, "results": { "bindings": iterBindings() } }
+
+# End.
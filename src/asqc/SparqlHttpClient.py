@@ -6,6 +6,12 @@ import os, os.path
 import sys
 
 import re
+import gzip
+import zlib
+import time
+import random
+import email.utils
+import threading
 import logging
 import http.client
 import urllib
@@ -16,76 +22,376 @@ except ImportError:
     # Running Python 2.5 with simplejson?
     import simplejson as json
 
-logger = logging.getLogger(__name__)
+log = logging.getLogger(__name__)
+
+# Default pool limits:  idle connections kept per host, and seconds an idle
+# connection is kept before it is discarded
+
+POOLMAXSIZE     = 8
+POOLIDLETIMEOUT = 30.0
+
+# Size of compressed data read at a time from a streamed response
+
+READSIZE = 65536
+
+# Response statuses by which an endpoint signals that it is overloaded, and
+# after which a request is retried
+
+RETRYSTATUS = [429, 503]
+
+# Default number of retries, and limits (seconds) on the delay before a retry:
+# the delay is chosen at random up to an exponentially increasing maximum,
+# unless the endpoint specifies a delay with Retry-After
+
+RETRIES         = 5
+RETRYBASEDELAY  = 0.5
+RETRYMAXDELAY   = 60.0
+RETRYAFTERLIMIT = 600.0
+
+def retryDelay(attempt, retryafter=None):
+    """
+    Return delay in seconds before retrying a request for the attempt'th time
+    (counting from 0), given the value of any Retry-After response header.
+    """
+    if retryafter:
+        retryafter = retryafter.strip()
+        try:
+            delay = float(retryafter)
+        except ValueError:
+            try:
+                delay = email.utils.parsedate_to_datetime(retryafter).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0.0), RETRYAFTERLIMIT)
+    return random.uniform(0, min(RETRYMAXDELAY, RETRYBASEDELAY * 2**attempt))
+
+class HttpConnectionPool(object):
+    """
+    Class implements a pool of persistent (keep-alive) HTTP/1.1 connections,
+    indexed by URI scheme and host.
+
+    Also records endpoint redirections, so that later requests can be sent
+    directly to the final location.
+    """
+    def __init__(self, maxsize=POOLMAXSIZE, idletimeout=POOLIDLETIMEOUT):
+        self._maxsize     = maxsize
+        self._idletimeout = idletimeout
+        self._lock        = threading.Lock()
+        self._idle        = {}  # (scheme, host) -> [ (connection, time returned to pool) ]
+        self._redirects   = {}  # endpoint URI -> redirected endpoint URI
+        return
+
+    def _evictIdle(self, now):
+        for key in list(self._idle):
+            keep = []
+            for (hc, t) in self._idle[key]:
+                if now - t > self._idletimeout:
+                    hc.close()
+                else:
+                    keep.append((hc, t))
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+        return
+
+    def getConnection(self, scheme, host):
+        """
+        Return a pair of connection to the indicated host, and a flag that is
+        True if the connection has been used for a previous request.
+        """
+        with self._lock:
+            self._evictIdle(time.time())
+            idle = self._idle.get((scheme, host), [])
+            if idle:
+                (hc, t) = idle.pop()
+                return (hc, True)
+        if scheme == "https":
+            return (http.client.HTTPSConnection(host), False)
+        return (http.client.HTTPConnection(host), False)
+
+    def putConnection(self, scheme, host, hc):
+        """
+        Return connection to the pool for reuse, or close it if the pool is full.
+        """
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self._maxsize:
+                idle.append((hc, time.time()))
+                return
+        hc.close()
+        return
+
+    def closeAll(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for (hc, t) in idle:
+                    hc.close()
+            self._idle = {}
+        return
+
+    def setRedirect(self, endpointuri, redirecturi):
+        with self._lock:
+            self._redirects[endpointuri] = redirecturi
+        return
+
+    def getRedirect(self, endpointuri):
+        with self._lock:
+            return self._redirects.get(endpointuri, None)
+
+class PooledResponse(object):
+    """
+    File-like wrapper for a streamed HTTP response, which returns the underlying
+    connection to its pool when the response has been read to the end, or
+    closes the connection if the response is closed before then.
+
+    A gzip content-encoded response is decompressed as it is read.
+
+    If a limiter is supplied, it is released when the response has been read
+    to the end or closed.
+    """
+    def __init__(self, response, hc, pool, scheme, host, limiter=None):
+        self._response = response
+        self._hc       = hc
+        self._pool     = pool
+        self._scheme   = scheme
+        self._host     = host
+        self._limiter  = limiter
+        self.status    = response.status
+        self.reason    = response.reason
+        self._decoder  = None
+        if isGzipEncoded(response):
+            self._decoder = zlib.decompressobj(16+zlib.MAX_WBITS)
+        return
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, size=-1):
+        if self._decoder:
+            return self._readDecoded(size)
+        data = self._response.read(size) if size is not None and size >= 0 else self._response.read()
+        if not data or (size is None or size < 0):
+            self._release()
+        return data
+
+    def _readDecoded(self, size):
+        decoder = self._decoder
+        if size is None or size < 0:
+            data = decoder.decompress(decoder.unconsumed_tail+self._response.read())+decoder.flush()
+            self._release()
+            return data
+        data = b""
+        while not data:
+            raw = decoder.unconsumed_tail
+            if not raw:
+                raw = self._response.read(READSIZE)
+                if not raw:
+                    self._release()
+                    return decoder.flush()
+            data = decoder.decompress(raw, size)
+        return data
+
+    def _release(self):
+        if self._hc:
+            if self._response.isclosed() and not self._response.will_close:
+                self._pool.putConnection(self._scheme, self._host, self._hc)
+            else:
+                self._hc.close()
+            self._hc = None
+        if self._limiter:
+            self._limiter.release()
+            self._limiter = None
+        return
+
+    def close(self):
+        self._release()
+        self._response.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excval, exctraceback):
+        self.close()
+        return False
+
+def isGzipEncoded(response):
+    return (response.getheader("Content-Encoding") or "").strip().lower() == "gzip"
+
+# Connection pool shared by all client instances
+
+connectionpool = HttpConnectionPool()
 
 class SparqlHttpClient(object):
     """
     Class implements simple SPARQL HTTP protocol client
     """
-    def __init__(self, endpointhost="localhost:3030", endpointpath="/ds", endpointuri=None):
+    def __init__(self, endpointhost="localhost:3030", endpointpath="/ds", endpointuri=None, pool=None,
+                 retries=RETRIES, limiter=None):
         # Default SPARQL endpoint details based on Fuseki defaults
+        self._endpointscheme = "http"
         self._endpointhost = None
         self._endpointpath = None
         self._endpointuri  = None
+        self._pool         = pool or connectionpool
+        self._retries      = retries
+        self._limiter      = limiter
         self.setQueryEndpoint(endpointhost, endpointpath, endpointuri)
         return
 
     def setQueryEndpoint(self, endpointhost=None, endpointpath=None, endpointuri=None):
         if endpointuri:
-            # assume scheme is http, no query, no fragment
+            # assume no query, no fragment
             up = urllib.parse.urlsplit(endpointuri)
+            self._endpointscheme = up.scheme or "http"
             endpointhost = up.netloc
             endpointpath = up.path
             ### print("---- endpointhost "+repr(endpointhost)+", endpointpath "+repr(endpointpath))
         if endpointhost: self._endpointhost = endpointhost
         if endpointpath: self._endpointpath = endpointpath
-        logger.debug("setQueryEndPoint: endpointhost %s: " % self._endpointhost)
-        logger.debug("setQueryEndPoint: endpointpath %s: " % self._endpointpath)
+        self._endpointuri = "%s://%s%s"%(self._endpointscheme, self._endpointhost, self._endpointpath)
+        log.debug("setQueryEndPoint: endpointhost %s: " % self._endpointhost)
+        log.debug("setQueryEndPoint: endpointpath %s: " % self._endpointpath)
+
+    def doRequest(self, method, path, body, reqheaders, stream=False):
+        """
+        Issue HTTP request using a pooled connection, and read the response.
+        Gzip content-encoded response data is decompressed.
 
-    def doQueryGET(self, query, accept="application/JSON", JSON=True, followredirect=False):
+        Returns the response object and response data.  If a reused connection
+        turns out to have been closed by the server, the request is retried once
+        on a new connection.
+
+        If the endpoint responds that it is overloaded, the request is retried
+        after a delay, up to the number of retries given when the client was
+        created.  If a limiter (see SparqlParallel.AdaptiveLimiter) was given,
+        each attempt is made within the limiter, which is told of the outcome.
+
+        If stream is True, the response is not read:  a PooledResponse object
+        is returned in place of the response, and the response data is None.
+        Any limiter is then held until the response has been read or closed.
+        """
+        attempt = 0
+        while True:
+            if self._limiter and stream:
+                self._limiter.acquire()
+                try:
+                    (response, responsedata) = self._doRequestOnce(
+                        method, path, body, reqheaders, stream, self._limiter)
+                except:
+                    self._limiter.release()
+                    raise
+            elif self._limiter:
+                with self._limiter:
+                    (response, responsedata) = self._doRequestOnce(method, path, body, reqheaders, stream)
+            else:
+                (response, responsedata) = self._doRequestOnce(method, path, body, reqheaders, stream)
+            if response.status not in RETRYSTATUS:
+                if self._limiter and response.status < 400:
+                    self._limiter.success()
+                return (response, responsedata)
+            if self._limiter:
+                self._limiter.congestion()
+            if attempt >= self._retries:
+                return (response, responsedata)
+            delay = retryDelay(attempt, response.getheader("Retry-After"))
+            log.debug("doRequest: status %i; retry in %.2fs"%(response.status, delay))
+            if stream:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def _doRequestOnce(self, method, path, body, reqheaders, stream, limiter=None):
+        scheme = self._endpointscheme
+        host   = self._endpointhost
+        while True:
+            (hc, reused) = self._pool.getConnection(scheme, host)
+            try:
+                hc.request(method, path, body, reqheaders)
+                response     = hc.getresponse()
+                if stream:
+                    return (PooledResponse(response, hc, self._pool, scheme, host, limiter), None)
+                responsedata = response.read()
+            except (http.client.HTTPException, ConnectionError) as e:
+                hc.close()
+                if reused:
+                    log.debug("doRequest: retry after stale connection: %s"%(repr(e)))
+                    continue
+                raise
+            except:
+                hc.close()
+                raise
+            if response.will_close:
+                hc.close()
+            else:
+                self._pool.putConnection(scheme, host, hc)
+            if isGzipEncoded(response):
+                responsedata = gzip.decompress(responsedata)
+            return (response, responsedata)
+
+    def doQueryGET(self, query, accept="application/JSON", JSON=True, followredirect=False, stream=False):
         """
         Issue SPARQL query as HTTP GET request.
+
+        If stream is True, the response data returned is a file-like object
+        from which the response is read.
         """
         ###print "---- query "+query
         reqheaders   = {
-            "Accept":       accept
+            "Accept":           accept,
+            "Accept-Encoding":  "gzip"
             }
-        hc = http.client.HTTPConnection(self._endpointhost)
         encodequery  = urllib.parse.urlencode({"query": query})
-        hc.request("GET", self._endpointpath+"?"+encodequery, None, reqheaders)
-        response = hc.getresponse()
+        (response, responsedata) = self.doRequest(
+            "GET", self._endpointpath+"?"+encodequery, None, reqheaders, stream=stream)
         status = response.status
         reason = response.reason
-        responsedata = response.read()
-        hc.close()
+        if stream:
+            return ((status, reason), response)
         if status == 200 and JSON:
             responsedata = json.loads(responsedata)
         return ((status, reason), responsedata)
 
-    def doQueryPOST(self, query, accept="application/JSON", JSON=True, followredirect=True):
+    def doQueryPOST(self, query, accept="application/JSON", JSON=True, followredirect=True, stream=False):
         """
         Issue SPARQL query as HTTP POST request.
+
+        A redirect response is followed with a GET request to the new location,
+        which is remembered so that later queries to the same endpoint go there
+        directly.
+
+        If stream is True, the response data returned is a file-like object
+        from which the response is read.
         """
         ### print( "---- query "+query )
+        redirecturl = self._pool.getRedirect(self._endpointuri)
+        if redirecturl and followredirect:
+            self.setQueryEndpoint(endpointuri=redirecturl)
+            return self.doQueryGET(query, accept=accept, JSON=JSON, followredirect=False, stream=stream)
         reqheaders   = {
-            "Content-type": "application/x-www-form-urlencoded",
-            "Accept":       accept
+            "Content-type":     "application/x-www-form-urlencoded",
+            "Accept":           accept,
+            "Accept-Encoding":  "gzip"
             }
-        hc = http.client.HTTPConnection(self._endpointhost)
         encodequery  = urllib.parse.urlencode({"query": query})
-        hc.request("POST", self._endpointpath, encodequery, reqheaders)
-        response = hc.getresponse()
+        (response, responsedata) = self.doRequest(
+            "POST", self._endpointpath, encodequery, reqheaders, stream=stream)
         status = response.status
         reason = response.reason
-        responsedata = response.read()
-        hc.close()
         ### print( "---- responsedata "+repr(responsedata) )
         ### print( "---- status "+repr(status)+", reason "+repr(reason))
         if status in [302, 303] and followredirect:
-            redirecturl = response.getheader("Location")
+            redirecturl = urllib.parse.urljoin(self._endpointuri, response.getheader("Location"))
             ### print( "---- location "+repr(redirecturl))
+            if stream:
+                response.read()
+            self._pool.setRedirect(self._endpointuri, redirecturl)
             self.setQueryEndpoint(endpointuri=redirecturl)
-            return self.doQueryGET(query, accept=accept, JSON=JSON, followredirect=False)
+            return self.doQueryGET(query, accept=accept, JSON=JSON, followredirect=False, stream=stream)
+        if stream:
+            return ((status, reason), response)
         if status == 200 and JSON:
             responsedata = json.loads(responsedata)
         return ((status, reason), responsedata)
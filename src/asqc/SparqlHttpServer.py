@@ -0,0 +1,363 @@
+"""
+Local SPARQL HTTP endpoint serving RDF data loaded by asq
+
+'asq --serve PORT' loads the RDF data specified by -r options once, then answers
+SPARQL 1.1 protocol query requests (GET, or POST with a form-encoded or direct
+query) on localhost, so that 'asq -e' pipelines can reuse the loaded data.
+
+Requests are handled by a pool of worker threads.  The served graph is not
+changed, so queries are evaluated concurrently, except against a store that
+does not allow concurrent reads (e.g. SqliteStore), when query evaluation is
+serialized by a lock.  Results are serialized outside the lock, and written to
+the client as they are formatted, using chunked transfer encoding.
+"""
+
+import sys
+import copy
+import socket
+import logging
+import threading
+import traceback
+import urllib.parse
+import http.server
+import concurrent.futures
+
+import rdflib
+
+from .asqc import getRdfData, queryRdfData, outputResult
+
+log = logging.getLogger(__name__)
+
+# Default number of worker threads
+
+SERVETHREADS = 8
+
+# Seconds that an idle keep-alive connection may hold a worker thread.
+# An idle connection is also closed if a new connection is waiting for a worker.
+
+KEEPALIVETIMEOUT = 5
+
+# Path of the SPARQL endpoint:  requests for other paths are refused
+
+ENDPOINTPATH = "/sparql"
+
+# Amount of response data buffered before it is sent as a chunk
+
+CHUNKSIZE = 65536
+
+# Response media types and the corresponding asq output formats.
+# The first of each list is used when the request does not specify a type.
+
+RESULTTYPES = (
+    [ ("application/sparql-results+json", "JSON")
+    , ("application/sparql-results+xml",  "XML")
+    , ("application/json",                "JSON")
+    , ("application/xml",                 "XML")
+    ])
+
+GRAPHTYPES = (
+    [ ("application/rdf+xml",   "RDFXML")
+    , ("text/turtle",           "TURTLE")
+    , ("application/n-triples", "NT")
+    , ("text/n3",               "N3")
+    , ("application/xml",       "RDFXML")
+    ])
+
+NOBINDINGS = { "head": { "vars": [] }, "results": { "bindings": [{}] } }
+
+def negotiateType(accept, available):
+    """
+    Select a response type from a list of (media type, format) pairs, in order
+    of preference given by an HTTP Accept header value.
+    """
+    accepted = []
+    for (i, item) in enumerate((accept or "").split(",")):
+        parts = item.split(";")
+        mtype = parts[0].strip().lower()
+        q     = 1.0
+        for p in parts[1:]:
+            (name, _, val) = p.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0.0
+        if mtype and q > 0:
+            accepted.append((-q, i, mtype))
+    for (q, i, mtype) in sorted(accepted):
+        for (t, f) in available:
+            if mtype == t or mtype in ["*/*", t.split("/")[0]+"/*"]:
+                return (t, f)
+    return available[0]
+
+def allowsConcurrentQueries(store):
+    """
+    Test if queries can be evaluated concurrently against an rdflib store that
+    is not being changed:  true for the default in-memory store, and stores
+    with a true concurrent_reads attribute.
+    """
+    if type(store) is rdflib.plugin.get("default", rdflib.store.Store):
+        return True
+    return getattr(store, "concurrent_reads", False)
+
+class ResponseWriter(object):
+    """
+    Text stream that writes an HTTP response body as UTF-8, in chunks of about
+    CHUNKSIZE bytes.  With chunked transfer encoding (HTTP/1.1), close() writes
+    the final empty chunk;  otherwise, the end of the body is marked by closing
+    the connection.
+    """
+    def __init__(self, wfile, chunked):
+        self._wfile   = wfile
+        self._chunked = chunked
+        self._buffer  = []
+        self._size    = 0
+        return
+
+    def write(self, s):
+        data = s.encode("utf-8")
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= CHUNKSIZE:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self._size:
+            data = b"".join(self._buffer)
+            if self._chunked:
+                data = b"%x\r\n"%len(data)+data+b"\r\n"
+            self._wfile.write(data)
+            self._buffer = []
+            self._size   = 0
+        return
+
+    def close(self):
+        self.flush()
+        if self._chunked:
+            self._wfile.write(b"0\r\n\r\n")
+        return
+
+class SparqlRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handle SPARQL protocol query requests
+    """
+    protocol_version = "HTTP/1.1"
+    timeout          = KEEPALIVETIMEOUT
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self.server.setIdle(self.connection, True):
+                break
+            self.handle_one_request()
+        return
+
+    def parse_request(self):
+        if not self.server.setIdle(self.connection, False):
+            # Connection closed to free this worker:  the client sends the request again
+            self.close_connection = True
+            return False
+        return http.server.BaseHTTPRequestHandler.parse_request(self)
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s"%(self.address_string(), format%args))
+        return
+
+    def isEndpointPath(self):
+        """
+        Test if request is for the endpoint path, otherwise send a 404 response.
+        """
+        if urllib.parse.urlsplit(self.path).path == ENDPOINTPATH:
+            return True
+        self.sendResponse(404, "text/plain", "Not found: %s\n"%self.path)
+        return False
+
+    def do_GET(self):
+        if not self.isEndpointPath():
+            return
+        params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        self.doQuery(params.get("query", [None])[0])
+        return
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body   = self.rfile.read(length).decode("utf-8")
+        ctype  = self.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if not self.isEndpointPath():
+            pass
+        elif ctype == "application/sparql-query":
+            self.doQuery(body)
+        elif ctype == "application/x-www-form-urlencoded":
+            self.doQuery(urllib.parse.parse_qs(body).get("query", [None])[0])
+        else:
+            self.sendResponse(415, "text/plain", "Unsupported request content type: %s\n"%ctype)
+        return
+
+    def doQuery(self, query):
+        if not query:
+            self.sendResponse(400, "text/plain", "No query supplied\n")
+            return
+        server = self.server
+        accept = self.headers.get("Accept", "")
+        try:
+            rdfgraph = server.rdfgraph
+            if allowsConcurrentQueries(rdfgraph.store):
+                (status, result) = queryRdfData(server.progname, server.options, "", query,
+                    copy.deepcopy(NOBINDINGS), rdfgraph=rdfgraph)
+            else:
+                with server.querylock:
+                    (status, result) = queryRdfData(server.progname, server.options, "", query,
+                        copy.deepcopy(NOBINDINGS), rdfgraph=rdfgraph)
+        except Exception as e:
+            log.debug("traceback: %s"%(traceback.format_exc()))
+            self.sendResponse(400, "text/plain", "Query failed: %s\n"%e)
+            return
+        if result is None:
+            self.sendResponse(400, "text/plain", "Query failed (query syntax problem?)\n")
+            return
+        options = copy.copy(server.options)
+        options.output = None
+        if "results" in result or "boolean" in result:
+            (ctype, options.format_var_out) = negotiateType(accept, RESULTTYPES)
+        else:
+            (ctype, options.format_rdf_out) = negotiateType(accept, GRAPHTYPES)
+        chunked = self.request_version != "HTTP/1.0"
+        self.send_response(200)
+        self.send_header("Content-Type", ctype+"; charset=utf-8")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = True
+        self.end_headers()
+        outstr = ResponseWriter(self.wfile, chunked)
+        try:
+            outputResult(server.progname, options, result, outstr=outstr)
+            outstr.close()
+        except Exception as e:
+            # The response status has been sent:  the client sees an incomplete response
+            log.debug("traceback: %s"%(traceback.format_exc()))
+            self.close_connection = True
+        return
+
+    def sendResponse(self, status, ctype, body):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", ctype+"; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+class SparqlHttpServer(http.server.HTTPServer):
+    """
+    HTTP server that answers SPARQL queries against a loaded RDF graph, using
+    a pool of worker threads to handle connections.
+    """
+    def __init__(self, address, progname, options, rdfgraph, threads=SERVETHREADS):
+        self.progname  = progname
+        self.options   = options
+        self.rdfgraph  = rdfgraph
+        self.querylock = threading.Lock()
+        self.threads   = threads
+        self.executor  = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.active    = {}         # Connection -> True if idle
+        self.closing   = set()      # Idle connections closed to free a worker
+        self.queued    = 0          # Connections waiting for a worker
+        self.activelock = threading.Lock()
+        http.server.HTTPServer.__init__(self, address, SparqlRequestHandler)
+        return
+
+    def endpointUri(self):
+        (host, port) = self.server_address[:2]
+        return "http://%s:%i%s"%(host, port, ENDPOINTPATH)
+
+    def setIdle(self, request, idle):
+        """
+        Record whether a connection is idle, waiting for its next request.
+        Returns False if the connection has been closed to free its worker.
+        """
+        with self.activelock:
+            if request in self.closing:
+                return False
+            self.active[request] = idle
+            if idle and self.queued > 0:
+                # Free this worker for a connection that is waiting
+                self.closeIdle(request)
+                return False
+        return True
+
+    def closeIdle(self, request):
+        # Called holding activelock
+        self.active[request] = False
+        self.closing.add(request)
+        try:
+            request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        return
+
+    def process_request(self, request, client_address):
+        with self.activelock:
+            self.queued += 1
+            if len(self.active)+self.queued > self.threads:
+                # Free a worker by closing an idle keep-alive connection
+                for (r, idle) in self.active.items():
+                    if idle:
+                        self.closeIdle(r)
+                        break
+        self.executor.submit(self.processRequestThread, request, client_address)
+        return
+
+    def processRequestThread(self, request, client_address):
+        with self.activelock:
+            self.queued -= 1
+            self.active[request] = False
+        try:
+            self.finish_request(request, client_address)
+        except ConnectionError as e:
+            # Client closed or reset the connection
+            log.debug("%s - %s"%(client_address[0], e))
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self.activelock:
+                del self.active[request]
+                self.closing.discard(request)
+            self.shutdown_request(request)
+        return
+
+    def server_close(self):
+        http.server.HTTPServer.server_close(self)
+        # Close idle keep-alive connections so that worker threads can finish
+        with self.activelock:
+            for request in self.active:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.executor.shutdown(wait=True)
+        return
+
+def runServer(progname, options):
+    """
+    Load RDF data and serve SPARQL queries on the port given by --serve, until interrupted.
+    """
+    rdfgraph = getRdfData(options)
+    if not rdfgraph:
+        print( "%s: Could not read RDF data, or syntax error in input"%progname )
+        return 2
+    threads = getattr(options, "serve_threads", None) or SERVETHREADS
+    server  = SparqlHttpServer(("localhost", options.serve), progname, options, rdfgraph, threads)
+    print( "%s: serving %i triples at %s"%(progname, len(rdfgraph), server.endpointUri()) )
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+# End.
@@ -0,0 +1,196 @@
+# This module provides an incremental parser for SPARQL query results in
+# JSON format (application/sparql-results+json), which returns result
+# bindings one at a time as they are read from a stream, and a matching
+# writer.
+#
+# See http://www.w3.org/TR/sparql11-results-json/
+
+import json
+import codecs
+
+BUFFERSIZE = 65536
+
+class JsonStreamReader(object):
+    """
+    Reads JSON text incrementally from a binary (UTF-8) or text stream,
+    keeping only unprocessed text in memory.
+    """
+    def __init__(self, stream, bufsize=BUFFERSIZE):
+        self._stream  = stream
+        self._bufsize = bufsize
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._decode  = json.JSONDecoder().raw_decode
+        self._buf     = ""
+        self._pos     = 0
+        self._eof     = False
+        return
+
+    def _fill(self):
+        """
+        Read more data into buffer, discarding text already processed.
+        Returns False if there is no more data.
+        """
+        if self._eof:
+            return False
+        data = self._stream.read(self._bufsize)
+        if isinstance(data, bytes):
+            text = self._decoder.decode(data, final=not data)
+        else:
+            text = data
+        if not data:
+            self._eof = True
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        return bool(text) or not self._eof
+
+    def peek(self):
+        """
+        Skip white space and return next character, or None at end of data
+        """
+        while True:
+            buf = self._buf
+            pos = self._pos
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self._fill():
+                return None
+
+    def expect(self, chars):
+        c = self.peek()
+        if c is None or c not in chars:
+            raise ValueError("JSON results: expected one of %r, found %r"%(chars, c))
+        self._pos += 1
+        return c
+
+    def value(self):
+        """
+        Read and return a complete JSON value
+        """
+        self.peek()
+        while True:
+            try:
+                (val, end) = self._decode(self._buf, self._pos)
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return val
+                # Value ends at end of buffer: may be a truncated number
+            except ValueError:
+                if self._eof:
+                    raise
+            self._fill()
+
+def iterResultsJSON(stream):
+    """
+    Generate (key, value) events from SPARQL JSON results read from a stream:
+
+    ("head", head)          the results header
+    ("boolean", value)      the result of an ASK query
+    ("results", None)       start of SELECT query results
+    ("binding", binding)    a single result binding, as a dictionary of JSON terms
+
+    Any other keys in the outer object are returned with their values.
+    """
+    reader = JsonStreamReader(stream)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key == "results":
+            yield ("results", None)
+            reader.expect("{")
+            if reader.peek() != "}":
+                while True:
+                    rkey = reader.value()
+                    reader.expect(":")
+                    if rkey == "bindings":
+                        reader.expect("[")
+                        if reader.peek() != "]":
+                            while True:
+                                yield ("binding", reader.value())
+                                if reader.expect(",]") == "]":
+                                    break
+                        else:
+                            reader.expect("]")
+                    else:
+                        reader.value()
+                    if reader.expect(",}") == "}":
+                        break
+            else:
+                reader.expect("}")
+        else:
+            yield (key, reader.value())
+        if reader.expect(",}") == "}":
+            break
+    return
+
+def readResultsJSON(stream):
+    """
+    Read SPARQL JSON results from a stream, returning a structure like that
+    returned by json.load, except that the value of ["results"]["bindings"] is
+    an iterator that reads result bindings from the stream as they are used.
+
+    The stream is read until the header and the first binding have been seen;
+    bindings that precede the header are held in memory.
+    """
+    result   = {}
+    bindings = []
+    events   = iterResultsJSON(stream)
+    for (key, val) in events:
+        if key == "binding":
+            bindings.append(val)
+            if "head" in result:
+                break
+        elif key == "results":
+            result["results"] = {}
+        else:
+            result[key] = val
+    def iterBindings():
+        for b in bindings:
+            yield b
+        for (key, val) in events:
+            if key == "binding":
+                yield val
+    if "results" in result:
+        result["results"]["bindings"] = iterBindings()
+    return result
+
+def writeResultsJSON(outstr, results, flushrows=None):
+    """
+    Write SPARQL results as JSON.  Result bindings are written one at a time as
+    they are taken from results["results"]["bindings"], which may be an iterator,
+    and the output is flushed after every flushrows bindings.
+
+    Returns the number of result bindings written, or None if the results have
+    no bindings (e.g. ASK query results).
+    """
+    if "results" not in results:
+        outstr.write(json.dumps(results))
+        outstr.write("\n")
+        return None
+    outstr.write("{")
+    for (key, val) in results.items():
+        if key != "results":
+            outstr.write("%s: %s, "%(json.dumps(key), json.dumps(val)))
+    outstr.write('"results": {')
+    for (key, val) in results["results"].items():
+        if key != "bindings":
+            outstr.write("%s: %s, "%(json.dumps(key), json.dumps(val)))
+    outstr.write('"bindings": [')
+    count = 0
+    for b in results["results"]["bindings"]:
+        if count:
+            outstr.write(", ")
+        outstr.write(json.dumps(b))
+        count += 1
+        if flushrows and count % flushrows == 0:
+            outstr.flush()
+    outstr.write("]}}\n")
+    outstr.flush()
+    return count
+
+# End.
@@ -0,0 +1,141 @@
+"""
+Concurrent execution of independent SPARQL endpoint requests
+
+Requests are run in a pool of worker threads with a limit on the number in
+flight at any time, and their results are returned in the order in which
+the requests were supplied so that output is deterministic.  CPU-bound work,
+such as parsing RDF data, may use a pool of worker processes instead.
+
+The number of requests sent to an endpoint at once may be further limited by
+an AdaptiveLimiter, which responds to signs of congestion at the endpoint.
+"""
+
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+
+log = logging.getLogger(__name__)
+
+# Minimum interval in seconds between reductions of an adaptive limit, so that
+# congestion signals from requests that were in progress together cause a
+# single reduction
+
+DECREASEINTERVAL = 1.0
+
+class AdaptiveLimiter(object):
+    """
+    Limit on the number of requests in progress at once, adjusted by additive
+    increase and multiplicative decrease (AIMD):  the limit is halved when the
+    endpoint signals congestion, and grows by about one for each limit's worth
+    of successful requests, up to a maximum.
+
+    Used as a context manager around each request, which waits until the
+    number of requests in progress is below the current limit.
+    """
+    def __init__(self, maxlimit, minlimit=1):
+        self.maxlimit  = maxlimit
+        self.minlimit  = minlimit
+        self.limit     = float(maxlimit)
+        self._inflight = 0
+        self._decrease = None       # Time of last decrease
+        self._cond     = threading.Condition()
+        return
+
+    def acquire(self):
+        """
+        Wait until the number of requests in progress is below the current
+        limit, and count a new request in progress.
+        """
+        with self._cond:
+            while self._inflight >= int(self.limit):
+                self._cond.wait()
+            self._inflight += 1
+        return
+
+    def release(self):
+        """
+        Count the end of a request in progress.
+        """
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+        return
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exctype, excval, exctraceback):
+        self.release()
+        return False
+
+    def success(self):
+        with self._cond:
+            self.limit = min(self.maxlimit, self.limit + 1.0/self.limit)
+            self._cond.notify_all()
+        return
+
+    def congestion(self):
+        with self._cond:
+            now = time.time()
+            if self._decrease is None or now - self._decrease >= DECREASEINTERVAL:
+                self.limit     = max(self.minlimit, self.limit/2)
+                self._decrease = now
+                log.debug("AdaptiveLimiter: congestion, limit %.2f"%(self.limit))
+        return
+
+def _timedCall(func, item):
+    start = time.time()
+    result = func(item)
+    return (result, time.time()-start)
+
+def orderedMap(func, items, parallel=1, processes=False, discard=None):
+    """
+    Generate (item, func(item), elapsed seconds) for each of the supplied items,
+    in the order given, with up to `parallel` calls of func running concurrently.
+
+    Items are consumed only as workers become free, so `items` may be an
+    unbounded iterator:  the caller stops by abandoning the generator, when any
+    calls still in progress are allowed to finish and their results discarded,
+    after being passed to the discard function if one is supplied (e.g. to
+    close a response).  An exception raised by func is re-raised when its
+    result is reached.
+
+    If processes is True, calls are run in worker processes, so func, the items
+    and the results must be picklable.
+    """
+    items = iter(items)
+    if parallel <= 1:
+        for item in items:
+            (result, elapsed) = _timedCall(func, item)
+            yield (item, result, elapsed)
+        return
+    pending  = collections.deque()
+    if processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=parallel)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=parallel)
+    try:
+        for item in items:
+            pending.append((item, executor.submit(_timedCall, func, item)))
+            if len(pending) >= parallel:
+                (item, future) = pending.popleft()
+                (result, elapsed) = future.result()
+                yield (item, result, elapsed)
+        while pending:
+            (item, future) = pending.popleft()
+            (result, elapsed) = future.result()
+            yield (item, result, elapsed)
+    finally:
+        for (item, future) in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        if discard:
+            for (item, future) in pending:
+                if not future.cancelled() and future.exception() is None:
+                    discard(future.result()[0])
+    return
+
+# End.
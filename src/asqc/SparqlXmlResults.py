@@ -1,78 +1,192 @@
 # This module provides an XML serializer for SPARQL results that are
-# supplied as a SPARQL results structure suitable for output as JSON 
+# supplied as a SPARQL results structure suitable for output as JSON, and an
+# incremental parser that reads XML results into the same structure.
+#
+# Result bindings are formatted one at a time as they are taken from the
+# results, which may be an iterator, and written in blocks, so that memory
+# use does not depend on the number of results.  Pretty-printing indentation
+# is added as the elements are written.
+#
+# The parser likewise returns result bindings one at a time as they are read
+# from a stream, discarding each result element once it has been used.
+#
+# See http://www.w3.org/TR/rdf-sparql-XMLres/
 
-# import StringIO
-
-from xml.etree.ElementTree import Element, SubElement, ElementTree, _namespace_map
+from xml.etree.ElementTree import iterparse
 
 SPARQL_RESULT_NS = "http://www.w3.org/2005/sparql-results#"
 XML_SCHEMA_NS    = "http://www.w3.org/2001/XMLSchema#"
+XML_NS           = "http://www.w3.org/XML/1998/namespace"
 
-def sparql_name(tag):
-    return "{%s}%s" % (SPARQL_RESULT_NS, tag)
+# Number of results written in one block, if not otherwise specified
+
+BLOCKROWS = 1000
+
+def escapeText(s):
+    if "&" in s: s = s.replace("&", "&amp;")
+    if "<" in s: s = s.replace("<", "&lt;")
+    if ">" in s: s = s.replace(">", "&gt;")
+    return s
+
+def escapeAttrib(s):
+    s = escapeText(s)
+    if '"'  in s: s = s.replace('"', "&quot;")
+    if "\n" in s: s = s.replace("\n", "&#10;")
+    if "\r" in s: s = s.replace("\r", "&#13;")
+    if "\t" in s: s = s.replace("\t", "&#09;")
+    return s
+
+class XmlLayout(object):
+    """
+    Line breaks and indentation for elements at each level of nesting.  With
+    indent=None, elements are written without line breaks or indentation.
+    """
+    def __init__(self, indent="  "):
+        if indent is None:
+            self._lines = [""]*5
+        else:
+            self._lines = [ "\n"+indent*level for level in range(5) ]
+        return
+
+    def __getitem__(self, level):
+        return self._lines[level]
 
-def xml_name(tag):
-    return "{%s}%s" % (XML_SCHEMA_NS, tag)
-
-def addHeader(head, root):
-    headerElem = SubElement(root, sparql_name("head"))
-    for var in head["vars"]:
-        varElem = SubElement(headerElem, sparql_name("variable"))
-        varElem.attrib["name"] = var
-    return
-
-def addBinding(var, val, result):
-    bindingElem = SubElement(result, sparql_name("binding"), name=var)
-    if val["type"] == "uri":
-        varElem = SubElement(bindingElem, sparql_name("uri"))
-    elif val["type"] == "bnode":
-        varElem = SubElement(bindingElem, sparql_name("bnode"))
-    elif val["type"] in ["literal","typed-literal"]:
-        varElem = SubElement(bindingElem, sparql_name(u'literal'))
+def formatHeader(head, nl):
+    variables = [ '<variable name="%s" />'%escapeAttrib(str(var)) for var in head.get("vars", []) ]
+    if not variables:
+        return nl[1]+'<head />'
+    return nl[1]+'<head>'+"".join([ nl[2]+v for v in variables ])+nl[1]+'</head>'
+
+def formatTerm(val):
+    valtype = val["type"]
+    if valtype == "uri":
+        return '<uri>%s</uri>'%escapeText(val["value"])
+    if valtype == "bnode":
+        return '<bnode>%s</bnode>'%escapeText(val["value"])
+    if valtype in ["literal","typed-literal"]:
+        attrs = ""
         if "xml:lang" in val:
-            varElem.attrib[xml_name("lang")] = val["xml:lang"]
-        if val["type"] == "typed-literal" and "datatype" in val:
-            varElem.attrib[sparql_name("datatype")] = val["datatype"]
-    varElem.text = val["value"]
-    return
-
-def addResults(results, root):
-    resultsElem = SubElement(root, sparql_name("results"))
-    for resultbindings in results["bindings"]:
-        resultElem = SubElement(resultsElem, sparql_name("result"))
-        for (var, val) in resultbindings.iteritems():
-            addBinding(var, val, resultElem)
-    return
-
-# See http://effbot.org/zone/element-lib.htm#prettyprint
-def indentTree(elem, level=0):
-    i = "\n" + level*"  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indentTree(elem, level+1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+            attrs += ' xml:lang="%s"'%escapeAttrib(val["xml:lang"])
+        if "datatype" in val:
+            attrs += ' datatype="%s"'%escapeAttrib(val["datatype"])
+        return '<literal%s>%s</literal>'%(attrs, escapeText(val["value"]))
+    raise ValueError("Unknown term type: %s"%(valtype))
 
-def writeResultsXML(outstr, results):
+def formatResult(resultbindings, nl):
+    if not resultbindings:
+        return nl[2]+'<result />'
+    bindings = [ '%s<binding name="%s">%s%s%s</binding>'%
+                 (nl[3], escapeAttrib(str(var)), nl[4], formatTerm(val), nl[3])
+                 for (var, val) in resultbindings.items() ]
+    return nl[2]+'<result>'+"".join(bindings)+nl[2]+'</result>'
+
+def writeResultsXML(outstr, results, flushrows=None, indent="  "):
     """
     Serialize query results per http://www.w3.org/TR/rdf-sparql-XMLres/
+
+    Results are written in blocks of flushrows results, after each of which
+    the output is flushed.  The indent string is used for pretty-printing:
+    if None, the output is not indented.
+
+    Returns the number of result bindings written, or None for ASK query results.
     """
-    root = Element(sparql_name("sparql"))
-    addHeader(results["head"], root)
-    addResults(results["results"], root)
-    resulttree = ElementTree(root)
-    indentTree(root)
-    _namespace_map[SPARQL_RESULT_NS] = ''
+    nl = XmlLayout(indent)
     outstr.write('<?xml version="1.0" encoding="utf-8"?>\n')
     outstr.write('<?xml-stylesheet type="text/xsl" href="/static/sparql-xml-to-html.xsl"?>\n')
-    resulttree.write(outstr, encoding="utf-8")
-    return
+    outstr.write('<sparql xmlns="%s">'%SPARQL_RESULT_NS)
+    outstr.write(formatHeader(results["head"], nl))
+    count = None
+    if "boolean" in results:
+        outstr.write(nl[1]+'<boolean>%s</boolean>'%("true" if results["boolean"] else "false"))
+    else:
+        blockrows = flushrows or BLOCKROWS
+        block     = [nl[1]+'<results>']
+        count     = 0
+        for resultbindings in results["results"]["bindings"]:
+            block.append(formatResult(resultbindings, nl))
+            count += 1
+            if count % blockrows == 0:
+                outstr.write("".join(block))
+                block = []
+                if flushrows:
+                    outstr.flush()
+        if count:
+            block.append(nl[1]+'</results>')
+        else:
+            block = [nl[1]+'<results />']
+        outstr.write("".join(block))
+    outstr.write(nl[0]+'</sparql>\n')
+    outstr.flush()
+    return count
+
+# XML results parser
+
+def sparql_name(tag):
+    return "{%s}%s" % (SPARQL_RESULT_NS, tag)
+
+SPARQL_VARIABLE = sparql_name("variable")
+SPARQL_BOOLEAN  = sparql_name("boolean")
+SPARQL_RESULTS  = sparql_name("results")
+SPARQL_RESULT   = sparql_name("result")
+SPARQL_BINDING  = sparql_name("binding")
+SPARQL_URI      = sparql_name("uri")
+SPARQL_BNODE    = sparql_name("bnode")
+SPARQL_LITERAL  = sparql_name("literal")
+XML_LANG        = "{%s}lang" % (XML_NS)
+
+def parseTerm(elem):
+    """
+    Return JSON-style result term for a uri, bnode or literal element
+    """
+    value = elem.text or ""
+    if elem.tag == SPARQL_URI:
+        return { 'type': 'uri', 'value': value }
+    if elem.tag == SPARQL_BNODE:
+        return { 'type': 'bnode', 'value': value }
+    if elem.tag == SPARQL_LITERAL:
+        if XML_LANG in elem.attrib:
+            return { 'type': 'literal', 'value': value, 'xml:lang': elem.attrib[XML_LANG] }
+        if "datatype" in elem.attrib:
+            return { 'type': 'typed-literal', 'value': value, 'datatype': elem.attrib["datatype"] }
+        return { 'type': 'literal', 'value': value }
+    raise ValueError("Unknown term element in XML results: %s"%(elem.tag))
+
+def parseResult(elem):
+    """
+    Return JSON-style result bindings for a result element
+    """
+    bindings = {}
+    for bindingElem in elem.iter(SPARQL_BINDING):
+        for termElem in bindingElem:
+            bindings[bindingElem.attrib["name"]] = parseTerm(termElem)
+    return bindings
+
+def readResultsXML(stream):
+    """
+    Read SPARQL XML results from a binary stream, returning a structure like
+    that returned by readResultsJSON:  the value of ["results"]["bindings"]
+    is an iterator that reads result bindings from the stream as they are used.
+
+    The stream is read until the results or boolean element is seen.
+    """
+    result = { "head": { "vars": [] } }
+    events = iterparse(stream, events=("start", "end"))
+    for (event, elem) in events:
+        if event == "end" and elem.tag == SPARQL_VARIABLE:
+            result["head"]["vars"].append(elem.attrib["name"])
+        elif event == "end" and elem.tag == SPARQL_BOOLEAN:
+            result["boolean"] = (elem.text or "").strip() == "true"
+            break
+        elif event == "start" and elem.tag == SPARQL_RESULTS:
+            resultsElem = elem
+            def iterBindings():
+                for (event, elem) in events:
+                    if event == "end" and elem.tag == SPARQL_RESULT:
+                        yield parseResult(elem)
+                        resultsElem.clear()
+                return
+            result["results"] = { "bindings": iterBindings() }
+            break
+    return result
 
 # End.
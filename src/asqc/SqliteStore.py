@@ -0,0 +1,295 @@
+"""
+Persistent rdflib store using SQLite
+
+Triples are held in a SQLite database file, so graphs larger than the available
+memory can be queried:  only the triples read by a query are brought into the
+Python heap.  Terms are stored once in a term table (see TermCodec), and triples
+as rows of term numbers in a table whose primary key is (s, p, o), with covering
+indexes on (p, o, s) and (o, s, p), so that any triple pattern is answered by a
+range scan of one index.
+
+Triples added to the store are buffered, and written in batches in a single
+transaction, for fast bulk loading.
+
+RDF data is parsed into the store through a graph returned by loadGraph, as not
+all parsers can use the store directly.
+
+The store also records the local files that have been loaded into it, so that
+they need not be loaded again.
+"""
+
+import sqlite3
+import logging
+import functools
+
+import rdflib
+from rdflib.store import Store
+
+from .TermCodec import encodeTerm, decodeTerm
+
+log = logging.getLogger(__name__)
+
+# Number of triples buffered before they are written to the database
+
+ADDBATCHSIZE = 50000
+
+# Maximum number of term numbers held in memory during bulk loading
+
+TERMCACHESIZE = 500000
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS terms
+        ( id   INTEGER PRIMARY KEY
+        , term TEXT NOT NULL UNIQUE
+        );
+    CREATE TABLE IF NOT EXISTS triples
+        ( s INTEGER NOT NULL
+        , p INTEGER NOT NULL
+        , o INTEGER NOT NULL
+        , PRIMARY KEY (s, p, o)
+        ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS triples_pos ON triples (p, o, s);
+    CREATE INDEX IF NOT EXISTS triples_osp ON triples (o, s, p);
+    CREATE TABLE IF NOT EXISTS namespaces
+        ( prefix TEXT PRIMARY KEY
+        , uri    TEXT NOT NULL
+        );
+    CREATE TABLE IF NOT EXISTS sources
+        ( path   TEXT PRIMARY KEY
+        , size   INTEGER
+        , mtime  REAL
+        , format TEXT
+        );
+    """
+
+class SqliteStore(Store):
+    """
+    rdflib store for a single graph held in a SQLite database file.
+    """
+    context_aware = False
+    formula_aware = False
+    graph_aware   = False
+    # Queries share one database connection, so must not be run concurrently
+    concurrent_reads = False
+
+    def __init__(self, path, identifier=None):
+        Store.__init__(self, configuration=None, identifier=identifier)
+        # check_same_thread=False: queries may be run by worker threads (e.g. --serve),
+        # which are serialized by the caller
+        self._db      = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._pending = []
+        self._termids = {}
+        self.decode   = functools.lru_cache(maxsize=65536)(decodeTerm)
+        return
+
+    # Term table access
+
+    def termId(self, term):
+        """
+        Return number of term in store, or None if it does not appear.
+        """
+        try:
+            text = encodeTerm(term)
+        except ValueError:
+            return None
+        row = self._db.execute("SELECT id FROM terms WHERE term = ?", (text,)).fetchone()
+        return row[0] if row else None
+
+    def _addTerms(self, texts):
+        """
+        Ensure terms are in the term table, and their numbers in the term cache.
+        """
+        texts = set(texts)
+        missing = [ t for t in texts if t not in self._termids ]
+        if len(self._termids)+len(missing) > TERMCACHESIZE:
+            # Clear the cache first, so that all the terms are then looked up
+            self._termids = {}
+            missing = list(texts)
+        texts = missing
+        self._db.executemany("INSERT OR IGNORE INTO terms (term) VALUES (?)", [ (t,) for t in texts ])
+        for i in range(0, len(texts), 500):
+            chunk = texts[i:i+500]
+            for (termid, text) in self._db.execute(
+                    "SELECT id, term FROM terms WHERE term IN (%s)"%(",".join("?"*len(chunk))), chunk):
+                self._termids[text] = termid
+        return
+
+    # Adding and removing triples
+
+    def add(self, triple, context=None, quoted=False):
+        self._pending.append(tuple(encodeTerm(t) for t in triple))
+        if len(self._pending) >= ADDBATCHSIZE:
+            self.flush()
+        return
+
+    def addN(self, quads):
+        for (s, p, o, c) in quads:
+            self.add((s, p, o), c)
+        return
+
+    def flush(self):
+        """
+        Write buffered triples to the database
+        """
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+        self._addTerms([ t for triple in pending for t in triple ])
+        termids = self._termids
+        self._db.executemany("INSERT OR IGNORE INTO triples (s, p, o) VALUES (?, ?, ?)",
+            [ (termids[s], termids[p], termids[o]) for (s, p, o) in pending ])
+        return
+
+    def remove(self, triple_pattern, context=None):
+        self.flush()
+        (where, params) = self._pattern(triple_pattern)
+        if where is not None:
+            self._db.execute("DELETE FROM triples"+where, params)
+        return
+
+    def clear(self):
+        """
+        Remove all triples, terms and loaded source records.
+        """
+        self._pending = []
+        self._termids = {}
+        self.term.cache_clear()
+        self._db.executescript("DELETE FROM triples; DELETE FROM terms; DELETE FROM sources;")
+        return
+
+    def commit(self):
+        self.flush()
+        self._db.commit()
+        return
+
+    def rollback(self):
+        self._pending = []
+        self._db.rollback()
+        return
+
+    def close(self, commit_pending_transaction=True):
+        if commit_pending_transaction:
+            self.commit()
+        self._db.close()
+        return
+
+    # Querying triples
+
+    def _isBound(self, t):
+        return isinstance(t, rdflib.term.Identifier) and not isinstance(t, rdflib.Variable)
+
+    def _pattern(self, triple_pattern):
+        """
+        Return SQL WHERE clause and parameters for a triple pattern, or (None, None)
+        if a term in the pattern is not in the store.
+        """
+        conds  = []
+        params = []
+        for (col, t) in zip(("s", "p", "o"), triple_pattern):
+            if self._isBound(t):
+                termid = self.termId(t)
+                if termid is None:
+                    return (None, None)
+                conds.append("%s = ?"%col)
+                params.append(termid)
+        return ((" WHERE "+" AND ".join(conds)) if conds else "", params)
+
+    def triples(self, triple_pattern, context=None):
+        self.flush()
+        (where, params) = self._pattern(triple_pattern)
+        if where is None:
+            return
+        # The text of each term not given in the pattern is read with the triple
+        cols  = []
+        joins = []
+        for (col, t) in zip(("s", "p", "o"), triple_pattern):
+            if not self._isBound(t):
+                cols.append("%sterm.term"%col)
+                joins.append(" JOIN terms %sterm ON %sterm.id = triples.%s"%(col, col, col))
+        sql    = "SELECT "+(", ".join(cols) or "1")+" FROM triples"+"".join(joins)+where
+        decode = self.decode
+        for row in self._db.execute(sql, params):
+            texts = iter(row)
+            yield ( tuple( t if self._isBound(t) else decode(next(texts)) for t in triple_pattern )
+                  , iter([None]) )
+        return
+
+    def __len__(self, context=None):
+        self.flush()
+        return self._db.execute("SELECT COUNT(*) FROM triples").fetchone()[0]
+
+    # Namespace bindings
+
+    def bind(self, prefix, namespace, override=True, **kwargs):
+        verb = "REPLACE" if override else "IGNORE"
+        self._db.execute("INSERT OR %s INTO namespaces (prefix, uri) VALUES (?, ?)"%verb,
+            (prefix, str(namespace)))
+        return
+
+    def namespace(self, prefix):
+        row = self._db.execute("SELECT uri FROM namespaces WHERE prefix = ?", (prefix,)).fetchone()
+        return rdflib.URIRef(row[0]) if row else None
+
+    def prefix(self, namespace):
+        row = self._db.execute("SELECT prefix FROM namespaces WHERE uri = ?", (str(namespace),)).fetchone()
+        return row[0] if row else None
+
+    def namespaces(self):
+        for (prefix, uri) in self._db.execute("SELECT prefix, uri FROM namespaces").fetchall():
+            yield (prefix, rdflib.URIRef(uri))
+        return
+
+    def loadGraph(self):
+        """
+        Return graph into which RDF data can be parsed to add it to the store.
+        """
+        return rdflib.Graph(store=SqliteLoadStore(self))
+
+    # Record of loaded source files
+
+    def loadedSources(self):
+        """
+        Return dictionary of loaded files, giving (size, mtime, format) for each path
+        """
+        return dict( (path, (size, mtime, fmt)) for (path, size, mtime, fmt)
+                     in self._db.execute("SELECT path, size, mtime, format FROM sources") )
+
+    def addLoadedSource(self, path, size, mtime, fmt):
+        self._db.execute("INSERT OR REPLACE INTO sources (path, size, mtime, format) VALUES (?, ?, ?, ?)",
+            (path, size, mtime, fmt))
+        return
+
+class SqliteLoadStore(rdflib.plugin.get("default", Store)):
+    """
+    Store through which RDF data is parsed into a SqliteStore.  Asserted triples
+    and namespace bindings are passed to the SQLite store, and not kept in memory.
+
+    Unlike SqliteStore, this store is context-aware and formula-aware, so it can
+    be used with the N3 (and Turtle) parser.  Triples quoted in N3 formulae are
+    kept in memory, and not added to the SQLite store.
+    """
+    def __init__(self, target):
+        super(SqliteLoadStore, self).__init__()
+        self.target = target
+        return
+
+    def add(self, triple, context, quoted=False):
+        if quoted:
+            return super(SqliteLoadStore, self).add(triple, context, quoted)
+        self.target.add(triple)
+        return
+
+    def bind(self, prefix, namespace, *args, **kwargs):
+        self.target.bind(prefix, namespace)
+        return super(SqliteLoadStore, self).bind(prefix, namespace, *args, **kwargs)
+
+def openSqliteGraph(path):
+    """
+    Return graph that accesses the SQLite store in the named file, creating it
+    if it does not exist.
+    """
+    return rdflib.Graph(store=SqliteStore(path))
+
+# End.
@@ -17,7 +17,7 @@ class SwitchStdin:
         return
     
     def __enter__(self):
-        if isinstance(self.fileorstr,basestring):
+        if isinstance(self.fileorstr,str):
             self.inpstr = open(self.fileorstr, "r")
             self.opened = True
         else:
@@ -20,7 +20,7 @@ class SwitchStdout:
         return
     
     def __enter__(self):
-        if isinstance(self.fileorstr,basestring):
+        if isinstance(self.fileorstr,str):
             self.outstr = open(self.fileorstr, "w")
             self.opened = True
         else:
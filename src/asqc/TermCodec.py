@@ -0,0 +1,73 @@
+"""
+Compact string encoding of RDF terms
+
+Terms are encoded as a single string whose first character indicates the kind of
+term, for use as keys in term dictionaries of stored graphs and binding sets.
+Both rdflib terms and JSON-style query result terms can be encoded:
+
+    <uri                        URI reference
+    _id                         blank node
+    "lang\\0datatype\\0value     literal (lang and datatype may be empty)
+"""
+
+import rdflib
+
+def encodeTerm(term):
+    """
+    Return string encoding of an rdflib term
+    """
+    if isinstance(term, rdflib.URIRef):
+        return "<"+str(term)
+    if isinstance(term, rdflib.BNode):
+        return "_"+str(term)
+    if isinstance(term, rdflib.Literal):
+        return '"%s\0%s\0%s'%(term.language or "", term.datatype or "", term)
+    raise ValueError("Cannot encode RDF term %r"%(term,))
+
+def decodeTerm(text):
+    """
+    Return rdflib term for a string encoding
+    """
+    kind = text[:1]
+    if kind == "<":
+        return rdflib.URIRef(text[1:])
+    if kind == "_":
+        return rdflib.BNode(text[1:])
+    if kind == '"':
+        (lang, datatype, value) = text[1:].split("\0", 2)
+        return rdflib.Literal(value, lang=lang or None,
+            datatype=rdflib.URIRef(datatype) if datatype else None)
+    raise ValueError("Invalid RDF term encoding %r"%(text,))
+
+def encodeJsonTerm(term):
+    """
+    Return string encoding of a JSON-style query result term
+    """
+    termtype = term["type"]
+    if termtype == "uri":
+        return "<"+term["value"]
+    if termtype == "bnode":
+        return "_"+term["value"]
+    if termtype in ["literal", "typed-literal"]:
+        return '"%s\0%s\0%s'%(term.get("xml:lang", ""), term.get("datatype", ""), term["value"])
+    raise ValueError("Cannot encode query result term %r"%(term,))
+
+def decodeJsonTerm(text):
+    """
+    Return JSON-style query result term for a string encoding
+    """
+    kind = text[:1]
+    if kind == "<":
+        return { "type": "uri", "value": text[1:] }
+    if kind == "_":
+        return { "type": "bnode", "value": text[1:] }
+    if kind == '"':
+        (lang, datatype, value) = text[1:].split("\0", 2)
+        if datatype:
+            return { "type": "typed-literal", "value": value, "datatype": datatype }
+        if lang:
+            return { "type": "literal", "value": value, "xml:lang": lang }
+        return { "type": "literal", "value": value }
+    raise ValueError("Invalid RDF term encoding %r"%(text,))
+
+# End.
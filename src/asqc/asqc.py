@@ -14,17 +14,34 @@ import urllib.request
 import io
 import json
 import re
+import codecs
+import itertools
+import gzip
+import bz2
+import lzma
 import optparse
 import logging
 import traceback
 
-from .SparqlHttpClient import SparqlHttpClient
-from .SparqlXmlResults import writeResultsXML
+from .SparqlHttpClient import SparqlHttpClient, RETRIES
+from .SparqlXmlResults import writeResultsXML, readResultsXML
+from .SparqlJsonResults import readResultsJSON, writeResultsJSON
+from .SparqlCsvResults  import writeResultsCSV, writeResultsTSV, readResultsTSV, writeRows
+from .SparqlBinaryResults import writeResultsBinary, readResultsBinary, isBinaryResults
+from .QueryCache       import getQueryCache, prepareQueryText, parselock
+from .SparqlParallel   import orderedMap, AdaptiveLimiter
+from .GraphSnapshot    import snapshotSources, openSnapshot, writeSnapshot
+from .SqliteStore      import openSqliteGraph
+from .TermCodec        import encodeTerm, decodeTerm
+from .DiskCache        import getHttpCache, getResultCache, CACHESIZE, CACHETTL
 
 from .StdoutContext import SwitchStdout
 from .StdinContext  import SwitchStdin
 
 import rdflib
+from rdflib.plugins.sparql.parser import parseQuery
+from rdflib.plugins.sparql.parserutils import CompValue
+from pyparsing import ParseResults
 
 # Set up to use SPARQL
 # rdflib.plugin.register(
@@ -53,7 +70,7 @@ import rdflib
 # Type codes and mapping for RDF and query variable p[arsing and serializing
 
 RDFTYP = ["RDFXML","N3","TURTLE","NT","JSONLD","RDFA","HTML5"]
-VARTYP = ["JSON","CSV","XML"]
+VARTYP = ["JSON","CSV","TSV","XML","BINARY"]
 
 RDFTYPPARSERMAP = (
     { "RDFXML": "xml"
@@ -73,6 +90,39 @@ RDFTYPSERIALIZERMAP = (
     , "JSONLD": "jsonld"
     })
 
+# Default maximum size (characters) of VALUES clause data sent in a single endpoint request
+
+VALUESCHUNKSIZE = 8000
+
+# Endpoint result sizes that suggest a result has been truncated by a limit on
+# result size (multiples of this number)
+
+PAGESIZEROUND = 1000
+
+# Formats and media types of ASK and SELECT query results requested from endpoints
+
+ENDPOINTRESULTTYPES = (
+    [ ("JSON", "application/sparql-results+json")
+    , ("XML",  "application/sparql-results+xml")
+    ])
+
+# Number of result rows written between flushes of streamed output
+
+OUTPUTFLUSHROWS = 1000
+
+# Default directory for caches of data retrieved from the web
+
+CACHEDIR = "~/.asqc-cache"
+
+# Signatures of compressed input data, and the corresponding modules used to
+# open a decompressing stream.  The longest signature is first.
+
+COMPRESSIONMAGIC = (
+    [ (b"\xfd7zXZ\x00", lzma)
+    , (b"BZh",          bz2)
+    , (b"\x1f\x8b",     gzip)
+    ])
+
 # Logging object
 log = logging.getLogger(__name__)
 
@@ -82,51 +132,51 @@ class asqc_settings(object):
 
 # Helper function for templated SPARQL results formatting and parsing
 
+TEMPLATEREPR = (
+    { "bnode":          "_:%(value)s"
+    , "uri":            "<%(value)s>"
+    , "literal":        '"%(value)s"'
+    , "typed-literal":  '"%(value)s"^^<%(datatype)s>'
+    })
+
+# Matches a template key reference, or an escaped '%'
+TEMPLATEKEY = re.compile(r"%(?:%|\(([^)]*)\))")
+
+class BindingsTemplate(object):
+    """
+    Output template, compiled once for formatting any number of result bindings.
+
+    The template is a Python format string applied to a dictionary of query
+    result variables:  each variable "v" is available as "v" (its value) and
+    "v_repr" (its Turtle-like representation).  Only the keys referenced by the
+    template are computed for each result.
+    """
+    def __init__(self, template):
+        self._template = codecs.decode(template.encode("latin-1", "backslashreplace"), "unicode_escape")
+        self._keys     = []
+        for key in set(k for k in TEMPLATEKEY.findall(self._template) if k):
+            if key.endswith("_repr"):
+                self._keys.append((key, key[:-5], True))
+            else:
+                self._keys.append((key, key, False))
+        return
+
+    def format(self, bindings):
+        """
+        Return bindings formatted with the template
+        """
+        formatdict = {}
+        for (key, var, isrepr) in self._keys:
+            val = bindings.get(var)
+            if val is not None:
+                formatdict[key] = TEMPLATEREPR[val["type"]]%val if isrepr else val["value"]
+        return self._template%formatdict
+
 def formatBindings(template, bindings):
     """
     Return bindings formatted with supplied template
     """
-    formatdict = {}
-    for (var, val) in bindings.iteritems():
-        formatdict[var]         = val["value"]
-        if val["type"] == "bnode":
-            vf = "_:%(value)s"
-        elif val["type"] == "uri":
-            vf = "<%(value)s>"
-        elif val["type"] == "literal":
-            vf = '"%(value)s"'
-        elif val["type"] == "typed-literal":
-            vf = '"%(value)s"^^<%(datatype)s>'
-        formatdict[var+"_repr"] = vf%val
-    return template.decode(encoding='string_escape')%formatdict
-
-# Helper function for CSV formatting query result from JSON
-
-def char_escape(c):
-    if c == '"': return '""'
-    if ord(c) >= 128: return r"\u" + "%04x"%ord(c)
-    return c
-
-def termToCSV(result): 
-    if result == None: 
-        return None
-    resval = result['value']
-    restyp = result['type']
-    if restyp == "uri":
-        return "<" + resval + ">"
-    if restyp == "bnode":
-        return "_:" + resval
-    # strval  = '"' + resval.replace('"', '""') + '"'
-    strval  = '"' + "".join([char_escape(c) for c in resval]) + '"'
-    strlang = result.get('xml:lang', None)
-    if restyp == "literal":
-        if strlang:
-            return strval + '@' + strlang
-        else:
-            return strval
-    if restyp == "typed-literal":
-        return strval + '^^' + result['datatype']
-    raise rdflib.query.ResultException('Unknown term type: %s (%s)'%(term, type(term)))
+    return BindingsTemplate(template).format(bindings)
 
 # Helper functions for JSON formatting and parsing
 # Mostly copied from rdflib SPARQL code (rdfextras/sparql/results/jsonresults)
@@ -184,14 +234,16 @@ def parseJsonTerm(d):
     else:
         raise NotImplementedError("json term type %r" % t)
 
-def parseJsonBindings(bindings):
-    newbindings = []
+def iterJsonBindings(bindings):
     for row in bindings:
         outRow = {}
         for k, v in row.items():
             outRow[k] = parseJsonTerm(v)
-        newbindings.append(outRow)
-    return newbindings
+        yield outRow
+    return
+
+def parseJsonBindings(bindings):
+    return list(iterJsonBindings(bindings))
 
 # Helper functions to form join of mutiple binding sets
 
@@ -204,15 +256,158 @@ def joinBinding(result_binding, constraint_binding):
     joined_binding.update(constraint_binding)
     return joined_binding
 
+def iterJoinBindings(result_bindings, constraint_bindings):
+    """
+    Generate compatible joins of two lists of bindings.
+
+    This is a hash join:  the smaller list is indexed on the variables that
+    are bound in all of its rows and also used by the other list, and rows of
+    the larger list are matched through this index.  A row that does not bind
+    all of the index variables is matched by scanning every row of the smaller
+    list, as any of them might be compatible.
+
+    If result_bindings is an iterator rather than a list, the constraint
+    bindings are indexed and result rows are read one at a time.
+    """
+    streamed = not isinstance(result_bindings, list)
+    if streamed or len(constraint_bindings) <= len(result_bindings):
+        (build, probe, probeisresult) = (constraint_bindings, result_bindings, True)
+    else:
+        (build, probe, probeisresult) = (result_bindings, constraint_bindings, False)
+    if not build:
+        return
+    if streamed:
+        keyvars = [ k for k in build[0] if all(k in b for b in build) ]
+    else:
+        probevars = set()
+        for b in probe:
+            probevars.update(b)
+        keyvars = [ k for k in build[0] if k in probevars and all(k in b for b in build) ]
+    index   = {}
+    for b in build:
+        index.setdefault(tuple([ b[k] for k in keyvars ]), []).append(b)
+    for bp in probe:
+        if all(k in bp for k in keyvars):
+            candidates = index.get(tuple([ bp[k] for k in keyvars ]), [])
+        else:
+            candidates = build
+        for bb in candidates:
+            bj = joinBinding(bp, bb) if probeisresult else joinBinding(bb, bp)
+            if bj:
+                yield bj
+    return
+
 def joinBindings(result_bindings, constraint_bindings):
-    return [ bj 
-             for bj in [ joinBinding(b1, b2) for b1 in result_bindings for b2 in constraint_bindings ]
-             if bj ]
+    return list(iterJoinBindings(result_bindings, constraint_bindings))
 
 def joinBindingsToJSON(result_bindings, constraint_bindings):
-    return [ bindingToJSON(bj) 
-             for bj in [ joinBinding(b1, b2) for b1 in result_bindings for b2 in constraint_bindings ]
-             if bj ]
+    return [ bindingToJSON(bj) for bj in iterJoinBindings(result_bindings, constraint_bindings) ]
+
+# Helper functions to pass a set of incoming bindings to a query as a SPARQL VALUES clause
+
+def bindingsAreEmpty(bindings):
+    """
+    True if the supplied list of bindings is the single empty binding (i.e. no constraint)
+    """
+    return len(bindings) == 1 and not bindings[0]
+
+def bindingVars(bindings):
+    """
+    Return list of variables used in a list of bindings, in order of first appearance
+    """
+    bvars = []
+    for b in bindings:
+        for k in b:
+            if str(k) not in bvars:
+                bvars.append(str(k))
+    return bvars
+
+def bindingsHaveBNodes(bindings):
+    """
+    True if any of the supplied bindings has a blank node value
+    """
+    for b in bindings:
+        for v in b.values():
+            if isinstance(v, rdflib.BNode):
+                return True
+    return False
+
+def canUseValuesClause(query, bindings):
+    """
+    Test if supplied bindings can be passed to a query as a trailing VALUES clause,
+    with the same results as evaluating the query separately for each binding.
+
+    A trailing VALUES clause is joined with the query solutions after grouping
+    and aggregation, and before DISTINCT, LIMIT and OFFSET are applied, so a
+    query using any of these, or a subquery, must be evaluated for each binding
+    (see PERROWFEATURES).  The VALUES clause is also joined after FILTER, BIND,
+    OPTIONAL and MINUS patterns are evaluated, in which a binding variable would
+    be unbound, so a query that uses a binding variable in any of these must also
+    be evaluated for each binding (see SCOPEDPATTERNS).  Blank nodes cannot appear
+    in a VALUES clause, and a query that already has a trailing VALUES clause is
+    left alone.
+    """
+    if bindingsHaveBNodes(bindings):
+        return False
+    features = queryFeatures(query)
+    if features is None or (features & PERROWFEATURES):
+        return False
+    return not (set(bindingVars(bindings)) & queryScopedVars(query))
+
+def valuesRow(bvars, binding):
+    bstr = dict( (str(k), v) for (k, v) in binding.items() )
+    vals = [ bstr[v].n3() if v in bstr else "UNDEF" for v in bvars ]
+    return "  ( "+" ".join(vals)+" )\n"
+
+def valuesClauses(bindings, maxsize=None):
+    """
+    Generate SPARQL VALUES clause text for a list of bindings, using UNDEF for
+    variables that are not bound in a given row.
+
+    If maxsize is given, the bindings are split over as many VALUES clauses
+    as are needed to keep the data rows of each within that many characters.
+    """
+    bvars  = bindingVars(bindings)
+    header = "VALUES ( "+" ".join([ "?"+v for v in bvars ])+" )\n{\n"
+    rows   = []
+    size   = 0
+    for b in bindings:
+        row = valuesRow(bvars, b)
+        if maxsize and rows and size+len(row) > maxsize:
+            yield header+"".join(rows)+"}\n"
+            rows = []
+            size = 0
+        rows.append(row)
+        size += len(row)
+    if rows or not bindings:
+        yield header+"".join(rows)+"}\n"
+    return
+
+def valuesClause(bindings):
+    """
+    Return SPARQL VALUES clause text for a list of bindings
+    """
+    return next(valuesClauses(bindings))
+
+def addValuesClause(query, bindings):
+    """
+    Return query with supplied bindings appended as a VALUES clause
+    """
+    return query.rstrip()+"\n"+valuesClause(bindings)
+
+def injectValuesClause(query, bindings):
+    """
+    Return query with supplied bindings added as a VALUES clause at the start of
+    the outermost group pattern of its WHERE clause, so that they are joined
+    with the pattern solutions before any aggregation or solution modifiers are
+    applied, and are bound in the FILTER, BIND, OPTIONAL and MINUS patterns of
+    the group.  Returns None if the group pattern cannot be found.
+    """
+    span = queryGroupSpan(query)
+    if span is None:
+        return None
+    start = span[0]+1
+    return query[:start]+"\n"+valuesClause(bindings)+query[start:]
 
 # Helper functions for accessing data at URI reference, which may be a path relative to current directory
 
@@ -226,17 +421,62 @@ def resolveUri(uriref, base, path=""):
         upath = upath + '/'
     return urllib.parse.urljoin(urllib.parse.urljoin(base, upath), uriref)
 
-def retrieveUri(uriref):
-    uri = resolveUri(uriref, "file://", os.getcwd())
-    log.debug("retrievUri: %s"%(uri))
-    request  = urllib.request.Request(uri)
+def retrieveUri(uriref, httpcache=None):
     try:
-        response = io.TextIOWrapper(urllib.request.urlopen(request), encoding="utf-8")
-        result   = response.read()
+        response = io.TextIOWrapper(openUri(uriref, httpcache), encoding="utf-8")
+        with response:
+            result = response.read()
     except:
         result = None
     return result
 
+def decompressStream(stream):
+    """
+    Return a binary stream that reads decompressed data from the supplied stream,
+    if it starts with the signature of a gzip (.gz), bzip2 (.bz2) or xz (.xz)
+    compressed file, otherwise the supplied stream.  The stream is decompressed
+    as it is read.
+    """
+    if not hasattr(stream, "peek"):
+        stream = io.BufferedReader(stream)
+    head = stream.peek(len(COMPRESSIONMAGIC[0][0]))
+    for (magic, decompressor) in COMPRESSIONMAGIC:
+        if head.startswith(magic):
+            log.debug("decompressStream: %s"%(decompressor.__name__))
+            return decompressor.open(stream)
+    return stream
+
+def openUri(uriref, httpcache=None):
+    """
+    Open resource at URI reference for reading, returning a binary stream.
+    Local files are opened directly.  Compressed data is decompressed as it is
+    read, and gzip content-encoding is requested from HTTP servers.  Raises an
+    exception if the resource cannot be opened.
+
+    If an HTTP cache is supplied (see getResourceCache), HTTP resources are
+    retrieved using the cache.
+    """
+    uri = resolveUri(uriref, "file://", os.getcwd())
+    log.debug("openUri: %s"%(uri))
+    parts = urllib.parse.urlsplit(uri)
+    if parts.scheme == "file" and parts.netloc in ["", "localhost"]:
+        return decompressStream(open(urllib.request.url2pathname(parts.path), "rb"))
+    headers = {"Accept-Encoding": "gzip"}
+    if httpcache and parts.scheme in ["http", "https"]:
+        return decompressStream(httpcache.open(uri, headers))
+    request = urllib.request.Request(uri, headers=headers)
+    return decompressStream(urllib.request.urlopen(request))
+
+def openStdin():
+    """
+    Return a binary stream that reads stdin, decompressed if necessary.
+    """
+    stdin = getattr(sys.stdin, "buffer", None)
+    if stdin is None:
+        # stdin replaced by a text stream
+        return io.BytesIO(sys.stdin.read().encode("utf-8"))
+    return decompressStream(stdin)
+
 # Helper function for determining type of query
 
 def queryType(query):
@@ -252,14 +492,302 @@ def queryType(query):
         return match.group(3).upper()
     return None
 
+# Helper functions for analysing query structure
+
+# Query features for which incoming bindings are applied to each evaluation of
+# the query, rather than joined with its results (see canUseValuesClause)
+
+PERROWFEATURES = set(
+    [ "DISTINCT", "REDUCED", "GROUP BY", "HAVING", "AGGREGATE"
+    , "LIMIT", "OFFSET", "SUBQUERY", "VALUES"
+    ])
+
+# Graph patterns in which a variable supplied by incoming bindings must be bound
+# when the pattern is evaluated, rather than joined with its solutions afterwards
+# (see canUseValuesClause)
+
+SCOPEDPATTERNS = set(
+    [ "Filter", "Bind", "OptionalGraphPattern", "MinusGraphPattern", "ServiceGraphPattern"
+    ])
+
+def iterQueryNodes(node):
+    """
+    Generate the nodes of an rdflib query parse tree, not including the
+    contents of subqueries.
+    """
+    if isinstance(node, CompValue):
+        yield node
+        if node.name == "SubSelect":
+            return
+        children = node.values()
+    elif isinstance(node, (list, ParseResults)):
+        children = node
+    else:
+        return
+    for child in children:
+        for n in iterQueryNodes(child):
+            yield n
+    return
+
+def parseQueryForm(query):
+    """
+    Return the rdflib parse tree of a query's form (SELECT, CONSTRUCT, etc.),
+    or None if the query cannot be parsed.
+    """
+    try:
+        with parselock:
+            return parseQuery(query)[1]
+    except Exception as e:
+        log.debug("parseQueryForm: cannot parse query: %s"%(e))
+    return None
+
+def iterQueryVars(node):
+    """
+    Generate the variables used in an rdflib query parse tree.
+    """
+    if isinstance(node, rdflib.Variable):
+        yield node
+    elif isinstance(node, CompValue):
+        for child in node.values():
+            for v in iterQueryVars(child):
+                yield v
+    elif isinstance(node, (list, ParseResults)):
+        for child in node:
+            for v in iterQueryVars(child):
+                yield v
+    return
+
+def queryScopedVars(query):
+    """
+    Return set of names of variables used in the FILTER, BIND, OPTIONAL, MINUS
+    and SERVICE patterns of a query's WHERE clause (see SCOPEDPATTERNS), or
+    None if the query cannot be parsed.
+    """
+    form = parseQueryForm(query)
+    if form is None:
+        return None
+    scoped = set()
+    for node in iterQueryNodes(form["where"] if "where" in form else None):
+        if node.name in SCOPEDPATTERNS:
+            scoped.update( str(v) for v in iterQueryVars(node) )
+    return scoped
+
+def queryFeatures(query):
+    """
+    Return set of features used at the top level of a query, found using the
+    rdflib SPARQL parser:  "DISTINCT", "REDUCED", "GROUP BY", "HAVING",
+    "AGGREGATE", "ORDER BY", "LIMIT", "OFFSET", "SUBQUERY", "VALUES" (a
+    trailing VALUES clause) and "FROM" (dataset clauses).  Keywords in
+    literals, IRIs, comments and subqueries are not counted.
+
+    Returns None if the query cannot be parsed.
+    """
+    form = parseQueryForm(query)
+    if form is None:
+        return None
+    features = set()
+    if "modifier" in form:
+        features.add(str(form["modifier"]).upper())
+    for (key, feature) in (
+            [ ("groupby", "GROUP BY"), ("having", "HAVING"), ("orderby", "ORDER BY")
+            , ("valuesClause", "VALUES"), ("datasetClause", "FROM")
+            ]):
+        if key in form and form[key] is not None:
+            features.add(feature)
+    if "limitoffset" in form:
+        for key in ["limit", "offset"]:
+            if key in form["limitoffset"]:
+                features.add(key.upper())
+    for node in iterQueryNodes(form):
+        if node.name.startswith("Aggregate_"):
+            features.add("AGGREGATE")
+        elif node.name == "SubSelect":
+            features.add("SUBQUERY")
+    return features
+
+# Tokens of query text that affect the nesting of group patterns, and keywords
+# that start the dataset clauses and WHERE clause.  Strings, IRIs and comments
+# are matched so that any brackets or keywords in them are skipped.
+
+QUERYTOKENS = re.compile(
+    r'"""(?:[^"\\]|\\.|"(?!""))*"""'
+    r"|'''(?:[^'\\]|\\.|'(?!''))*'''"
+    r'|"(?:[^"\\\n]|\\.)*"'
+    r"|'(?:[^'\\\n]|\\.)*'"
+    r'|<[^<>"{}|^`\\\x00-\x20]*>'
+    r'|#[^\n]*'
+    r'|(?<![\w:?$])(?:where|from)(?![\w:])'
+    r'|[{}()]',
+    flags=re.IGNORECASE|re.DOTALL)
+
+def scanQuery(query):
+    """
+    Return positions in the query text of the first dataset clause ("from"),
+    the WHERE keyword ("where"), and the opening and closing braces of the
+    outermost group pattern of the WHERE clause ("group", a pair), skipping a
+    CONSTRUCT template.  Any that are not found are None.  "group" is also None
+    for the short form CONSTRUCT WHERE query, whose pattern can only contain
+    triples.
+    """
+    (prologue, body) = splitQueryPrologue(query)
+    construct  = re.match(r"construct\b", body, flags=re.IGNORECASE)
+    afterwhere = not construct
+    template   = False
+    clauses = { "from": None, "where": None, "group": None }
+    depth   = 0
+    parens  = 0
+    start   = None
+    for m in QUERYTOKENS.finditer(query, len(prologue)):
+        token = m.group(0)
+        if token == "{":
+            if depth == 0 and parens == 0 and start is None:
+                if afterwhere:
+                    if construct and not template:
+                        break
+                    start = m.start()
+                else:
+                    template = True
+            depth += 1
+        elif token == "}":
+            depth -= 1
+            if depth == 0 and start is not None:
+                clauses["group"] = (start, m.start())
+                break
+        elif token == "(":
+            parens += 1
+        elif token == ")":
+            parens -= 1
+        elif depth == 0 and parens == 0 and start is None:
+            if token.lower() == "where":
+                afterwhere = True
+                clauses["where"] = m.start()
+            elif token.lower() == "from" and clauses["from"] is None:
+                clauses["from"] = m.start()
+    return clauses
+
+def queryGroupSpan(query):
+    """
+    Return positions of the opening and closing braces of the outermost group
+    pattern of the query's WHERE clause, or None (see scanQuery).
+    """
+    return scanQuery(query)["group"]
+
+# Helper functions for requesting query results in pages
+
+def splitQueryPrologue(query):
+    """
+    Split query into prologue (BASE and PREFIX declarations) and query body
+    """
+    prologueregex = r"^((?:\s+|#[^\n]*\n|base\s*<[^>]*>|prefix\s+[^:\s]*:\s*<[^>]*>)*)(.*)$"
+    match = re.match(prologueregex, query, flags=re.IGNORECASE|re.DOTALL)
+    return (match.group(1), match.group(2))
+
+def selectOrderVars(body):
+    """
+    Return variables used to give a stable ordering of SELECT query results:
+    the projected variables, or all variables in the query for SELECT *.
+    """
+    match  = re.match(r"\s*select\s+(.*?)(\bwhere\b|\bfrom\b|\{)", body, flags=re.IGNORECASE|re.DOTALL)
+    clause = match.group(1) if match else "*"
+    qvars  = []
+    for v in re.findall(r"[?$](\w+)", body if "*" in clause else clause):
+        if v not in qvars:
+            qvars.append(v)
+    return qvars
+
+def pageQuery(query, limit, offset):
+    """
+    Return SELECT query modified to request a single page of results, in a
+    stable order.  A query without ORDER BY is wrapped as a subquery and
+    ordered by its variables;  any dataset clauses (FROM and FROM NAMED) are
+    moved to the wrapping query, as they cannot appear in a subquery.
+
+    Returns None if the query already uses LIMIT or OFFSET, or cannot be parsed.
+    """
+    features = queryFeatures(query)
+    if features is None or "LIMIT" in features or "OFFSET" in features:
+        return None
+    page = "LIMIT %i OFFSET %i\n"%(limit, offset)
+    if "ORDER BY" in features and "VALUES" not in features:
+        return query.rstrip()+"\n"+page
+    clauses = scanQuery(query)
+    if clauses["group"] is None:
+        return None
+    (prologue, body) = splitQueryPrologue(query)
+    dataset = ""
+    if clauses["from"] is not None:
+        end     = clauses["group"][0] if clauses["where"] is None else clauses["where"]
+        dataset = query[clauses["from"]:end].strip()+"\n"
+        body    = query[len(prologue):clauses["from"]]+query[end:]
+    orderby = " ".join([ "?"+v for v in selectOrderVars(body) ])
+    if orderby:
+        page = "ORDER BY "+orderby+"\n"+page
+    return prologue+"SELECT * "+dataset+"WHERE {\n{\n"+body.strip()+"\n}\n}\n"+page
+
+def getPageSize(options):
+    """
+    Return page size for endpoint SELECT queries:  None, a number, or "auto"
+    """
+    pagesize = getattr(options, "page_size", None)
+    if not pagesize:
+        return None
+    if str(pagesize).lower() == "auto":
+        return "auto"
+    return int(pagesize)
+
+def detectPageSize(options, query, suffix, result, resulttype):
+    """
+    Guess whether an endpoint has truncated a SELECT query result:  public
+    endpoints commonly cap result sizes at a round number such as 10000 rows.
+    A result with a multiple of PAGESIZEROUND rows is taken to be truncated
+    only if a probe query for the row following it returns a result.
+
+    Returns the number of results if so, otherwise None.
+    """
+    n = len(result['results']['bindings'])
+    if n == 0 or n % PAGESIZEROUND != 0:
+        return None
+    probe = pageQuery(query, 1, n)
+    if not probe:
+        return None
+    probe = readEndpointResults(next(iterEndpointQueries(options, [probe+suffix], resulttype)))
+    if not list(probe['results']['bindings']):
+        log.debug("detectPageSize: %i results are complete"%(n))
+        return None
+    return n
+
 # Main program functions
 
+def getResourceCache(options):
+    """
+    Return cache for HTTP resources selected by --http-cache or --offline, or None.
+    """
+    offline = getattr(options, "offline", False)
+    if not (getattr(options, "http_cache", False) or offline):
+        return None
+    cachedir  = os.path.join(getattr(options, "cache_dir", None) or CACHEDIR, "http")
+    cachesize = getattr(options, "cache_size", None) or CACHESIZE
+    return getHttpCache(cachedir, cachesize*1024*1024, offline)
+
+def getEndpointCache(options):
+    """
+    Return cache for SPARQL endpoint query results selected by --cache, or None.
+    """
+    if not getattr(options, "result_cache", False):
+        return None
+    cachedir  = os.path.join(getattr(options, "cache_dir", None) or CACHEDIR, "results")
+    cachesize = getattr(options, "cache_size", None) or CACHESIZE
+    ttl       = getattr(options, "cache_ttl", None)
+    if ttl is None:
+        ttl = CACHETTL
+    return getResultCache(cachedir, cachesize*1024*1024, ttl)
+
 def getQuery(options, args):
     """
     Get query string from command line option or argument.
     """
     if options.query:
-        return retrieveUri(options.query)
+        return retrieveUri(options.query, getResourceCache(options))
     elif len(args) >= 2:
         return args[1]
     return None
@@ -283,82 +811,301 @@ def getPrefixes(options):
     if prefixUri.startswith("~"):
         prefixUri = configbase+prefixUri[1:]
     log.debug("Prefix URI %s"%(prefixUri))
-    prefixes   = retrieveUri(prefixUri)
+    prefixes   = retrieveUri(prefixUri, getResourceCache(options))
     return prefixes or defaultPrefixes
 
 def getBindings(options):
-    bndtext  = None
+    """
+    Read incoming query variable bindings selected by --bindings, in the format
+    selected by --format-var-in.  Binary bindings (see SparqlBinaryResults) are
+    recognized whatever format is selected.
+
+    Returns a JSON-like structure with rdflib terms as values of the bindings,
+    or None if the bindings cannot be read.
+    """
+    stream   = None
     bindings = (
         { "head":    { "vars": [] }
         , "results": { "bindings": [{}] }
         })
     if options.bindings and options.bindings != "-":
-        bndtext = retrieveUri(options.bindings)
+        try:
+            stream = openUri(options.bindings, getResourceCache(options))
+        except:
+            stream = None
     elif options.bindings == "-":
-        if options.rdf_data or options.endpoint:
-            bndtext = sys.stdin.read()
+        if ( options.rdf_data or options.endpoint or
+             getattr(options, "socket", None) or getattr(options, "store", None) ):
+            stream = openStdin()
         else:
             # Can't read bindings from stdin if trying to read RDF from stdin
             return None
-    else:
-        bndtext = None
-    if bndtext:
+    if stream:
+        if not hasattr(stream, "peek"):
+            stream = io.BufferedReader(stream)
         try:
-            bindings = json.loads(bndtext)
-            bindings['results']['bindings'] = parseJsonBindings(bindings['results']['bindings'])
+            if isBinaryResults(stream):
+                bindings = readResultsBinary(stream, parseJsonTerm)
+                bindings['results']['bindings'] = list(bindings['results']['bindings'])
+            else:
+                bindings = readBindingsText(options, io.TextIOWrapper(stream, encoding="utf-8").read())
         except Exception as e:
             bindings = None
+        finally:
+            if options.bindings != "-":
+                stream.close()
     return bindings
 
+def readBindingsText(options, bndtext):
+    """
+    Parse text bindings in the format selected by --format-var-in
+    """
+    bindings = (
+        { "head":    { "vars": [] }
+        , "results": { "bindings": [{}] }
+        })
+    if bndtext:
+        if getattr(options, "format_var_in", None) == "TSV":
+            bindings = readResultsTSV(io.StringIO(bndtext))
+        elif getattr(options, "format_var_in", None) == "XML":
+            bindings = readResultsXML(io.BytesIO(bndtext.encode("utf-8")))
+        else:
+            bindings = json.loads(bndtext)
+        bindings['results']['bindings'] = parseJsonBindings(bindings['results']['bindings'])
+    return bindings
+
+def parseRdfData(rdfgraph, r, rdfformat, httpcache=None):
+    """
+    Reads RDF data from a file or URI, or stdin if r is "-", into the supplied graph.
+    Returns True if the data was read, otherwise False.
+
+    The data is passed to the parser as a binary stream, rather than being read
+    into memory first.
+    """
+    rdfformatdefault = RDFTYPPARSERMAP[RDFTYP[0]]
+    rdfformatselect  = RDFTYPPARSERMAP.get(rdfformat, rdfformatdefault)
+    rdfstream = None
+    if hasattr(rdfgraph.store, "loadGraph"):
+        # e.g. SqliteStore, which cannot be used directly by all parsers
+        rdfgraph = rdfgraph.store.loadGraph()
+    try:
+        if r == "-":
+            base      = ""
+            rdfstream = openStdin()
+        else:
+            log.debug("Reading RDF from %s"%(r))
+            base      = r
+            rdfstream = openUri(r, httpcache)
+        log.debug("Parsing RDF format %s"%(rdfformatselect))
+        if rdfformatselect == "rdfa+html":
+            rdfgraph.parse(source=rdfstream, format="rdfa", media_type="text/html", publicID=base)
+        else:
+            rdfgraph.parse(source=rdfstream, format=rdfformatselect, publicID=base)
+    except Exception as e:
+        log.debug("RDF Parse failed: %s"%(repr(e)))
+        log.debug("traceback:        %s"%(traceback.format_exc()))
+        return False
+    finally:
+        if rdfstream is not None and r != "-":
+            rdfstream.close()
+    return True
+
+class SourceStore(rdflib.plugin.get("default", rdflib.store.Store)):
+    """
+    Store that records triples in the order in which they are added by a parser,
+    with blank nodes renamed in order of first appearance, using the supplied index.
+    """
+    def __init__(self, index):
+        super(SourceStore, self).__init__()
+        self.index   = index
+        self.bnodes  = {}
+        self.encoded = []
+        return
+
+    def encode(self, t):
+        if isinstance(t, rdflib.BNode):
+            return self.bnodes.setdefault(t, "_r%ib%i"%(self.index, len(self.bnodes)))
+        return encodeTerm(t)
+
+    def add(self, triple, context, quoted=False):
+        if not quoted:
+            self.encoded.append(tuple(self.encode(t) for t in triple))
+        return super(SourceStore, self).add(triple, context, quoted)
+
+def parseRdfSource(source):
+    """
+    Reads RDF data from a file or URI in a worker process.
+
+    source is a tuple (index, uri, format, HTTP cache), where index is the position
+    of the resource in the list being loaded.  Returns a tuple of the namespace bindings
+    and the list of triples of encoded terms (see TermCodec), or None if the data
+    cannot be read.  Blank nodes are renamed using the index, so that those from
+    different resources are distinct, and the same on every run.
+    """
+    (index, r, rdfformat, httpcache) = source
+    store    = SourceStore(index)
+    rdfgraph = rdflib.Graph(store=store)
+    if not parseRdfData(rdfgraph, r, rdfformat, httpcache):
+        return None
+    return ([ (p, str(u)) for (p, u) in rdfgraph.namespaces() ], store.encoded)
+
+def loadRdfData(rdfgraph, rdfsources, options, loaded=None):
+    """
+    Reads RDF data from the listed files or URIs into the supplied graph.
+    Returns True if all the data was read, otherwise False.
+
+    If --load-workers is more than 1, resources other than stdin are fetched
+    and parsed concurrently in worker processes, and their triples are added
+    to the graph in bulk, in the order listed.
+
+    If supplied, loaded is called with the index of each resource as it is
+    added to the graph.
+    """
+    workers   = getattr(options, "load_workers", None) or 1
+    rdfformat = options.format_rdf_in
+    httpcache = getResourceCache(options)
+    if workers <= 1 or len([ r for r in rdfsources if r != "-" ]) <= 1:
+        for (i, r) in enumerate(rdfsources):
+            if not parseRdfData(rdfgraph, r, rdfformat, httpcache):
+                return False
+            if loaded:
+                loaded(i)
+        return True
+    remote  = [ (i, r, rdfformat, httpcache) for (i, r) in enumerate(rdfsources) if r != "-" ]
+    results = orderedMap(parseRdfSource, remote, workers, processes=True)
+    for (i, r) in enumerate(rdfsources):
+        if r == "-":
+            if not parseRdfData(rdfgraph, r, rdfformat, httpcache):
+                return False
+        else:
+            (source, result, elapsed) = next(results)
+            log.debug("loadRdfData: parsed %s in %.3fs"%(r, elapsed))
+            if result is None:
+                results.close()
+                return False
+            (namespaces, triples) = result
+            for (prefix, uri) in namespaces:
+                rdfgraph.bind(prefix, uri, override=False)
+            rdfgraph.addN( (decodeTerm(s), decodeTerm(p), decodeTerm(o), rdfgraph)
+                           for (s, p, o) in triples )
+        if loaded:
+            loaded(i)
+    results.close()
+    return True
+
+def getRdfStore(options):
+    """
+    Opens the SQLite triple store specified by --store, and loads into it any RDF
+    data specified using -r that it does not already contain.
+
+    Local files are loaded only if they have not been loaded before, or have changed
+    since they were loaded, in which case the store is cleared and all the data
+    specified is reloaded.  Other RDF data is loaded every time.  If no RDF data is
+    specified, the existing contents of the store are queried.
+    """
+    rdfgraph = openSqliteGraph(options.store)
+    store    = rdfgraph.store
+    loaded   = store.loadedSources()
+    sources  = []
+    for r in options.rdf_data or []:
+        if r != "-" and os.path.isfile(r):
+            st = os.stat(r)
+            sources.append((r, (os.path.abspath(r), st.st_size, st.st_mtime, options.format_rdf_in)))
+        else:
+            sources.append((r, None))
+    if any( s and s[0] in loaded and loaded[s[0]] != s[1:] for (r, s) in sources ):
+        log.debug("getRdfStore: RDF data changed; reloading %s"%(options.store))
+        store.clear()
+        loaded = {}
+    sources = [ (r, s) for (r, s) in sources if not (s and loaded.get(s[0]) == s[1:]) ]
+    def sourceLoaded(i):
+        if sources[i][1]:
+            store.addLoadedSource(*sources[i][1])
+        return
+    if not loadRdfData(rdfgraph, [ r for (r, s) in sources ], options, loaded=sourceLoaded):
+        store.rollback()
+        store.close(commit_pending_transaction=False)
+        return None
+    store.commit()
+    return rdfgraph
+
 def getRdfData(options):
     """
     Reads RDF data from files specified using -r or from stdin
+
+    If a snapshot file is specified with --snapshot, and it is current for the
+    RDF data files, the data is accessed from the snapshot without being parsed.
+    Otherwise, the snapshot is written after the data has been read.
+
+    If a triple store is specified with --store, the data is accessed from the
+    store (see getRdfStore).
     """
+    if getattr(options, "store", None):
+        return getRdfStore(options)
     if not options.rdf_data:
         options.rdf_data = ['-']
-    rdfgraph = rdflib.Graph()
-    for r in options.rdf_data:
-        base = ""
-        if r == "-":
-            rdftext = sys.stdin.read()
+    snapshot = getattr(options, "snapshot", None)
+    sources  = None
+    if snapshot:
+        sources = snapshotSources(options.rdf_data, options.format_rdf_in)
+        if sources is None:
+            log.debug("getRdfData: RDF data is not from local files; --snapshot not used")
         else:
-            log.debug("Reading RDF from %s"%(r))
-            rdftext = retrieveUri(r)
-            base    = r
-        rdfformatdefault = RDFTYPPARSERMAP[RDFTYP[0]]
-        rdfformatselect  = RDFTYPPARSERMAP.get(options.format_rdf_in, rdfformatdefault)
-        try:
-            log.debug("Parsing RDF format %s"%(rdfformatselect))
-            if rdfformatselect == "rdfa+html":
-                rdfgraph.parse(data=rdftext, format="rdfa", media_type="text/html", publicID=base)
-            else:
-                rdfgraph.parse(data=rdftext, format=rdfformatselect, publicID=base)
-        except Exception as e:
-            log.debug("RDF Parse failed: %s"%(repr(e)))
-            log.debug("traceback:        %s"%(traceback.format_exc()))
-            return None
+            rdfgraph = openSnapshot(snapshot, sources)
+            if rdfgraph is not None:
+                log.debug("getRdfData: using snapshot %s"%(snapshot))
+                return rdfgraph
+    rdfgraph = rdflib.Graph()
+    if not loadRdfData(rdfgraph, options.rdf_data, options):
+        return None
+    if sources is not None:
+        log.debug("getRdfData: writing snapshot %s"%(snapshot))
+        writeSnapshot(rdfgraph, snapshot, sources)
     return rdfgraph
 
-def queryRdfData(progname, options, prefixes, query, bindings):
+def queryRdfData(progname, options, prefixes, query, bindings, stream=False, rdfgraph=None):
     """
     Submit query against RDF data.
     Result is tuple of status and dictionary/list structure suitable for JSON encoding,
     or an rdflib.graph value.
+
+    The RDF data is read as specified by the options, unless an already loaded
+    graph is supplied.
+
+    If stream is True, the result bindings of a SELECT query are an iterator
+    that generates rows as they are used, and the returned status is None:
+    it is determined by whether any rows are written by outputResult.
     """
-    rdfgraph = getRdfData(options)
+    if rdfgraph is None:
+        rdfgraph = getRdfData(options)
     if not rdfgraph:
         print( "%s: Could not read RDF data, or syntax error in input"%progname )
         print( "     Use -r <file> or supply RDF on stdin; specify input format if not RDF/XML" )
         return (2, None)
     query = prefixes + query
     log.debug("queryRdfData query:\n%s\n"%(query))
+    rows  = bindings['results']['bindings']
+    qc    = getQueryCache(getattr(options, "query_cache", None))
+    initns = dict(rdfgraph.namespaces())
     try:
-        resps = [rdfgraph.query(query, initBindings=b) for b in bindings['results']['bindings']]
+        if bindingsAreEmpty(rows):
+            resps = [rdfgraph.query(qc.getQuery(query, initns))]
+        elif canUseValuesClause(query, rows):
+            # Evaluate query once, joined with all incoming bindings.  The query
+            # text includes the bindings, so is unlikely to be used again and is
+            # not cached.
+            prepared = prepareQueryText(addValuesClause(query, rows), initns)
+            resps = [rdfgraph.query(prepared)]
+        else:
+            prepared = qc.getQuery(query, initns)
+            resps = [rdfgraph.query(prepared, initBindings=b) for b in rows]
     except AssertionError as e:
         print( "Query failed (query syntax problem?)" )
         print( "Submitted query:" )
         print( query )
         return (2, None)
+    if options.verbose:
+        print( "== Query cache: %d hits, %d misses"%(qc.hits, qc.misses) )
     res = { "head": {} }
     if resps[0].type == 'ASK':
         res["boolean"] = any([ r.askAnswer for r in resps ])
@@ -366,7 +1113,10 @@ def queryRdfData(progname, options, prefixes, query, bindings):
     elif resps[0].type == 'SELECT':
         res["head"]["vars"] = resps[0].vars
         res["results"] = {}
-        res["results"]["bindings"] = [ bindingToJSON(b) for r in resps for b in r.bindings ]
+        res["results"]["bindings"] = ( bindingToJSON(b) for r in resps for b in r.bindings )
+        if stream:
+            return (None, res)
+        res["results"]["bindings"] = list(res["results"]["bindings"])
         return (0 if len(res["results"]["bindings"]) > 0 else 1, res)
     elif resps[0].type == 'CONSTRUCT':
         res = rdflib.graph.ReadOnlyGraphAggregate( [r.graph for r in resps] )
@@ -375,12 +1125,211 @@ def queryRdfData(progname, options, prefixes, query, bindings):
         assert False, "Unexpected query response type %s"%resp.type
     return (2, None)
 
-def querySparqlEndpoint(progname, options, prefixes, query, bindings):
+def endpointRequest(options, query, resulttype, limiter=None):
+    """
+    Issue a query to the SPARQL endpoint, and return the status and a file-like
+    object from which the response data is read as it arrives.
+
+    The request is retried, up to the number of times given by --retries, if
+    the endpoint responds that it is overloaded.  A limiter shared by requests
+    issued concurrently may be supplied to limit their number adaptively.
+
+    If a result cache is selected (see getEndpointCache), a current cached response
+    is returned without contacting the endpoint;  otherwise a successful response
+    is added to the cache as it is read.
+    """
+    cache = getEndpointCache(options)
+    if cache:
+        cached = cache.open(options.endpoint, query, resulttype)
+        if cached:
+            log.debug("endpointRequest: cached response")
+            return ((cached.status, cached.reason), cached)
+    retries = getattr(options, "retries", None)
+    sc = SparqlHttpClient(endpointuri=options.endpoint,
+        retries=RETRIES if retries is None else retries, limiter=limiter)
+    ((status, reason), response) = sc.doQueryPOST(query, accept=resulttype, JSON=False, stream=True)
+    if cache and status == 200:
+        response = cache.tee(options.endpoint, query, resulttype, response)
+    return ((status, reason), response)
+
+def doEndpointQuery(options, query, resulttype, limiter=None, buffered=False):
+    """
+    Issue a single query to the SPARQL endpoint, and return a file-like object
+    from which the response data is read as it arrives.
+    (This may be called concurrently from several threads.)
+
+    If buffered is True, or in verbose mode (so that it can be displayed), the
+    response is read completely before it is returned.
+    """
+    ((status, reason), result) = endpointRequest(options, query, resulttype, limiter)
+    if status != 200:
+        result.close()
+        assert False, "Error from SPARQL query request: %i %s"%(status, reason)
+    if options.verbose or buffered:
+        with result:
+            result = io.BytesIO(result.read())
+    return result
+
+def reportEndpointQuery(options, reqnum, query, resulttype, result, elapsed):
+    if options.verbose:
+        print( "== Query to endpoint ==" )
+        print( query )
+        print( "== resulttype: "+resulttype )
+        print( "== Query response (request %i, %.3fs) =="%(reqnum, elapsed) )
+        print( result.getvalue().decode("utf-8", "replace") )
+    return
+
+def iterEndpointQueries(options, queries, resulttype):
+    """
+    Issue a number of queries to the SPARQL endpoint, running up to --parallel
+    requests concurrently, and generate response streams in query order.
+
+    The number of requests in progress is reduced while the endpoint responds
+    that it is overloaded, and increased again as requests succeed.
+
+    When requests run concurrently, each response is read in full by the
+    worker that issued it, so that responses are downloaded in parallel.
+    Responses that are not used, because the caller stops early, are closed.
+    """
+    parallel = getattr(options, "parallel", None) or 1
+    limiter  = AdaptiveLimiter(parallel) if parallel > 1 else None
+    def endpointQuery(query):
+        return doEndpointQuery(options, query, resulttype, limiter, buffered=parallel > 1)
+    def closeResponse(result):
+        result.close()
+        return
+    reqnum = 0
+    for (query, result, elapsed) in orderedMap(endpointQuery, queries, parallel, discard=closeResponse):
+        reqnum += 1
+        reportEndpointQuery(options, reqnum, query, resulttype, result, elapsed)
+        yield result
+    return
+
+def endpointResultType(options):
+    """
+    Return media types requested for endpoint ASK and SELECT query results:
+    the format selected by --endpoint-format, or XML if XML output is selected,
+    or else JSON, with the other format as an alternative.
+    """
+    resultformat = getattr(options, "endpoint_format", None)
+    if not resultformat:
+        resultformat = "XML" if getattr(options, "format_var_out", None) == "XML" else "JSON"
+    othertypes = [ t for (f, t) in ENDPOINTRESULTTYPES if f != resultformat ]
+    return ", ".join([ t for (f, t) in ENDPOINTRESULTTYPES if f == resultformat ] +
+                     [ t+";q=0.9" for t in othertypes ])
+
+def isXmlResponse(stream):
+    """
+    Test if endpoint response is in XML format, according to its content type,
+    or its first character if it has no content type (e.g. in verbose mode).
+    """
+    getheader = getattr(stream, "getheader", None)
+    if getheader:
+        return "xml" in (getheader("Content-Type") or "").lower()
+    if hasattr(stream, "getvalue"):
+        return stream.getvalue().lstrip()[:1] == b"<"
+    return False
+
+def readEndpointResults(stream):
+    """
+    Read JSON or XML results from an endpoint response stream, according to its
+    content type, into a JSON-like structure.  The result bindings are an
+    iterator that reads from the stream as rows are used, and result["count"]
+    is a list whose single value counts the rows read.
+    """
+    if isXmlResponse(stream):
+        result = readResultsXML(stream)
+    else:
+        result = readResultsJSON(stream)
+    count  = [0]
+    def countBindings(bindings):
+        try:
+            for b in bindings:
+                count[0] += 1
+                yield b
+        finally:
+            stream.close()
+        return
+    if "results" in result:
+        result["results"]["bindings"] = countBindings(result["results"]["bindings"])
+    else:
+        stream.close()
+    result["count"] = count
+    return result
+
+def iterEndpointPages(options, query, suffix, resulttype, pagesize):
+    """
+    Generate JSON results for successive pages of a SELECT query, up to and
+    including the first page with fewer than pagesize results.  Pages are
+    requested concurrently, up to the --parallel limit.
+
+    Each page's bindings must be used before the next page is generated.
+    """
+    def pageQueries():
+        offset = 0
+        while True:
+            yield pageQuery(query, pagesize, offset)+suffix
+            offset += pagesize
+    for result in iterEndpointQueries(options, pageQueries(), resulttype):
+        result = readEndpointResults(result)
+        yield result
+        if result["count"][0] < pagesize:
+            break
+    return
+
+def iterSelectResults(options, queries, resulttype):
+    """
+    Generate JSON results of SELECT queries to the SPARQL endpoint, for each
+    of the supplied (query, suffix) pairs, where the suffix is a VALUES clause
+    appended to the query, using paged requests if a page size is specified
+    or detected.
+    """
+    pagesize = getPageSize(options)
+    if pagesize and not pageQuery(queries[0][0], 1, 0):
+        log.debug("iterSelectResults: query already uses LIMIT or OFFSET; not paged")
+        pagesize = None
+    if pagesize == "auto":
+        # The first result is read in full to see if it has been truncated
+        result = readEndpointResults(next(iterEndpointQueries(options, [ "".join(queries[0]) ], resulttype)))
+        result["results"]["bindings"] = list(result["results"]["bindings"])
+        pagesize = detectPageSize(options, queries[0][0], queries[0][1], result, resulttype)
+        if not pagesize:
+            yield result
+            for r in iterEndpointQueries(options, [ q+s for (q, s) in queries[1:] ], resulttype):
+                yield readEndpointResults(r)
+            return
+        if options.verbose:
+            print( "== Endpoint result size limit %i detected; requesting pages =="%(pagesize) )
+    if not pagesize:
+        for r in iterEndpointQueries(options, [ q+s for (q, s) in queries ], resulttype):
+            yield readEndpointResults(r)
+        return
+    for (q, s) in queries:
+        for r in iterEndpointPages(options, q, s, resulttype, pagesize):
+            yield r
+    return
+
+def querySparqlEndpoint(progname, options, prefixes, query, bindings, stream=False):
     """
     Issue SPARQL query to SPARQL HTTP endpoint.
     Requests either JSON or RDF/XML depending on query type.
     Returns JSON-like dictionary/list structure or RDF graph, depending on query type.
     These are used as basis for result formatting by outputResult function
+
+    If stream is True, the result bindings of a SELECT query are an iterator
+    that reads rows from the endpoint as they are used, and the returned status
+    is None:  it is determined by whether any rows are written by outputResult.
+
+    Incoming bindings are sent to the endpoint as VALUES clauses, split into
+    chunks of limited size with a separate request for each, so that only
+    matching results are returned.  The bindings for a query with ORDER BY are
+    not split, as results of separate requests are not ordered together
+    (queries with DISTINCT or aggregates do not use VALUES clauses).  A query
+    that must be evaluated separately for each binding (see canUseValuesClause)
+    is sent once for each, with the binding as a VALUES clause at the start of
+    its WHERE clause.  If the bindings contain blank nodes, which cannot be sent
+    to the endpoint, the unconstrained SELECT query result is joined locally
+    with the bindings.
     """
     query = prefixes + query
     resulttype = "application/RDF+XML"
@@ -389,33 +1338,58 @@ def querySparqlEndpoint(progname, options, prefixes, query, bindings):
     if querytype in ["ASK", "SELECT"]:
         # NOTE application/json doesn't work with Fuseki
         # See: http://gearon.blogspot.co.uk/2011/09/sparql-json-after-commenting-other-day.html
-        resulttype = "application/sparql-results+json"
+        resulttype = endpointResultType(options)
         resultjson = True
-    if options.verbose:
-        print( "== Query to endpoint ==" )
-        print( query )
-        print( "== resulttype: "+resulttype )
-        print( "== resultjson: "+str(resultjson) )
-    sc = SparqlHttpClient(endpointuri=options.endpoint)
-    ((status, reason), result) = sc.doQueryPOST(query, accept=resulttype, JSON=False)
-    if status != 200:
-        assert False, "Error from SPARQL query request: %i %s"%(status, reason)
-    if options.verbose:
-        print( "== Query response ==" )
-        print( result )
-    if resultjson:
-        result = json.loads(result)
+    rows      = bindings['results']['bindings'] if bindings else [{}]
+    joinlocal = False
+    queries   = [(query, "")]
+    if bindingsAreEmpty(rows):
+        pass
+    elif canUseValuesClause(query, rows):
+        chunksize = getattr(options, "values_chunk_size", None) or VALUESCHUNKSIZE
+        if "ORDER BY" in queryFeatures(query):
+            chunksize = None
+        queries   = [ (query.rstrip()+"\n", s) for s in valuesClauses(rows, chunksize) ]
+    elif not bindingsHaveBNodes(rows) and injectValuesClause(query, rows[:1]):
+        queries   = [ (injectValuesClause(query, [b]), "") for b in rows ]
+    elif querytype == "SELECT" and canUseValuesClause(query, []):
+        # Bindings with blank nodes, for a query whose results can be joined with them
+        joinlocal = True
+    else:
+        assert False, "Can't use supplied bindings with blank nodes with this endpoint query"
     status = 1
     if querytype == "SELECT":
-        result['results']['bindings'] = parseJsonBindings(result['results']['bindings'])
-        result['results']['bindings'] = joinBindingsToJSON(
-                                            result['results']['bindings'], 
-                                            bindings['results']['bindings'])
+        result  = { "head": { "vars": [] }, "results": { "bindings": [] } }
+        results = iterSelectResults(options, queries, resulttype)
+        def addVars(r):
+            for v in r.get('head', {}).get('vars', []):
+                if v not in result['head']['vars']:
+                    result['head']['vars'].append(v)
+            return
+        def iterBindings(first):
+            # Variables from later results are added to the header as they are seen
+            for r in itertools.chain([first], results):
+                addVars(r)
+                if joinlocal:
+                    for b in iterJoinBindings(iterJsonBindings(r['results']['bindings']), rows):
+                        yield bindingToJSON(b)
+                else:
+                    for b in r['results']['bindings']:
+                        yield b
+            return
+        first = next(results)
+        addVars(first)
+        result['results']['bindings'] = iterBindings(first)
+        if stream:
+            return (None, result)
+        result['results']['bindings'] = list(result['results']['bindings'])
         if result['results']['bindings']: status = 0
-    elif bindings:
-        assert False, "Can't use supplied bindings with endpoint query other than SELECT"
     elif querytype == "ASK":
         # Just return JSON from Sparql query
+        result = { "head": {}, "boolean": False }
+        results = iterEndpointQueries(options, [ q+s for (q, s) in queries ], resulttype)
+        for r in map(readEndpointResults, results):
+            result['boolean'] = result['boolean'] or r['boolean']
         if result['boolean']: status = 0
     else:
         # return RDF
@@ -423,45 +1397,182 @@ def querySparqlEndpoint(progname, options, prefixes, query, bindings):
         try:
             # Note: declaring xml prefix in SPAQL query can result in invalid XML from Fuseki (v2.1)
             # See: https://issues.apache.org/jira/browse/JENA-24
-            rdfgraph.parse(data=result)
+            for r in iterEndpointQueries(options, [ q+s for (q, s) in queries ], resulttype):
+                with r:
+                    rdfgraph.parse(source=r, format="xml")
             result = rdfgraph   # Return parsed RDF graph
             if len(result) > 0: status = 0
         except Exception as e:
             assert False, "Error parsing RDF from SPARQL endpoint query: "+str(e)
     return (status, result)
 
-def outputResult(progname, options, result):
-    outstr = sys.stdout
+# Helper functions to copy endpoint responses directly to the output
+
+# Response media types that can be copied to output without conversion, indexed
+# by query type and output format.  Each entry gives the media type requested,
+# other acceptable response types, and a pattern that matches a non-empty result.
+
+PASSTHROUGHTYPES = (
+    { ("SELECT", "JSON"):
+        ( "application/sparql-results+json", ["application/json"]
+        , rb'"bindings"\s*:\s*\[\s*[^\s\]]' )
+    , ("SELECT", "XML"):
+        ( "application/sparql-results+xml", ["application/xml"]
+        , rb'<result[\s>]' )
+    , ("ASK", "JSON"):
+        ( "application/sparql-results+json", ["application/json"]
+        , rb'"boolean"\s*:\s*true' )
+    , ("ASK", "XML"):
+        ( "application/sparql-results+xml", ["application/xml"]
+        , rb'<boolean>\s*true' )
+    , ("CONSTRUCT", "RDFXML"):
+        ( "application/rdf+xml", ["application/xml"]
+        , rb'<rdf:RDF[^>]*>\s*<[^/]' )
+    , ("CONSTRUCT", "TURTLE"):
+        ( "text/turtle", ["application/x-turtle"]
+        , rb'(?im)^(?!\s*@?(prefix|base)\b)\s*[^#\s].*\n' )
+    , ("CONSTRUCT", "NT"):
+        ( "application/n-triples", ["text/plain"]
+        , rb'(?m)^\s*[<_].*\n' )
+    })
+
+PASSTHROUGHBUFSIZE = 65536
+
+def copyResponse(instream, outstr, nonempty, bufsize=PASSTHROUGHBUFSIZE):
+    """
+    Copy response data from a binary input stream to the output, in large blocks.
+    Returns True if the pattern nonempty is matched by the response data.
+    """
+    outbuf  = getattr(outstr, "buffer", None)
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    outstr.flush()
+    found   = False
+    tail    = b""
+    while True:
+        data = instream.read(bufsize)
+        if not data:
+            break
+        if not found:
+            # Keep the end of the previous block, in case a match spans blocks
+            tail  = tail+data
+            found = re.search(nonempty, tail) is not None
+            tail  = tail[-1024:]
+        if outbuf:
+            outbuf.write(data)
+        else:
+            outstr.write(decoder.decode(data))
+    if not found:
+        # Patterns for line-based formats match complete lines only
+        found = re.search(nonempty, tail+b"\n") is not None
+    if outbuf:
+        outbuf.flush()
+    else:
+        outstr.write(decoder.decode(b"", final=True))
+        outstr.flush()
+    return found
+
+def passthroughType(options, querytype):
+    """
+    Return passthrough details for a query and the selected output format,
+    or None if the endpoint response must be converted.
+    """
+    if querytype in ["ASK", "SELECT"]:
+        outformat = options.format_var_out or "JSON"
+    else:
+        outformat = options.format_rdf_out
+        if outformat not in RDFTYPSERIALIZERMAP:
+            outformat = RDFTYP[0]
+        querytype = "CONSTRUCT"
+    return PASSTHROUGHTYPES.get((querytype, outformat), None)
+
+def passthroughSparqlEndpoint(progname, options, prefixes, query, bindings):
+    """
+    Issue SPARQL query to SPARQL HTTP endpoint, requesting the selected output
+    format, and copy the response directly to stdout without parsing it.
+
+    This is used only if no incoming bindings, paging or format conversion are
+    required.  The query status is inferred by scanning the response for a
+    result.  Returns None, before writing anything, if the response cannot be
+    used in this way.
+    """
+    if options.verbose or getattr(options, "output", "-") not in [None, "-"]:
+        return None
+    if bindings and not bindingsAreEmpty(bindings['results']['bindings']):
+        return None
+    query     = prefixes + query
+    querytype = queryType(query)
+    if querytype is None:
+        return None
+    if querytype == "SELECT" and getPageSize(options):
+        return None
+    passthrough = passthroughType(options, querytype)
+    if not passthrough:
+        return None
+    (resulttype, othertypes, nonempty) = passthrough
+    ((status, reason), response) = endpointRequest(options, query, resulttype)
+    with response:
+        if status != 200:
+            assert False, "Error from SPARQL query request: %i %s"%(status, reason)
+        contenttype = (response.getheader("Content-Type") or "").split(";")[0].strip().lower()
+        if contenttype not in [resulttype]+othertypes:
+            log.debug("passthroughSparqlEndpoint: response type %s, not %s"%(contenttype, resulttype))
+            return None
+        found = copyResponse(response, sys.stdout, nonempty)
+    return 0 if found else 1
+
+def outputResult(progname, options, result, outstr=None):
+    """
+    Write query result to stdout or the supplied stream, in the selected output format.
+
+    Result bindings are written as they are taken from the result, which may be
+    an iterator, and output is flushed periodically so that a following stage
+    of a pipeline can start work before the query has finished.
+
+    Returns the number of result bindings written, or None if the result does
+    not contain bindings (e.g. an RDF graph or ASK query result).
+    """
+    outstr = outstr or sys.stdout
+    count  = None
     if options.output and options.output != "-":
         print( "Output to other than stdout not implemented" )
     if isinstance(result, rdflib.Graph):
         rdfformatdefault = RDFTYPSERIALIZERMAP[RDFTYP[0]]
         rdfformatselect  = RDFTYPSERIALIZERMAP.get(options.format_rdf_out, rdfformatdefault)
-        result.serialize(destination=outstr, format=rdfformatselect, base=None)
+        outbuf = getattr(outstr, "buffer", None)
+        if outbuf:
+            # rdflib serializers write bytes
+            outstr.flush()
+            result.serialize(destination=outbuf, format=rdfformatselect, base=None)
+            outbuf.flush()
+        else:
+            data = result.serialize(format=rdfformatselect, base=None)
+            if isinstance(data, bytes):
+                data = data.decode("utf-8")
+            outstr.write(data)
     elif isinstance(result, str):
         outstr.write(result)
     else:
         if options.format_var_out == "JSON" or options.format_var_out == None:
-            outstr.write(json.dumps(result))
-            outstr.write("\n")
+            count = writeResultsJSON(outstr, result, OUTPUTFLUSHROWS)
         elif options.format_var_out == "XML":
-            writeResultsXML(outstr, result)
+            count = writeResultsXML(outstr, result, OUTPUTFLUSHROWS)
         elif options.format_var_out == "CSV":
-            qvars = result["head"]["vars"]
-            outstr.write(", ".join(qvars))
-            outstr.write("\n")
-            for bindings in result["results"]["bindings"]:
-                ### print("---- bindings: "+repr(bindings))
-                vals = [ termToCSV(bindings.get(str(v),{'type': 'literal', 'value': ''})) for v in qvars ]
-                outstr.write(", ".join(vals))
-                outstr.write("\n")
+            count = writeResultsCSV(outstr, result, OUTPUTFLUSHROWS)
+        elif options.format_var_out == "TSV":
+            count = writeResultsTSV(outstr, result, OUTPUTFLUSHROWS)
+        elif options.format_var_out == "BINARY":
+            outbuf = getattr(outstr, "buffer", None)
+            if outbuf:
+                outstr.flush()
+                count = writeResultsBinary(outbuf, result, OUTPUTFLUSHROWS)
+            else:
+                print( "Binary output to a text stream not supported" )
         else:
-            for bindings in result["results"]["bindings"]:
-                #log.debug("options.format_var_out '%s'"%(repr(options.format_var_out)))
-                formattedrow = formatBindings(options.format_var_out, bindings)
-                #log.debug("formattedrow '%s'"%(repr(formattedrow)))
-                outstr.write(formattedrow)
-    return
+            template = BindingsTemplate(options.format_var_out)
+            rows     = ( template.format(bindings) for bindings in result["results"]["bindings"] )
+            count    = writeRows(outstr, "", rows, OUTPUTFLUSHROWS)
+    outstr.flush()
+    return count
 
 def run(configbase, options, args):
     status   = 0
@@ -469,6 +1580,12 @@ def run(configbase, options, args):
         print( "%s/examples"%(os.path.dirname(os.path.abspath(__file__))) )
         return 0
     progname = os.path.basename(args[0])
+    if getattr(options, "daemon", None):
+        from .QueryDaemon import runDaemon
+        return runDaemon(progname, options)
+    if getattr(options, "serve", None):
+        from .SparqlHttpServer import runServer
+        return runServer(progname, options)
     query    = getQuery(options, args)
     if not query:
         print( "%s: Could not determine query string (need query argument or -q option)"%progname )
@@ -494,12 +1611,28 @@ def run(configbase, options, args):
         print( query )
         print( "== Initial bindings ==" )
         print( bindings )
+    if getattr(options, "socket", None):
+        from .QueryDaemon import runClient
+        return runClient(progname, options, prefixes, query, bindings)
+    return runQuery(progname, options, prefixes, query, bindings)
+
+def runQuery(progname, options, prefixes, query, bindings, rdfgraph=None, outstr=None):
+    """
+    Evaluate query against SPARQL endpoint or RDF data, and output the result.
+    Returns the query status.
+    """
+    status = 0
     if options.endpoint:
-        (status,result) = querySparqlEndpoint(progname, options, prefixes, query, bindings)
+        status = passthroughSparqlEndpoint(progname, options, prefixes, query, bindings)
+        if status is not None:
+            return status
+        (status,result) = querySparqlEndpoint(progname, options, prefixes, query, bindings, stream=True)
     else:
-        (status,result) = queryRdfData(progname, options, prefixes, query, bindings)
+        (status,result) = queryRdfData(progname, options, prefixes, query, bindings, stream=True, rdfgraph=rdfgraph)
     if result:
-        outputResult(progname, options, result)
+        count = outputResult(progname, options, result, outstr=outstr)
+        if status is None:
+            status = 0 if count else 1
     return status
 
 def parseCommandArgs(argv):
@@ -530,8 +1663,16 @@ def parseCommandArgs(argv):
                       default=None,
                       help="URI or filename of resource containing incoming query variable bindings "+
                            "(default none). "+
-                           "Specify '-' to use stdin. "+
-                           "This option works for SELECT queries only when accessing a SPARQL endpoint.")
+                           "Specify '-' to use stdin (when RDF data is not also read from stdin). "+
+                           "Compressed bindings are decompressed as they are read. "+
+                           "When accessing a SPARQL endpoint, bindings are sent with the query as VALUES clauses; "+
+                           "bindings containing blank nodes can be used with SELECT queries only.")
+    parser.add_option("--daemon",
+                      dest="daemon",
+                      default=None,
+                      help="Run as a query daemon:  load the RDF data specified by -r options once, "+
+                           "then serve queries sent by 'asq --socket' over the Unix domain socket "+
+                           "with the given path, until interrupted.")
     parser.add_option("--debug",
                       action="store_true", 
                       dest="debug", 
@@ -541,11 +1682,51 @@ def parseCommandArgs(argv):
                       dest="endpoint",
                       default=None,
                       help="URI of SPARQL endpoint to query.")
+    parser.add_option("--endpoint-format",
+                      dest="endpoint_format",
+                      default=None,
+                      help="Format requested for SPARQL endpoint ASK and SELECT query results: JSON or XML.  "+
+                           "The default is XML if XML output is selected, otherwise JSON.  "+
+                           "Responses in either format are accepted.")
+    parser.add_option("--values-chunk-size",
+                      dest="values_chunk_size",
+                      type="int",
+                      default=VALUESCHUNKSIZE,
+                      help="Maximum size in characters of incoming bindings sent to a SPARQL endpoint "+
+                           "as a VALUES clause in a single request.  Larger binding sets are split "+
+                           "over several requests, except for a query with ORDER BY.  (default %default)")
+    parser.add_option("--parallel",
+                      dest="parallel",
+                      type="int",
+                      default=1,
+                      help="Maximum number of requests to a SPARQL endpoint that may be in progress at once, "+
+                           "when a query is split into several requests.  (default %default)")
+    parser.add_option("--load-workers",
+                      dest="load_workers",
+                      type="int",
+                      default=1,
+                      help="Number of worker processes used to fetch and parse RDF data when several "+
+                           "resources are specified with -r.  Blank nodes in each resource are kept "+
+                           "distinct from those in other resources.  (default %default)")
+    parser.add_option("--retries",
+                      dest="retries",
+                      type="int",
+                      default=RETRIES,
+                      help="Number of times a request is retried if a SPARQL endpoint responds that it is "+
+                           "overloaded (status 429 or 503), after a delay given by the endpoint or a random "+
+                           "exponentially increasing delay.  (default %default)")
+    parser.add_option("--page-size",
+                      dest="page_size",
+                      default=None,
+                      help="Request SELECT query results from a SPARQL endpoint in pages of this many results, "+
+                           "for endpoints that limit the size of a result.  Pages are requested in a stable order "+
+                           "until a short page is returned, up to --parallel at a time.  "+
+                           "'auto' pages only if an unpaged result appears to have been truncated.")
     parser.add_option("-f", "--format",
                       dest="format",
                       default=None,
                       help="Format for input and/or output:  "+
-                           "RDFXML, N3, NT, TURTLE, JSONLD, RDFA, HTML5, JSON, CSV or template.  "+
+                           "RDFXML, N3, NT, TURTLE, JSONLD, RDFA, HTML5, JSON, CSV, TSV, BINARY or template.  "+
                            "XML, N3, NT, TURTLE, JSONLD, RDFA, HTML5 apply to RDF data, "+
                            "others apply to query variable bindings.  "+
                            "Multiple comma-separated values may be specified; "+
@@ -570,6 +1751,51 @@ def parseCommandArgs(argv):
                       dest="query", 
                       help="URI or filename of resource containing query to execute. "+
                            "If not present, query must be supplied as command line argument.")
+    parser.add_option("--http-cache",
+                      action="store_true",
+                      dest="http_cache",
+                      default=False,
+                      help="Keep copies of RDF data, queries, prefixes and bindings retrieved by HTTP in a cache "+
+                           "in the directory given by --cache-dir, and revalidate them with conditional requests "+
+                           "rather than retrieving them again.")
+    parser.add_option("--offline",
+                      action="store_true",
+                      dest="offline",
+                      default=False,
+                      help="Use copies of HTTP resources in the cache (see --http-cache) without contacting "+
+                           "the server.  Resources that are not cached cannot be retrieved.")
+    parser.add_option("--cache",
+                      action="store_true",
+                      dest="result_cache",
+                      default=False,
+                      help="Keep SPARQL endpoint query results in a cache in the directory given by --cache-dir, "+
+                           "and use them for repeated queries until they expire (see --cache-ttl).")
+    parser.add_option("--no-cache",
+                      action="store_false",
+                      dest="result_cache",
+                      help="Do not use cached SPARQL endpoint query results (the default).")
+    parser.add_option("--cache-ttl",
+                      dest="cache_ttl",
+                      type="int",
+                      default=CACHETTL,
+                      help="Time in seconds for which cached SPARQL endpoint query results are used.  "+
+                           "(default %default)")
+    parser.add_option("--cache-dir",
+                      dest="cache_dir",
+                      default=CACHEDIR,
+                      help="Directory for caches of data retrieved from the web.  (default %default)")
+    parser.add_option("--cache-size",
+                      dest="cache_size",
+                      type="int",
+                      default=CACHESIZE,
+                      help="Maximum size in megabytes of each cache in --cache-dir;  the least recently used "+
+                           "entries are removed when it is exceeded.  (default %default)")
+    parser.add_option("--query-cache",
+                      dest="query_cache",
+                      default=None,
+                      help="Directory in which prepared (parsed) queries are saved for use by later runs.  "+
+                           "The directory must be private to the current user.  "+
+                           "Recently used prepared queries are always cached in memory for the duration of a run.")
     parser.add_option("-r", "--rdf-input",
                       action="append",
                       dest="rdf_data",
@@ -577,7 +1803,36 @@ def parseCommandArgs(argv):
                       help="URI or filename of RDF resource to query "+
                            "(default stdin or none). "+
                            "May be repeated to merge multiple input resources. "+
-                           "Specify '-' to use stdin.")
+                           "Specify '-' to use stdin.  "+
+                           "gzip, bzip2 and xz compressed data is decompressed as it is read.")
+    parser.add_option("--serve",
+                      dest="serve",
+                      type="int",
+                      default=None,
+                      help="Run as a SPARQL endpoint:  load the RDF data specified by -r options once, "+
+                           "then answer SPARQL protocol queries at http://localhost:PORT/sparql, until interrupted.")
+    parser.add_option("--serve-threads",
+                      dest="serve_threads",
+                      type="int",
+                      default=8,
+                      help="Number of worker threads used to handle requests with --serve.  (default %default)")
+    parser.add_option("--snapshot",
+                      dest="snapshot",
+                      default=None,
+                      help="Filename of a binary snapshot of the RDF data read from local files with -r.  "+
+                           "If the snapshot is current, it is used instead of reading the RDF data; "+
+                           "otherwise it is (re)written after the data has been read.")
+    parser.add_option("--socket",
+                      dest="socket",
+                      default=None,
+                      help="Unix domain socket path of a query daemon (see --daemon) to which the query is sent, "+
+                           "instead of evaluating it locally.  Output format options apply to the results returned.")
+    parser.add_option("--store",
+                      dest="store",
+                      default=None,
+                      help="Filename of a SQLite triple store holding the RDF data, for data too large to hold in memory.  "+
+                           "RDF data specified with -r is loaded into the store, unless already loaded from an "+
+                           "unchanged local file; with no -r options the existing store contents are queried.")
     parser.add_option("-v", "--verbose",
                       action="store_true", 
                       dest="verbose", 
@@ -602,16 +1857,24 @@ def parseCommandArgs(argv):
     parser.add_option("--format-var-in",
                       dest="format_var_in",
                       default=None,
-                      help="Format for query variable binding input data: JSON or CSV.")
+                      help="Format for query variable binding input data: JSON, XML or TSV.  "+
+                           "BINARY input is recognized automatically.")
     parser.add_option("--format-var-out",
                       dest="format_var_out",
                       default=None,
-                      help="Format for query variable binding output data: JSON, CSV or template.  "+
+                      help="Format for query variable binding output data: JSON, XML, CSV, TSV, BINARY or template.  "+
+                           "BINARY is a compact format for passing bindings to another asq command.  "+
                            "The template option is a Python format string applied to a dictionary of query result variables.")
     # parse command line now
     (options, args) = parser.parse_args(argv)
     if len(args) < 1: parser.error("No command present")
     if len(args) > 2: parser.error("Too many arguments present: "+repr(args))
+    if options.page_size and not (options.page_size.isdigit() or options.page_size.lower() == "auto"):
+        parser.error("--page-size must be a number or 'auto'")
+    if options.endpoint_format:
+        options.endpoint_format = options.endpoint_format.upper()
+        if options.endpoint_format not in [ f for (f, t) in ENDPOINTRESULTTYPES ]:
+            parser.error("--endpoint-format must be JSON or XML")
     def pick_next_format_option(s,kws):
         t = s
         for k in kws:
@@ -15,18 +15,30 @@ try:
     import simplejson as json
 except ImportError:
     import json
-import StringIO
-import urllib
+import io
+import urllib.request
+import shutil
+import tempfile
+import threading
+import time
+import email.utils
+import xml.etree.ElementTree
 import rdflib
+import rdflib.compare
 
 if __name__ == "__main__":
     # Add main project directory and ro manager directories at start of python path
     sys.path.insert(0, "../..")
-    sys.path.insert(0, "..")
 from MiscLib       import TestUtils
-from StdoutContext import SwitchStdout
-from StdinContext  import SwitchStdin
-import asqc
+from asqc.StdoutContext import SwitchStdout
+from asqc.StdinContext  import SwitchStdin
+from asqc.SparqlHttpClient import HttpConnectionPool, SparqlHttpClient, retryDelay
+from asqc.SparqlParallel   import orderedMap, AdaptiveLimiter
+from asqc.SparqlJsonResults import readResultsJSON, JsonStreamReader
+from asqc.SparqlCsvResults  import readResultsTSV
+from asqc.SparqlXmlResults  import writeResultsXML, readResultsXML
+from asqc.DiskCache        import DiskCache, HttpCache
+from asqc import asqc
 
 # Logging object
 log = logging.getLogger(__name__)
@@ -36,6 +48,9 @@ testbase = os.path.dirname(__file__)
 
 class TestAsqc(unittest.TestCase):
 
+    # SPARQL endpoint used by testQuerySparqlEndpoint... tests
+    endpoint = "http://localhost:3030/ds/query"
+
     def setUp(self):
         super(TestAsqc, self).setUp()
         return
@@ -49,18 +64,41 @@ class TestAsqc(unittest.TestCase):
     def testResolveUri(self):
         assert asqc.resolveUri("http://example.org/path", "http://base.example.org/base") == "http://example.org/path"
         assert asqc.resolveUri("path", "http://base.example.org/base") == "http://base.example.org/path"
-        assert asqc.resolveUri("path", "file://", os.getcwd() ) == "file://"+urllib.pathname2url(os.getcwd())+"/path"
+        assert asqc.resolveUri("path", "file://", os.getcwd() ) == "file://"+urllib.request.pathname2url(os.getcwd())+"/path"
         return
 
     def testRetrieveUri(self):
         assert asqc.retrieveUri("test.txt") == "Test data\n"
-        assert asqc.retrieveUri("file://"+urllib.pathname2url(os.getcwd())+"/test.txt") == "Test data\n"
+        assert asqc.retrieveUri("file://"+urllib.request.pathname2url(os.getcwd())+"/test.txt") == "Test data\n"
         assert "<title>Example Domain</title>" in asqc.retrieveUri("http://example.org/nosuchdata"), \
                asqc.retrieveUri("http://example.org/nosuchdata")
         assert asqc.retrieveUri("http://nohost.example.org/nosuchdata") == None, \
                asqc.retrieveUri("http://nohost.example.org/nosuchdata")
         return
 
+    def testOpenUri(self):
+        with asqc.openUri("test.txt") as f:
+            assert f.read() == b"Test data\n"
+        with asqc.openUri("file://"+urllib.request.pathname2url(os.getcwd())+"/test.txt") as f:
+            assert f.read() == b"Test data\n"
+        self.assertRaises(IOError, asqc.openUri, "nosuchfile.txt")
+        return
+
+    def testOpenUriCompressed(self):
+        import gzip, bz2, lzma
+        tempdir = tempfile.mkdtemp()
+        try:
+            for (ext, module) in [(".gz", gzip), (".bz2", bz2), (".xz", lzma)]:
+                filename = os.path.join(tempdir, "test.txt"+ext)
+                with module.open(filename, "wb") as f:
+                    f.write(b"Test data\n")
+                with asqc.openUri(filename) as f:
+                    assert f.read() == b"Test data\n", ext
+                assert asqc.retrieveUri(filename) == "Test data\n", ext
+        finally:
+            shutil.rmtree(tempdir)
+        return
+
     def testQueryType(self):
         q1 = """
             prefix foo: <http://example.org/foo#>
@@ -93,6 +131,30 @@ class TestAsqc(unittest.TestCase):
         assert asqc.queryType(q5) == None
         return
 
+    def testPageQuery(self):
+        prefixes = "# Test prefixes\nPREFIX ex: <http://example.org/test#>\nBASE <http://example.org/>\n"
+        (prologue, body) = asqc.splitQueryPrologue(prefixes+"SELECT ?s WHERE { ?s ex:p ?o }")
+        assert prologue == prefixes, prologue
+        assert body == "SELECT ?s WHERE { ?s ex:p ?o }", body
+        assert asqc.selectOrderVars("SELECT DISTINCT ?s ?o WHERE { ?s ?p ?o }") == ["s", "o"]
+        assert asqc.selectOrderVars("select * { ?s ?p ?o . ?o ?q ?s }") == ["s", "p", "o", "q"]
+        q = asqc.pageQuery(prefixes+"SELECT ?s WHERE { ?s ex:p ?o }", 100, 200)
+        assert q.startswith(prefixes+"SELECT * WHERE {"), q
+        assert "ORDER BY ?s\nLIMIT 100 OFFSET 200" in q, q
+        q = asqc.pageQuery("SELECT ?s WHERE { ?s ?p ?o } ORDER BY ?o", 10, 0)
+        assert q == "SELECT ?s WHERE { ?s ?p ?o } ORDER BY ?o\nLIMIT 10 OFFSET 0\n", q
+        assert asqc.pageQuery("SELECT ?s WHERE { ?s ?p ?o } LIMIT 5", 10, 0) == None
+        # Only top-level solution modifiers are recognized
+        q = asqc.pageQuery('SELECT ?s WHERE { ?s ?p "limit 1" } # ORDER BY ?s', 10, 0)
+        assert "ORDER BY ?s\nLIMIT 10 OFFSET 0" in q, q
+        q = asqc.pageQuery("SELECT ?s WHERE { { SELECT ?s WHERE { ?s ?p ?o } ORDER BY ?s LIMIT 5 } }", 10, 0)
+        assert q.startswith("SELECT * WHERE {") and q.endswith("ORDER BY ?s\nLIMIT 10 OFFSET 0\n"), q
+        # Dataset clauses are kept outside the subquery
+        q = asqc.pageQuery(prefixes+"SELECT ?s FROM <http://example.org/g1> FROM NAMED ex:g2 WHERE { ?s ?p ?o }", 10, 0)
+        assert q.startswith(prefixes+"SELECT * FROM <http://example.org/g1> FROM NAMED ex:g2\nWHERE {\n{\nSELECT ?s WHERE {"), q
+        assert asqc.queryFeatures(q) == set(["FROM", "SUBQUERY", "ORDER BY", "LIMIT", "OFFSET"])
+        return
+
     def testGetQuery(self):
         class testOptions(object):
             verbose = False
@@ -117,13 +179,22 @@ class TestAsqc(unittest.TestCase):
         f.close()
         options.prefix = "test.prefixes"
         assert asqc.getPrefixes(options) == p, asqc.getPrefixes(options)
-        # configured defaults
-        configprefixfile = os.path.join(os.path.expanduser("~"), ".asqc-prefixes")
-        f = open(configprefixfile, "r")
-        p = f.read()
-        f.close()
-        options.prefix = None
-        assert asqc.getPrefixes(options) == p, asqc.getPrefixes(options)
+        # configured defaults, in a home directory set up for the test
+        savehome = os.environ.get("HOME")
+        tempdir  = tempfile.mkdtemp()
+        try:
+            os.environ["HOME"] = tempdir
+            options.prefix = None
+            assert "PREFIX rdf:" in asqc.getPrefixes(options), asqc.getPrefixes(options)
+            configprefixfile = os.path.join(os.path.expanduser("~"), ".asqc-prefixes")
+            shutil.copy("test.prefixes", configprefixfile)
+            assert asqc.getPrefixes(options) == p, asqc.getPrefixes(options)
+        finally:
+            if savehome is None:
+                del os.environ["HOME"]
+            else:
+                os.environ["HOME"] = savehome
+            shutil.rmtree(tempdir)
         return
 
     def testGetBindings(self):
@@ -178,14 +249,14 @@ class TestAsqc(unittest.TestCase):
             assert bindings['results']['bindings'][1]['c'] == { 'type': "literal",       'value': "lit-c2" }
         #
         options  = testOptions()
-        inpstr   = StringIO.StringIO(testBindings)
+        inpstr   = io.StringIO(testBindings)
         bindings = asqc.getBindings(options)
         assert bindings == defaultBindings, repr(bindings)
         #
         options = testOptions()
         options.bindings = "-"
         options.rdf_data = ["test.rdfdata"]
-        inpstr   = StringIO.StringIO(testBindings)
+        inpstr   = io.StringIO(testBindings)
         with SwitchStdin(inpstr):
             bindings = asqc.getBindings(options)
             checkBindings(bindings)
@@ -193,7 +264,7 @@ class TestAsqc(unittest.TestCase):
         options = testOptions()
         options.bindings = "-"
         options.endpoint = "http://example.org/"
-        inpstr   = StringIO.StringIO(testBindings)
+        inpstr   = io.StringIO(testBindings)
         with SwitchStdin(inpstr):
             bindings = asqc.getBindings(options)
             checkBindings(bindings)
@@ -201,6 +272,27 @@ class TestAsqc(unittest.TestCase):
         options.bindings = "test.bindings"
         bindings = asqc.getBindings(options)
         checkBindings(bindings)
+        #
+        options = testOptions()
+        options.bindings = "-"
+        options.endpoint = "http://example.org/"
+        options.format_var_in = "TSV"
+        inpstr   = io.StringIO(
+            "?a\t?b\t?c\t?d\t?e\n"+
+            "<http://example.org/a1>\t_:b1\t\"lit-c1\"\t1\t\"lit-c1\"@en\n"+
+            "<http://example.org/a2>\t_:b2\t\"lit-c2\"\t\t\n")
+        with SwitchStdin(inpstr):
+            bindings = asqc.getBindings(options)
+            checkBindings(bindings)
+            assert 'd' not in bindings['results']['bindings'][1]
+        #
+        options.format_var_in = "XML"
+        xmlstr   = io.StringIO()
+        writeResultsXML(xmlstr, json.loads(testBindings))
+        inpstr   = io.StringIO(xmlstr.getvalue())
+        with SwitchStdin(inpstr):
+            bindings = asqc.getBindings(options)
+            checkBindings(bindings)
         return
 
     def testGetRdfXmlData(self):
@@ -221,7 +313,7 @@ class TestAsqc(unittest.TestCase):
             """
         #
         options = testOptions()
-        inpstr   = StringIO.StringIO(testRdfData)
+        inpstr   = io.StringIO(testRdfData)
         with SwitchStdin(inpstr):
             rdfgraph = asqc.getRdfData(options)
             assert len(rdfgraph) == 2
@@ -252,7 +344,7 @@ class TestAsqc(unittest.TestCase):
             """
         #
         options = testOptions()
-        inpstr   = StringIO.StringIO(testRdfData)
+        inpstr   = io.StringIO(testRdfData)
         with SwitchStdin(inpstr):
             rdfgraph = asqc.getRdfData(options)
             assert len(rdfgraph) == 2
@@ -280,6 +372,586 @@ class TestAsqc(unittest.TestCase):
         assert False, "Expected binding not found: %s"%(msg)
         return
 
+    def testValuesClause(self):
+        bindings = (
+            [ { 's': rdflib.URIRef("http://example.org/test#s1")
+              }
+            , { 's': rdflib.URIRef("http://example.org/test#s2")
+              , 'o': rdflib.Literal("lit-o2", lang="en")
+              }
+            ])
+        assert asqc.bindingVars(bindings) == ['s', 'o']
+        values = asqc.valuesClause(bindings)
+        assert values.startswith("VALUES ( ?s ?o )"), values
+        assert "( <http://example.org/test#s1> UNDEF )" in values, values
+        assert '( <http://example.org/test#s2> "lit-o2"@en )' in values, values
+        query = "SELECT * WHERE { ?s ?p ?o }"
+        assert asqc.canUseValuesClause(query, bindings)
+        assert not asqc.canUseValuesClause(query+" VALUES ?s { ex:s1 }", bindings)
+        assert not asqc.canUseValuesClause(query, [ { 's': rdflib.BNode("b1") } ])
+        assert asqc.canUseValuesClause(query+" ORDER BY ?s", bindings)
+        assert asqc.canUseValuesClause('SELECT * WHERE { ?s ?p "limit 1" } # LIMIT 1', bindings)
+        for q in ( [ "SELECT (COUNT(*) AS ?n) WHERE { ?s ?p ?o }"
+                   , "SELECT ?s WHERE { ?s ?p ?o } GROUP BY ?s HAVING (COUNT(?o) > 1)"
+                   , "SELECT DISTINCT ?p WHERE { ?s ?p ?o }"
+                   , "SELECT * WHERE { ?s ?p ?o } OFFSET 1"
+                   , "SELECT * WHERE { { SELECT ?s WHERE { ?s ?p ?o } LIMIT 1 } }"
+                   ] + self.scopedVarQueries ):
+            assert not asqc.canUseValuesClause(q, bindings), q
+        assert asqc.canUseValuesClause("SELECT * WHERE { ?s ?p ?o FILTER(?o != ?s) }", [ { 'p': rdflib.RDF.type } ])
+        assert asqc.queryFeatures("SELECT REDUCED * FROM <http://example.org/g> { ?s ?p ?o } LIMIT 5") == \
+               set(["REDUCED", "FROM", "LIMIT"])
+        assert asqc.queryFeatures("SELECT * WHERE { ?s ?p ") == None
+        q = asqc.injectValuesClause(
+            'CONSTRUCT { ?s ?p "}" } WHERE { ?s ?p ?o # }\n FILTER(?o != "}") } LIMIT 1', bindings[:1])
+        assert q == ( 'CONSTRUCT { ?s ?p "}" } WHERE {\nVALUES ( ?s )\n{\n  ( <http://example.org/test#s1> )\n}\n'
+                      ' ?s ?p ?o # }\n FILTER(?o != "}") } LIMIT 1' ), q
+        assert asqc.injectValuesClause("CONSTRUCT WHERE { ?s ?p ?o }", bindings) == None
+        assert asqc.bindingsAreEmpty([{}])
+        assert not asqc.bindingsAreEmpty(bindings)
+        chunks = list(asqc.valuesClauses(bindings, 40))
+        assert len(chunks) == 2, chunks
+        assert "s1" in chunks[0] and "s2" not in chunks[0], chunks[0]
+        assert chunks[1].startswith("VALUES ( ?s ?o )"), chunks[1]
+        assert "s2" in chunks[1] and "s1" not in chunks[1], chunks[1]
+        return
+
+    def testQueryCache(self):
+        from asqc.QueryCache import QueryCache
+        query    = "SELECT * WHERE { ?s ?p ?o }"
+        cachedir = tempfile.mkdtemp()
+        try:
+            qc = QueryCache(cachedir)
+            q1 = qc.getQuery(query)
+            q2 = qc.getQuery(query)
+            assert q1 is q2
+            assert (qc.hits, qc.misses) == (1, 1)
+            # New cache instance reads prepared query saved by the first
+            qc = QueryCache(cachedir)
+            q3 = qc.getQuery(query)
+            assert (qc.hits, qc.misses) == (1, 0)
+            rdfgraph = rdflib.Graph()
+            rdfgraph.parse("test1.rdf")
+            assert len(rdfgraph.query(q3).bindings) == 4
+            # Saved queries are not loaded from a directory others can write
+            os.chmod(cachedir, 0o777)
+            qc = QueryCache(cachedir)
+            qc.getQuery(query)
+            assert (qc.hits, qc.misses) == (0, 1)
+            os.chmod(cachedir, 0o700)
+            # Least recently used queries are removed from memory and disk
+            datasize = sum( os.path.getsize(os.path.join(cachedir, f))
+                            for f in os.listdir(cachedir) if f.endswith(".data") )
+            qc = QueryCache(cachedir, size=2, disksize=datasize*2)
+            queries = [ "SELECT * WHERE { ?s ?p ?o } LIMIT %i"%(i) for i in range(1,5) ]
+            for q in queries+[queries[3], queries[0]]:
+                qc.getQuery(q)
+            assert (qc.hits, qc.misses) == (1, 5), (qc.hits, qc.misses)
+            datasize = sum( os.path.getsize(os.path.join(cachedir, f))
+                            for f in os.listdir(cachedir) if f.endswith(".data") )
+            assert datasize <= qc._disk.maxsize
+        finally:
+            shutil.rmtree(cachedir)
+        return
+
+    def testJoinBindings(self):
+        def u(n): return rdflib.URIRef("http://example.org/test#"+n)
+        results = (
+            [ { 's': u("s1"), 'p': u("p1"), 'o': u("o1") }
+            , { 's': u("s1"), 'p': u("p2"), 'o': u("o2") }
+            , { 's': u("s2"), 'p': u("p3"), 'o': u("o3") }
+            , { 's': u("s2"), 'p': u("p4") }
+            ])
+        constraints = (
+            [ { 's': u("s1") }
+            , { 'o': u("o3") }
+            ])
+        def nestedLoopJoin(b1s, b2s):
+            return [ bj for bj in [ asqc.joinBinding(b1, b2) for b1 in b1s for b2 in b2s ] if bj ]
+        def sortKey(b):
+            return sorted(b.items())
+        for (b1s, b2s) in [(results, constraints), (constraints, results), (results, results)]:
+            expect = sorted(nestedLoopJoin(b1s, b2s), key=sortKey)
+            joined = sorted(asqc.joinBindings(b1s, b2s), key=sortKey)
+            assert joined == expect, repr(joined)
+        joined = asqc.joinBindings(results, constraints)
+        assert len(joined) == 4, repr(joined)
+        assert { 's': u("s2"), 'p': u("p4"), 'o': u("o3") } in joined
+        assert asqc.joinBindings(results, []) == []
+        return
+
+    def testHttpConnectionPool(self):
+        pool = HttpConnectionPool(maxsize=1, idletimeout=60.0)
+        (hc1, reused) = pool.getConnection("http", "example.org")
+        assert not reused
+        (hc2, reused) = pool.getConnection("http", "example.org")
+        pool.putConnection("http", "example.org", hc1)
+        pool.putConnection("http", "example.org", hc2)     # pool full: closed
+        (hc, reused) = pool.getConnection("http", "example.org")
+        assert reused and hc is hc1
+        (hc, reused) = pool.getConnection("https", "example.org")
+        assert not reused
+        pool.putConnection("http", "example.org", hc1)
+        pool._idletimeout = -1.0
+        (hc, reused) = pool.getConnection("http", "example.org")
+        assert not reused and hc is not hc1
+        pool.setRedirect("http://example.org/sparql", "http://example.org/query")
+        assert pool.getRedirect("http://example.org/sparql") == "http://example.org/query"
+        assert pool.getRedirect("http://example.org/query") == None
+        return
+
+    def testOrderedMap(self):
+        lock     = threading.Lock()
+        inflight = [0, 0]   # current, maximum
+        def work(n):
+            with lock:
+                inflight[0] += 1
+                inflight[1] = max(inflight)
+            time.sleep(0.01*(5-n))
+            with lock:
+                inflight[0] -= 1
+            return n*n
+        results = list(orderedMap(work, range(5), parallel=3))
+        assert [ (i, r) for (i, r, t) in results ] == [ (n, n*n) for n in range(5) ]
+        assert inflight[1] <= 3, inflight
+        # Abandon unbounded generator after a few results
+        found = []
+        for (i, r, t) in orderedMap(work, iter(int, 1), parallel=2):
+            found.append(r)
+            if len(found) == 3: break
+        assert found == [0, 0, 0]
+        # Results of calls in progress when the generator is abandoned are discarded
+        discarded = []
+        results   = orderedMap(work, iter(int, 1), parallel=3, discard=discarded.append)
+        next(results)
+        results.close()
+        assert discarded == [0, 0], discarded
+        def fail(n):
+            raise ValueError(n)
+        try:
+            list(orderedMap(fail, range(3), parallel=2))
+            assert False, "Expected exception from orderedMap"
+        except ValueError:
+            pass
+        return
+
+    def testAdaptiveLimiter(self):
+        import asqc.SparqlParallel as SparqlParallel
+        limiter = AdaptiveLimiter(4)
+        assert limiter.limit == 4
+        limiter.congestion()
+        assert limiter.limit == 2
+        # Congestion signals close together cause a single decrease
+        limiter.congestion()
+        assert limiter.limit == 2
+        limiter._decrease -= SparqlParallel.DECREASEINTERVAL
+        limiter.congestion()
+        assert limiter.limit == 1
+        # Limit increases by about one for each limit's worth of successes
+        for i in range(3):
+            limiter.success()
+        assert 2.5 < limiter.limit < 3, limiter.limit
+        for i in range(20):
+            limiter.success()
+        assert limiter.limit == 4
+        # Requests wait for the number in progress to fall below the limit
+        limiter.limit = 1
+        entered = []
+        with limiter:
+            thread = threading.Thread(target=lambda: entered.append(limiter.__enter__()))
+            thread.start()
+            time.sleep(0.05)
+            assert entered == []
+        thread.join()
+        assert entered == [limiter]
+        limiter.__exit__(None, None, None)
+        return
+
+    def testRetryRequest(self):
+        import http.server
+        responses = []
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                (status, body) = responses.pop(0) if responses else (200, b'{"head": {}, "boolean": true}')
+                self.send_response(status)
+                if status != 200:
+                    self.send_header("Retry-After", "0")
+                self.send_header("Content-Type", "application/sparql-results+json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        server = http.server.HTTPServer(("localhost", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            endpoint = "http://localhost:%i/sparql"%(server.server_address[1])
+            limiter  = AdaptiveLimiter(4)
+            sc = SparqlHttpClient(endpointuri=endpoint, limiter=limiter)
+            responses[:] = [(503, b"Busy"), (429, b"Busy")]
+            ((status, reason), result) = sc.doQueryPOST("ASK { ?s ?p ?o }")
+            assert status == 200
+            assert result == { "head": {}, "boolean": True }
+            assert responses == []
+            assert limiter.limit < 4
+            # Streamed responses are retried, and retries are limited
+            sc = SparqlHttpClient(endpointuri=endpoint, retries=1)
+            responses[:] = [(503, b"Busy"), (503, b"Busy"), (503, b"Busy")]
+            ((status, reason), result) = sc.doQueryPOST("ASK { ?s ?p ?o }", JSON=False, stream=True)
+            assert status == 503
+            assert result.read() == b"Busy"
+            assert len(responses) == 1
+            # A streamed response holds the limiter until it has been read
+            sc = SparqlHttpClient(endpointuri=endpoint, limiter=limiter)
+            ((status, reason), result) = sc.doQueryPOST("ASK { ?s ?p ?o }", JSON=False, stream=True)
+            assert limiter._inflight == 1
+            assert b"true" in result.read()
+            assert limiter._inflight == 0
+            ((status, reason), result) = sc.doQueryPOST("ASK { ?s ?p ?o }", JSON=False, stream=True)
+            result.close()
+            assert limiter._inflight == 0
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        # Delay before retry
+        assert retryDelay(0, "2") == 2.0
+        assert 9 < retryDelay(0, email.utils.formatdate(time.time()+10, usegmt=True)) <= 10
+        for attempt in range(4):
+            assert 0 <= retryDelay(attempt) <= 0.5*2**attempt
+        return
+
+    def testReadResultsJSON(self):
+        import io, json
+        rows = [ { "s": { "type": "uri", "value": "http://example.org/s%i"%i }
+                 , "o": { "type": "literal", "value": "caf\u00e9 %i"%i, "xml:lang": "fr" }
+                 } for i in range(20) ]
+        text = json.dumps(
+            { "head": { "vars": ["s", "o"] }, "results": { "bindings": rows } }, indent=2)
+        # Read in small chunks to exercise values and characters split across reads
+        class chunked(object):
+            def __init__(self, data, size):
+                self.stream = io.BytesIO(data)
+                self.size   = size
+            def read(self, size):
+                return self.stream.read(min(size, self.size))
+        for size in [1, 3, 7, 1000]:
+            result = readResultsJSON(chunked(text.encode("utf-8"), size))
+            assert result["head"] == { "vars": ["s", "o"] }
+            assert list(result["results"]["bindings"]) == rows
+        # Bindings are read lazily
+        stream = chunked(text.encode("utf-8"), 100)
+        result = readResultsJSON(stream)
+        next(result["results"]["bindings"])
+        assert stream.stream.tell() < len(text)
+        # Results before head, numbers split across buffer boundary, and ASK results
+        text   = '{ "results": { "bindings": [ { "a": 12345 } ] }, "head": { "vars": [ "a" ] } }'
+        result = readResultsJSON(io.BytesIO(text.encode("utf-8")))
+        assert result["head"] == { "vars": [ "a" ] }
+        assert list(result["results"]["bindings"]) == [ { "a": 12345 } ]
+        result = readResultsJSON(io.BytesIO(b'{ "head": {}, "boolean": true }'))
+        assert result == { "head": {}, "boolean": True }
+        reader = JsonStreamReader(io.BytesIO(b'[ 12345678 ]'), bufsize=4)
+        reader.expect("[")
+        assert reader.value() == 12345678
+        assert reader.expect("]") == "]"
+        return
+
+    def testReadResultsXML(self):
+        import io
+        result = (
+            { "head":    { "vars": ["s", "o"] }
+            , "results":
+              { "bindings":
+                [ { 's': { 'type': "bnode", 'value': "nodeid" }
+                  , 'o': { 'type': "literal", 'value': "caf\u00e9 <&>", 'xml:lang': "fr" }
+                  }
+                , { }
+                , { 'o': { 'type': "typed-literal", 'value': "1"
+                         , 'datatype': "http://www.w3.org/2001/XMLSchema#integer" }
+                  }
+                , { 's': { 'type': "uri", 'value': "http://example.org/test#s1" }
+                  , 'o': { 'type': "literal", 'value': "" }
+                  }
+                ]
+              }
+            })
+        for indent in ["  ", None]:
+            teststr = io.StringIO()
+            writeResultsXML(teststr, result, indent=indent)
+            readback = readResultsXML(io.BytesIO(teststr.getvalue().encode("utf-8")))
+            assert readback["head"]["vars"] == ["s", "o"]
+            assert list(readback["results"]["bindings"]) == result["results"]["bindings"]
+        # Bindings are read incrementally
+        stream = io.BytesIO(
+            b'<?xml version="1.0"?>\n'+
+            b'<sparql xmlns="http://www.w3.org/2005/sparql-results#">'+
+            b'<head><variable name="n"/></head><results>'+
+            b''.join([ b'<result><binding name="n"><literal>%i</literal></binding></result>'%i
+                       for i in range(100000) ])+
+            b'</results></sparql>')
+        readback = readResultsXML(stream)
+        bindings = readback["results"]["bindings"]
+        assert next(bindings) == { 'n': { 'type': "literal", 'value': "0" } }
+        assert stream.tell() < len(stream.getvalue())
+        assert len(list(bindings)) == 99999
+        # ASK results
+        for val in [True, False]:
+            teststr = io.StringIO()
+            writeResultsXML(teststr, { "head": {}, "boolean": val })
+            readback = readResultsXML(io.BytesIO(teststr.getvalue().encode("utf-8")))
+            assert readback["boolean"] == val
+            assert "results" not in readback
+        return
+
+    def testCopyResponse(self):
+        import io
+        def copy(data, querytype, outformat, bufsize):
+            class testOptions(object):
+                format_var_out = outformat
+                format_rdf_out = outformat
+            (resulttype, othertypes, nonempty) = asqc.passthroughType(testOptions(), querytype)
+            teststr = io.StringIO()
+            found   = asqc.copyResponse(io.BytesIO(data.encode("utf-8")), teststr, nonempty, bufsize)
+            assert teststr.getvalue() == data
+            return found
+        select = '{ "head": { "vars": ["s"] }, "results": { "bindings": [ { "s": { "type": "literal", "value": "caf\u00e9" } } ] } }'
+        for bufsize in [1, 5, 1000]:
+            assert copy(select, "SELECT", "JSON", bufsize)
+            assert not copy('{ "head": { "vars": ["s"] }, "results": { "bindings": [ ] } }', "SELECT", "JSON", bufsize)
+            assert copy('{ "head": {}, "boolean": true }', "ASK", "JSON", bufsize)
+            assert not copy('{ "head": {}, "boolean": false }', "ASK", "JSON", bufsize)
+            assert copy('@prefix ex: <http://example.org/> .\nex:s ex:p ex:o .\n', "CONSTRUCT", "TURTLE", bufsize)
+            assert not copy('@prefix ex: <http://example.org/> .\n# comment\n', "CONSTRUCT", "TURTLE", bufsize)
+        class testOptions(object):
+            format_var_out = "CSV"
+            format_rdf_out = "JSONLD"
+        assert asqc.passthroughType(testOptions(), "SELECT") is None
+        assert asqc.passthroughType(testOptions(), "CONSTRUCT") is None
+        return
+
+    def testDiskCache(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            cache = DiskCache(tempdir, maxsize=25)
+            assert cache.get("a") is None
+            # Entry "a" is used more recently than "b", so "b" is evicted when "c" is added
+            for (key, used) in [("a", 2), ("b", 1), ("c", 3)]:
+                writer = cache.put(key, {"key": key})
+                writer.write(b"0123456789")
+                writer.commit()
+                os.utime(cache._paths(key)[1], (used, used))
+            # Least recently used entry is evicted
+            assert cache.get("b") is None
+            (meta, datapath) = cache.get("a")
+            assert meta["key"] == "a"
+            with open(datapath, "rb") as f:
+                assert f.read() == b"0123456789"
+            assert cache.get("c") is not None
+            # Running total is kept as entries are added and removed, without eviction
+            assert cache._total == 20
+            writer = cache.put("e", {})
+            writer.write(b"x")
+            writer.commit()
+            assert cache._total == 21
+            cache.remove("e")
+            assert cache._total == 20
+            # Aborted entries are not added
+            writer = cache.put("d", {})
+            writer.write(b"x")
+            writer.abort()
+            assert cache.get("d") is None
+            assert [ f for f in os.listdir(tempdir) if f.endswith(".tmp") ] == []
+        finally:
+            shutil.rmtree(tempdir)
+        return
+
+    def testHttpCache(self):
+        import http.server
+        requests = []
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def send_head(self):
+                requests.append(self.headers.get("If-Modified-Since"))
+                return http.server.SimpleHTTPRequestHandler.send_head(self)
+            def log_message(self, format, *args):
+                pass
+        server  = http.server.HTTPServer(("localhost", 0), Handler)
+        thread  = threading.Thread(target=server.serve_forever)
+        thread.start()
+        tempdir = tempfile.mkdtemp()
+        try:
+            uri = "http://localhost:%i/test.txt"%(server.server_address[1])
+            cache = HttpCache(tempdir)
+            with cache.open(uri) as f:
+                assert f.read() == b"Test data\n"
+            assert len(requests) == 1 and requests[0] is None
+            # Cached copy is revalidated, and used
+            assert asqc.retrieveUri(uri, cache) == "Test data\n"
+            assert len(requests) == 2 and requests[1] is not None
+            # Offline:  cached copy is used without a request
+            offline = HttpCache(tempdir, offline=True)
+            assert asqc.retrieveUri(uri, offline) == "Test data\n"
+            assert len(requests) == 2
+            assert asqc.retrieveUri(uri+"?nosuch", offline) is None
+            assert len(requests) == 2
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            shutil.rmtree(tempdir)
+        return
+
+    def testGraphSnapshot(self):
+        from asqc.GraphSnapshot import snapshotSources, openSnapshot, writeSnapshot
+        class testOptions(object):
+            verbose        = False
+            rdf_data       = ["test1.rdf", "test2.rdf"]
+            prefix         = None
+            format_rdf_in  = None
+        options  = testOptions()
+        rdfgraph = asqc.getRdfData(options)
+        tempdir  = tempfile.mkdtemp()
+        try:
+            options.snapshot = os.path.join(tempdir, "test.snapshot")
+            sources  = snapshotSources(options.rdf_data, None)
+            assert openSnapshot(options.snapshot, sources) is None
+            writeSnapshot(rdfgraph, options.snapshot, sources)
+            snapgraph = openSnapshot(options.snapshot, sources)
+            assert snapgraph is not None
+            assert len(snapgraph) == len(rdfgraph)
+            # Every pattern of bound and unbound terms matches the same triples
+            ex = rdflib.Namespace("http://example.org/test#")
+            for (s, p, o) in list(rdfgraph)+[(ex.s1, ex.p2, ex.nonesuch)]:
+                for pattern in [ (s, p, o), (s, p, None), (s, None, o), (None, p, o)
+                               , (s, None, None), (None, p, None), (None, None, o)
+                               , (None, None, None) ]:
+                    assert set(snapgraph.triples(pattern)) == set(rdfgraph.triples(pattern)), repr(pattern)
+            snapgraph.close()
+            # Queries use the snapshot
+            prefixes = asqc.getPrefixes(options)+"PREFIX ex: <http://example.org/test#>\n"
+            bindings = { "head": { "vars": [] }, "results": { "bindings": [{}] } }
+            query    = "SELECT ?o WHERE { ex:s2 ?p ?o }"
+            (status,result) = asqc.queryRdfData("test", options, prefixes, query, bindings)
+            assert status == 0
+            assert len(result["results"]["bindings"]) == 2
+            # Snapshot is not used if a source file changes
+            st = os.stat("test1.rdf")
+            os.utime("test1.rdf", (st.st_atime, st.st_mtime+1))
+            try:
+                assert openSnapshot(options.snapshot, snapshotSources(options.rdf_data, None)) is None
+            finally:
+                os.utime("test1.rdf", (st.st_atime, st.st_mtime))
+        finally:
+            shutil.rmtree(tempdir)
+        return
+
+    def testSqliteStore(self):
+        from asqc.SqliteStore import openSqliteGraph
+        class testOptions(object):
+            verbose        = False
+            rdf_data       = ["test1.rdf", "test2.rdf"]
+            prefix         = None
+            format_rdf_in  = None
+        options  = testOptions()
+        rdfgraph = asqc.getRdfData(options)
+        tempdir  = tempfile.mkdtemp()
+        try:
+            options.store = os.path.join(tempdir, "test.db")
+            storegraph = asqc.getRdfData(options)
+            assert storegraph is not None
+            assert len(storegraph) == len(rdfgraph)
+            # Every pattern of bound and unbound terms matches the same triples
+            ex = rdflib.Namespace("http://example.org/test#")
+            for (s, p, o) in list(rdfgraph)+[(ex.s1, ex.p2, ex.nonesuch)]:
+                for pattern in [ (s, p, o), (s, p, None), (s, None, o), (None, p, o)
+                               , (s, None, None), (None, p, None), (None, None, o)
+                               , (None, None, None) ]:
+                    assert set(storegraph.triples(pattern)) == set(rdfgraph.triples(pattern)), repr(pattern)
+            storegraph.close()
+            # Loaded files are recorded, and not loaded again
+            storegraph = openSqliteGraph(options.store)
+            assert len(storegraph.store.loadedSources()) == 2
+            storegraph.close()
+            # Queries use the store, with or without RDF data options
+            prefixes = asqc.getPrefixes(options)+"PREFIX ex: <http://example.org/test#>\n"
+            bindings = { "head": { "vars": [] }, "results": { "bindings": [{}] } }
+            query    = "SELECT ?o WHERE { ex:s2 ?p ?o }"
+            (status,result) = asqc.queryRdfData("test", options, prefixes, query, bindings)
+            assert status == 0
+            assert len(result["results"]["bindings"]) == 2
+            options.rdf_data = None
+            (status,result) = asqc.queryRdfData("test", options, prefixes, query, bindings)
+            assert status == 0
+            assert len(result["results"]["bindings"]) == 2
+            # Turtle and N3 data, loaded in batches larger than the term cache
+            import asqc.SqliteStore as SqliteStore
+            termcachesize = SqliteStore.TERMCACHESIZE
+            addbatchsize  = SqliteStore.ADDBATCHSIZE
+            try:
+                SqliteStore.TERMCACHESIZE = 3
+                SqliteStore.ADDBATCHSIZE  = 4
+                for fmt in ["TURTLE", "N3"]:
+                    options.rdf_data      = ["test.n3"]
+                    options.format_rdf_in = fmt
+                    options.store         = None
+                    rdfgraph = asqc.getRdfData(options)
+                    options.store = os.path.join(tempdir, "test%s.db"%fmt)
+                    storegraph = asqc.getRdfData(options)
+                    assert storegraph is not None
+                    assert len(storegraph) == len(rdfgraph) == 2
+                    assert rdflib.compare.isomorphic(storegraph, rdfgraph)
+                    storegraph.close()
+                options.rdf_data      = ["test1.rdf", "test2.rdf"]
+                options.format_rdf_in = None
+                options.store = os.path.join(tempdir, "testbatch.db")
+                storegraph = asqc.getRdfData(options)
+                assert set(storegraph) == set(asqc.getRdfData(testOptions()))
+                storegraph.close()
+            finally:
+                SqliteStore.TERMCACHESIZE = termcachesize
+                SqliteStore.ADDBATCHSIZE  = addbatchsize
+        finally:
+            shutil.rmtree(tempdir)
+        return
+
+    def testGetRdfDataParallel(self):
+        class testOptions(object):
+            verbose        = False
+            rdf_data       = ["test1.rdf", "test2.rdf", "test.rdf"]
+            prefix         = None
+            format_rdf_in  = None
+            load_workers   = 1
+        options  = testOptions()
+        rdfgraph = asqc.getRdfData(options)
+        options.load_workers = 3
+        pargraph = asqc.getRdfData(options)
+        assert pargraph is not None
+        assert rdflib.compare.isomorphic(pargraph, rdfgraph)
+        # Blank nodes are named by position of the resource, and are distinct between resources
+        (ns, triples0) = asqc.parseRdfSource((0, "test.n3", "N3", None))
+        assert asqc.parseRdfSource((0, "test.n3", "N3", None))[1] == triples0
+        (ns, triples1) = asqc.parseRdfSource((1, "test.n3", "N3", None))
+        assert len(triples1) == len(triples0) == 2
+        assert set(s for (s, p, o) in triples0) == set(["_r0b0"])
+        assert set(s for (s, p, o) in triples1) == set(["_r1b0"])
+        options.rdf_data = ["test1.rdf", "nonesuch.rdf"]
+        assert asqc.getRdfData(options) is None
+        return
+
+    def testTermCodec(self):
+        from asqc.TermCodec import encodeTerm, decodeTerm
+        for t in [ rdflib.URIRef("http://example.org/test#s1")
+                 , rdflib.BNode("b1")
+                 , rdflib.Literal("caf\u00e9", lang="fr")
+                 , rdflib.Literal("42", datatype=rdflib.XSD.integer)
+                 , rdflib.Literal("a\0b")
+                 ]:
+            e = encodeTerm(t)
+            assert decodeTerm(e) == t and type(decodeTerm(e)) == type(t), repr(t)
+        return
+
     def testQueryRdfDataSelect(self):
         class testOptions(object):
             verbose        = False
@@ -345,6 +1017,90 @@ class TestAsqc(unittest.TestCase):
         assert len(result["results"]["bindings"]) == 0, "queryRdfData result count"
         return
 
+    def testQueryRdfDataSelectStream(self):
+        class testOptions(object):
+            verbose        = False
+            output         = None
+            rdf_data       = ["test1.rdf", "test2.rdf"]
+            prefix         = None
+            format_rdf_in  = None
+            format_var_out = "JSON"
+        options  = testOptions()
+        prefixes = asqc.getPrefixes(options)+"PREFIX ex: <http://example.org/test#>\n"
+        bindings = { "head": { "vars": [] }, "results": { "bindings": [{}] } }
+        query = "SELECT * WHERE { ex:s1 ?p ?o }"
+        (status,result) = asqc.queryRdfData("test", options, prefixes, query, bindings, stream=True)
+        assert status is None, "queryRdfData streamed SELECT status"
+        assert not isinstance(result["results"]["bindings"], list)
+        teststr = io.StringIO()
+        with SwitchStdout(teststr):
+            count = asqc.outputResult("asqc", options, result)
+            testtxt = teststr.getvalue()
+        assert count == 2, "outputResult streamed result count"
+        assert len(json.loads(testtxt)["results"]["bindings"]) == 2
+        query = "SELECT * WHERE { <http://example.org/nonesuch> ?p ?o }"
+        (status,result) = asqc.queryRdfData("test", options, prefixes, query, bindings, stream=True)
+        teststr = io.StringIO()
+        with SwitchStdout(teststr):
+            count = asqc.outputResult("asqc", options, result)
+            testtxt = teststr.getvalue()
+        assert count == 0, "outputResult streamed empty result count"
+        assert json.loads(testtxt)["results"]["bindings"] == []
+        return
+
+    # Queries for which incoming bindings are applied to each evaluation of the query
+
+    perRowQueries = (
+        [ "SELECT (COUNT(*) AS ?n) WHERE { ?s ?p ?o }"
+        , "SELECT ?s ?o WHERE { ?s ?p ?o } ORDER BY ?o LIMIT 1"
+        , 'SELECT DISTINCT ?x WHERE { ?s ?p ?o BIND("x" AS ?x) }'
+        ])
+
+    # Queries that use the binding variable ?s where it must be bound by each incoming binding
+
+    scopedVarQueries = (
+        [ "SELECT ?o WHERE { ?x ?p ?o FILTER(?x = ?s) }"
+        , "SELECT ?x ?y WHERE { ?x ?p ?o BIND(?s AS ?y) FILTER(?x = ?y) }"
+        , "SELECT ?o WHERE { ?x ?p ?o FILTER EXISTS { ?s ?p ?o } }"
+        , "SELECT ?x ?o WHERE { ?x ?p ?o MINUS { ?x ?q ?s } }"
+        ])
+
+    def perRowResults(self, rdfgraph, query, rows):
+        return sorted( sorted( (str(k), str(v)) for (k, v) in b.asdict().items() )
+                       for row in rows for b in rdfgraph.query(query, initBindings=row) )
+
+    def resultRows(self, result):
+        return sorted( sorted( (k, v['value']) for (k, v) in b.items() )
+                       for b in result["results"]["bindings"] )
+
+    def testQueryRdfDataPerRow(self):
+        class testOptions(object):
+            verbose        = False
+            rdf_data       = ["test1.rdf", "test2.rdf"]
+            prefix         = None
+            format_rdf_in  = None
+        options  = testOptions()
+        rdfgraph = asqc.getRdfData(options)
+        rows     = (
+            [ { 's': rdflib.URIRef("http://example.org/test#s1") }
+            , { 's': rdflib.URIRef("http://example.org/test#s2") }
+            ])
+        bindings = { "head": { "vars": ["s"] }, "results": { "bindings": rows } }
+        queries  = self.perRowQueries+["SELECT ?o WHERE { { SELECT ?s ?o WHERE { ?s ?p ?o } ORDER BY ?o LIMIT 1 } }"]
+        for query in queries:
+            (status,result) = asqc.queryRdfData("test", options, "", query, bindings, rdfgraph=rdfgraph)
+            assert status == 0, query
+            expect = self.perRowResults(rdfgraph, query, rows)
+            assert len(expect) == 2, expect
+            assert self.resultRows(result) == expect, "%s: %r"%(query, result["results"]["bindings"])
+        # Binding variables used in FILTER, BIND, EXISTS and MINUS are bound for each row
+        for query in self.scopedVarQueries:
+            (status,result) = asqc.queryRdfData("test", options, "", query, bindings, rdfgraph=rdfgraph)
+            expect = self.perRowResults(rdfgraph, query, rows)
+            assert expect, query
+            assert self.resultRows(result) == expect, "%s: %r"%(query, result["results"]["bindings"])
+        return
+
     def testQueryRdfDataAsk(self):
         class testOptions(object):
             verbose        = False
@@ -423,6 +1179,7 @@ class TestAsqc(unittest.TestCase):
             endpoint = "http://localhost:3030/ds/query"
             prefix   = None
         options  = testOptions()
+        options.endpoint = self.endpoint
         prefixes = asqc.getPrefixes(options)+"PREFIX ex: <http://example.org/test#>\n"
         query    = "SELECT * WHERE { ?s ?p ?o }"
         bindings = (
@@ -471,6 +1228,7 @@ class TestAsqc(unittest.TestCase):
             endpoint = "http://localhost:3030/ds/query"
             prefix   = None
         options  = testOptions()
+        options.endpoint = self.endpoint
         prefixes = asqc.getPrefixes(options)+"PREFIX ex: <http://example.org/test#>\n"
         query    = "ASK { ex:s1 ?p ?o }"
         (status,result) = asqc.querySparqlEndpoint("test", options, prefixes, query, None)
@@ -493,6 +1251,7 @@ class TestAsqc(unittest.TestCase):
             endpoint = "http://localhost:3030/ds/query"
             prefix   = None
         options  = testOptions()
+        options.endpoint = self.endpoint
         prefixes = asqc.getPrefixes(options)+"PREFIX ex: <http://example.org/test#>\n"
         query    = "CONSTRUCT { ex:s1 ?p ?o } WHERE { ex:s1 ?p ?o }"
         (status,result) = asqc.querySparqlEndpoint("test", options, prefixes, query, None)
@@ -523,7 +1282,7 @@ class TestAsqc(unittest.TestCase):
                 ]
               }
             })
-        teststr = StringIO.StringIO()
+        teststr = io.StringIO()
         with SwitchStdout(teststr):
             asqc.outputResult("asqc", options, result)
             testtxt = teststr.getvalue()
@@ -549,7 +1308,7 @@ class TestAsqc(unittest.TestCase):
                 ]
               }
             })
-        teststr = StringIO.StringIO()
+        teststr = io.StringIO()
         with SwitchStdout(teststr):
             asqc.outputResult("asqc", options, result)
             testtxt = teststr.getvalue()
@@ -560,6 +1319,26 @@ class TestAsqc(unittest.TestCase):
         assert """<uri>http://example.org/test#p1</uri>""" in testtxt
         assert """<binding name="o">""" in testtxt
         assert """<literal>literal string</literal>""" in testtxt
+        # Bindings taken from an iterator, with markup characters and language tags
+        def iterBindings():
+            yield { 'o': { 'type': "literal", 'value': "a<&>b", 'xml:lang': "en" } }
+            yield { }
+            yield { 'o': { 'type': "typed-literal", 'value': "1"
+                         , 'datatype': "http://www.w3.org/2001/XMLSchema#integer" } }
+        result = { "head": { "vars": ["o"] }, "results": { "bindings": iterBindings() } }
+        teststr = io.StringIO()
+        with SwitchStdout(teststr):
+            count   = asqc.outputResult("asqc", options, result)
+            testtxt = teststr.getvalue()
+        log.debug("testOutputResultXML \n"+testtxt)
+        assert count == 3
+        assert """<literal xml:lang="en">a&lt;&amp;&gt;b</literal>""" in testtxt
+        assert """<result />""" in testtxt
+        assert """<literal datatype="http://www.w3.org/2001/XMLSchema#integer">1</literal>""" in testtxt
+        root = xml.etree.ElementTree.fromstring(testtxt.encode("utf-8"))
+        literals = root.findall(".//{http://www.w3.org/2005/sparql-results#}literal")
+        assert literals[0].text == "a<&>b"
+        assert literals[0].get("{http://www.w3.org/XML/1998/namespace}lang") == "en"
         return
 
     def testOutputResultCSV(self):
@@ -579,7 +1358,7 @@ class TestAsqc(unittest.TestCase):
                 ]
               }
             })
-        teststr = StringIO.StringIO()
+        teststr = io.StringIO()
         with SwitchStdout(teststr):
             asqc.outputResult("asqc", options, result)
             testtxt = teststr.getvalue()
@@ -589,6 +1368,112 @@ class TestAsqc(unittest.TestCase):
         assert r'''_:nodeid, <http://example.org/test#p1>, "literal '""' '\u00e9' string"''' in testtxt
         return
 
+    def testOutputResultTSV(self):
+        class testOptions(object):
+            verbose        = False
+            output         = None
+            format_var_out = "TSV"
+        options  = testOptions()
+        result = (
+            { "head":    { "vars": ["s", "p", "o", "x"] }
+            , "results": 
+              { "bindings": 
+                [ { 's': { 'type': "bnode", 'value': "nodeid" }
+                  , 'p': { 'type': "uri", 'value': "http://example.org/test#p1" }
+                  , 'o': { 'type': "literal", 'value': """tab\t'"' '\u00e9' \\ string""", 'xml:lang': "en" }
+                  }
+                , { 's': { 'type': "uri", 'value': "http://example.org/test#s2" }
+                  , 'o': { 'type': "typed-literal", 'value': "42"
+                         , 'datatype': "http://www.w3.org/2001/XMLSchema#integer" }
+                  }
+                ]
+              }
+            })
+        teststr = io.StringIO()
+        with SwitchStdout(teststr):
+            count   = asqc.outputResult("asqc", options, result)
+            testtxt = teststr.getvalue()
+        log.debug("testOutputResultTSV \n"+repr(testtxt))
+        assert count == 2
+        lines = testtxt.split("\n")
+        assert lines[0] == "?s\t?p\t?o\t?x"
+        assert lines[1] == (
+            '_:nodeid\t<http://example.org/test#p1>\t"tab\\t\'\\"\' \'\u00e9\' \\\\ string"@en\t' )
+        assert lines[2] == (
+            '<http://example.org/test#s2>\t\t"42"^^<http://www.w3.org/2001/XMLSchema#integer>\t' )
+        # Read back
+        readback = readResultsTSV(io.StringIO(testtxt))
+        assert readback["head"]["vars"] == ["s", "p", "o", "x"]
+        assert list(readback["results"]["bindings"]) == result["results"]["bindings"]
+        return
+
+    def testOutputResultBinary(self):
+        import io
+        import asqc.SparqlBinaryResults as SparqlBinaryResults
+        from asqc.SparqlBinaryResults import readResultsBinary
+        class testOptions(object):
+            verbose        = False
+            output         = None
+            bindings       = "-"
+            endpoint       = "http://example.org/"
+            rdf_data       = None
+            format_var_in  = None
+            format_var_out = "BINARY"
+        options  = testOptions()
+        xsdint   = "http://www.w3.org/2001/XMLSchema#integer"
+        result = (
+            { "head":    { "vars": ["s", "p", "o"] }
+            , "results":
+              { "bindings":
+                [ { 's': { 'type': "bnode", 'value': "nodeid" }
+                  , 'p': { 'type': "uri", 'value': "http://example.org/test#p1" }
+                  , 'o': { 'type': "literal", 'value': "caf\u00e9", 'xml:lang': "fr" }
+                  }
+                , { 's': { 'type': "bnode", 'value': "nodeid" }
+                  , 'o': { 'type': "typed-literal", 'value': "1", 'datatype': xsdint }
+                  }
+                , { }
+                , { 'p': { 'type': "uri", 'value': "http://example.org/test#p1" }
+                  , 'x': { 'type': "literal", 'value': "" }
+                  }
+                ]
+              }
+            })
+        def writeBinary(result):
+            testbuf = io.BytesIO()
+            teststr = io.TextIOWrapper(testbuf, encoding="utf-8")
+            with SwitchStdout(teststr):
+                count = asqc.outputResult("asqc", options, result)
+            return (count, testbuf.getvalue())
+        (count, data) = writeBinary(result)
+        assert count == 4
+        assert data.startswith(SparqlBinaryResults.MAGIC)
+        readback = readResultsBinary(io.BytesIO(data))
+        assert list(readback["results"]["bindings"]) == result["results"]["bindings"]
+        assert readback["head"]["vars"] == ["s", "p", "o", "x"]
+        # Term numbering is reset when the limit is reached
+        termdictsize = SparqlBinaryResults.TERMDICTSIZE
+        try:
+            SparqlBinaryResults.TERMDICTSIZE = 2
+            (count, data) = writeBinary(result)
+        finally:
+            SparqlBinaryResults.TERMDICTSIZE = termdictsize
+        readback = readResultsBinary(io.BytesIO(data))
+        assert list(readback["results"]["bindings"]) == result["results"]["bindings"]
+        # Binary bindings are recognized as input
+        with SwitchStdin(io.TextIOWrapper(io.BytesIO(data), encoding="utf-8")):
+            bindings = asqc.getBindings(options)
+        assert bindings["head"]["vars"] == ["s", "p", "o", "x"]
+        assert bindings["results"]["bindings"][1] == (
+            { 's': rdflib.BNode("nodeid"), 'o': rdflib.Literal("1", datatype=rdflib.URIRef(xsdint)) } )
+        assert bindings["results"]["bindings"][0]['o'] == rdflib.Literal("caf\u00e9", lang="fr")
+        # ASK results
+        for val in [True, False]:
+            (count, data) = writeBinary({ "head": {}, "boolean": val })
+            assert count is None
+            assert readResultsBinary(io.BytesIO(data))["boolean"] == val
+        return
+
     def testOutputResultTemplate(self):
         class testOptions(object):
             verbose        = False
@@ -606,12 +1491,29 @@ class TestAsqc(unittest.TestCase):
                 ]
               }
             })
-        teststr = StringIO.StringIO()
+        teststr = io.StringIO()
         with SwitchStdout(teststr):
             asqc.outputResult("asqc", options, result)
             testtxt = teststr.getvalue()
         log.debug("testOutputResultTemplate \n"+testtxt)
         assert """s: _:nodeid p: <http://example.org/test#p1> o: "literal string" .""" in testtxt
+        # Only referenced variables are formatted:  'x' has an unknown type, but is not used
+        options.format_var_out = r"%(p)s 100%% %(o_repr)s\n"
+        result["results"]["bindings"].append(
+            { 'p': { 'type': "uri", 'value': "http://example.org/test#p2" }
+            , 'o': { 'type': "typed-literal", 'value': "1"
+                   , 'datatype': "http://www.w3.org/2001/XMLSchema#integer" }
+            , 'x': { 'type': "unknown", 'value': "?" }
+            })
+        teststr = io.StringIO()
+        with SwitchStdout(teststr):
+            count   = asqc.outputResult("asqc", options, result)
+            testtxt = teststr.getvalue()
+        assert count == 2
+        assert testtxt == (
+            'http://example.org/test#p1 100% "literal string"\n'+
+            'http://example.org/test#p2 100% "1"^^<http://www.w3.org/2001/XMLSchema#integer>\n'
+            ), repr(testtxt)
         return
 
     def testOutputResultRDFXML(self):
@@ -626,7 +1528,7 @@ class TestAsqc(unittest.TestCase):
             , rdflib.URIRef("http://example.org/test#p1")
             , rdflib.URIRef("http://example.org/test#o1")
             ) )
-        teststr = StringIO.StringIO()
+        teststr = io.StringIO()
         with SwitchStdout(teststr):
             asqc.outputResult("asqc", options, result)
             testtxt = teststr.getvalue()
@@ -645,7 +1547,7 @@ class TestAsqc(unittest.TestCase):
             , rdflib.URIRef("http://example.org/test#p1")
             , rdflib.URIRef("http://example.org/test#o1")
             ) )
-        teststr = StringIO.StringIO()
+        teststr = io.StringIO()
         with SwitchStdout(teststr):
             asqc.outputResult("asqc", options, result)
             testtxt = teststr.getvalue()
@@ -655,6 +1557,204 @@ class TestAsqc(unittest.TestCase):
 
     # Sentinel/placeholder tests
 
+    def testQueryDaemon(self):
+        from asqc.QueryDaemon import QueryDaemon, runClient, isStaleSocket
+        class testOptions(object):
+            verbose        = False
+            output         = None
+            endpoint       = None
+            rdf_data       = ["test1.rdf", "test2.rdf"]
+            prefix         = None
+            format_rdf_in  = None
+            format_var_out = None
+            query_cache    = None
+        options    = testOptions()
+        prefixes   = asqc.getPrefixes(options)+"PREFIX ex: <http://example.org/test#>\n"
+        tempdir    = tempfile.mkdtemp()
+        socketpath = os.path.join(tempdir, "asqd")
+        server     = QueryDaemon(socketpath, "asqd", options, asqc.getRdfData(options))
+        thread     = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            import stat
+            assert stat.S_IMODE(os.stat(socketpath).st_mode) == 0o600
+            assert not isStaleSocket(socketpath)
+            assert not isStaleSocket(os.path.join(testbase, "test1.rdf"))
+            assert not isStaleSocket(os.path.join(tempdir, "nonesuch"))
+            options.socket = socketpath
+            options.format_var_out = "CSV"
+            bindings = (
+                { "head":    { "vars": ["s"] }
+                , "results": { "bindings": [ { 's': rdflib.URIRef("http://example.org/test#s2") } ] }
+                })
+            teststr = io.StringIO()
+            with SwitchStdout(teststr):
+                status  = runClient("asq", options, prefixes, "SELECT ?o WHERE { ?s ?p ?o }", bindings)
+                testtxt = teststr.getvalue()
+            assert status == 0, "Query daemon SELECT status"
+            assert testtxt == "o\n<http://example.org/test#o3>\n<http://example.org/test#o4>\n" or \
+                   testtxt == "o\n<http://example.org/test#o4>\n<http://example.org/test#o3>\n", testtxt
+            options.format_var_out = None
+            bindings = { "head": { "vars": [] }, "results": { "bindings": [{}] } }
+            teststr = io.StringIO()
+            with SwitchStdout(teststr):
+                status  = runClient("asq", options, prefixes, "ASK { ex:s1 ?p ex:nonesuch }", bindings)
+                testtxt = teststr.getvalue()
+            assert status == 1, "Query daemon ASK status"
+            assert json.loads(testtxt) == { "head": {}, "boolean": False }
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        try:
+            # Socket left by a daemon that is no longer running
+            assert isStaleSocket(socketpath)
+        finally:
+            shutil.rmtree(tempdir)
+        return
+
+    def testLocalSparqlEndpoint(self):
+        # Run the SPARQL endpoint tests against data served by 'asq --serve'
+        from asqc.SparqlHttpServer import SparqlHttpServer
+        class testOptions(object):
+            verbose        = False
+            rdf_data       = ["test1.rdf", "test2.rdf"]
+            prefix         = None
+            format_rdf_in  = None
+            format_rdf_out = None
+            format_var_out = None
+            query_cache    = None
+        options = testOptions()
+        server  = SparqlHttpServer(("localhost", 0), "asq", options, asqc.getRdfData(options), threads=4)
+        thread  = threading.Thread(target=server.serve_forever)
+        thread.start()
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.endpoint = server.endpointUri()
+            self.testQuerySparqlEndpointSelect()
+            self.testQuerySparqlEndpointAsk()
+            self.testQuerySparqlEndpointConstruct()
+            # Concurrent requests, and XML results
+            options.endpoint       = self.endpoint
+            options.parallel       = 4
+            options.values_chunk_size = 60
+            bindings = (
+                { "head":    { "vars": ["s"] }
+                , "results": { "bindings":
+                    [ { 's': rdflib.URIRef("http://example.org/test#s%i"%i) } for i in range(1,5) ] }
+                })
+            (status,result) = asqc.querySparqlEndpoint("test", options, "", "SELECT * WHERE { ?s ?p ?o }", bindings)
+            assert status == 0
+            assert len(result["results"]["bindings"]) == 8
+            options.endpoint_format = "XML"
+            (status,result) = asqc.querySparqlEndpoint("test", options, "", "SELECT * WHERE { ?s ?p ?o }", bindings)
+            assert status == 0
+            assert len(result["results"]["bindings"]) == 8
+            assert { 'type': "uri", 'value': "http://example.org/test#s1" } in \
+                   [ b['s'] for b in result["results"]["bindings"] ]
+            # Chunked VALUES clauses give the same results as a single VALUES clause
+            for query in ( [ "SELECT * WHERE { ?s ?p ?o }"
+                           , "SELECT ?s ?o WHERE { ?s ?p ?o } ORDER BY DESC(?o)"
+                           , "SELECT DISTINCT ?s WHERE { ?s ?p ?o }"
+                           , "SELECT ?s (COUNT(?o) AS ?n) WHERE { ?s ?p ?o } GROUP BY ?s"
+                           ] ):
+                options.values_chunk_size = 1000000
+                (status,unchunked) = asqc.querySparqlEndpoint("test", options, "", query, bindings)
+                options.values_chunk_size = 60
+                (status,chunked) = asqc.querySparqlEndpoint("test", options, "", query, bindings)
+                assert len(unchunked["results"]["bindings"]) in [4, 8], query
+                assert self.resultRows(chunked) == self.resultRows(unchunked), query
+                if "ORDER BY" in query:
+                    assert chunked["results"]["bindings"] == unchunked["results"]["bindings"], query
+            # Paged results are the same as unpaged results
+            query = "SELECT * WHERE { ?s ?p ?o }"
+            (status,result) = asqc.querySparqlEndpoint("test", options, "", query, None)
+            expect = self.resultRows(result)
+            assert len(expect) == 8
+            options.page_size = 3
+            (status,result) = asqc.querySparqlEndpoint("test", options, "", query, None)
+            assert self.resultRows(result) == expect
+            # A round number of results is not taken to be truncated if a probe finds no more
+            roundsize = asqc.PAGESIZEROUND
+            try:
+                options.page_size  = "auto"
+                asqc.PAGESIZEROUND = 4
+                (status,result) = asqc.querySparqlEndpoint("test", options, "", query, None)
+                assert self.resultRows(result) == expect
+                assert asqc.detectPageSize(options, query, "", result, asqc.endpointResultType(options)) == None
+                result["results"]["bindings"] = result["results"]["bindings"][:4]
+                assert asqc.detectPageSize(options, query, "", result, asqc.endpointResultType(options)) == 4
+            finally:
+                asqc.PAGESIZEROUND = roundsize
+                options.page_size  = None
+            # Queries that are sent once for each binding give the same results as local evaluation
+            for query in self.perRowQueries+self.scopedVarQueries:
+                (status,result) = asqc.querySparqlEndpoint("test", options, "", query, bindings)
+                expect = self.perRowResults(server.rdfgraph, query, bindings["results"]["bindings"])
+                assert self.resultRows(result) == expect, "%s: %r"%(query, result["results"]["bindings"])
+            (status,result) = asqc.querySparqlEndpoint("test", options, "", "ASK { ?s ?p ?o }", None)
+            assert status == 0
+            assert result["boolean"] == True
+            options.endpoint_format = None
+            sc = SparqlHttpClient(endpointuri=self.endpoint)
+            ((status, reason), result) = sc.doQueryGET("ASK { ?s ?p ?o }",
+                accept="application/sparql-results+xml", JSON=False)
+            assert status == 200
+            assert b"<boolean>true</boolean>" in result
+            # Requests for other paths are refused
+            sc = SparqlHttpClient(endpointuri=self.endpoint+"/other")
+            ((status, reason), result) = sc.doQueryGET("ASK { ?s ?p ?o }", JSON=False)
+            assert status == 404
+            # HTTP/1.0 response body is ended by closing the connection
+            import socket
+            conn = socket.create_connection(server.server_address[:2])
+            conn.sendall(b"GET /sparql?query=ASK%7B%3Fs%20%3Fp%20%3Fo%7D HTTP/1.0\r\n\r\n")
+            response = b""
+            while True:
+                data = conn.recv(4096)
+                if not data: break
+                response += data
+            conn.close()
+            assert response.split(b"\r\n")[0].endswith(b" 200 OK"), response
+            assert b"chunked" not in response and b'"boolean": true' in response, response
+            # Queries against the in-memory store are not serialized
+            from asqc.SparqlHttpServer import allowsConcurrentQueries
+            from asqc.SqliteStore import SqliteStore
+            assert allowsConcurrentQueries(server.rdfgraph.store)
+            assert not allowsConcurrentQueries(SqliteStore(":memory:"))
+            # Concurrent requests, each with new query text to be parsed
+            import concurrent.futures
+            def concurrentQuery(i):
+                sc = SparqlHttpClient(endpointuri=self.endpoint)
+                query = ( "SELECT ?o%i WHERE { <http://example.org/test#s%i> ?p ?o%i FILTER(?o%i != %i) }"%
+                          (i, i%4+1, i, i, i) )
+                return sc.doQueryGET(query)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                responses = list(executor.map(concurrentQuery, range(32)))
+            for (i, ((status, reason), result)) in enumerate(responses):
+                assert status == 200, "%i: %i %s"%(i, status, reason)
+                assert len(result["results"]["bindings"]) == 2, "%i: %r"%(i, result)
+            # Cached results are used until they expire
+            options.result_cache = True
+            options.cache_dir    = tempdir
+            options.parallel     = 1
+            query = "SELECT * WHERE { ?s ?p ?o }"
+            (status,result) = asqc.querySparqlEndpoint("test", options, "", query, None, stream=True)
+            assert len(list(result["results"]["bindings"])) == 8
+            server.rdfgraph = rdflib.Graph()
+            server.rdfgraph.add((rdflib.URIRef("http://example.org/test#s9"), rdflib.RDF.type, rdflib.RDFS.Resource))
+            (status,result) = asqc.querySparqlEndpoint("test", options, "", query, None, stream=True)
+            assert len(list(result["results"]["bindings"])) == 8
+            options.cache_ttl = -1
+            (status,result) = asqc.querySparqlEndpoint("test", options, "", query, None, stream=True)
+            assert len(list(result["results"]["bindings"])) == 1
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            shutil.rmtree(tempdir)
+        return
+
     def testUnits(self):
         assert (True)
 
@@ -684,24 +1784,49 @@ def getTestSuite(select="unit"):
         "unit":
             [ "testUnits"
             , "testResolveUri"
+            , "testOpenUri"
+            , "testOpenUriCompressed"
             , "testQueryType"
+            , "testPageQuery"
             , "testGetQuery"
             , "testGetPrefixes"
             , "testGetBindings"
             , "testGetRdfXmlData"
             , "testGetRdfN3Data"
+            , "testValuesClause"
+            , "testQueryCache"
+            , "testJoinBindings"
+            , "testHttpConnectionPool"
+            , "testOrderedMap"
+            , "testAdaptiveLimiter"
+            , "testRetryRequest"
+            , "testReadResultsJSON"
+            , "testReadResultsXML"
+            , "testCopyResponse"
+            , "testDiskCache"
+            , "testHttpCache"
+            , "testTermCodec"
+            , "testGraphSnapshot"
+            , "testSqliteStore"
+            , "testGetRdfDataParallel"
             , "testQueryRdfDataSelect"
+            , "testQueryRdfDataSelectStream"
+            , "testQueryRdfDataPerRow"
             , "testQueryRdfDataAsk"
             , "testQueryRdfDataConstruct"
             , "testOutputResultJSON"
             , "testOutputResultXML"
             , "testOutputResultCSV"
+            , "testOutputResultTSV"
+            , "testOutputResultBinary"
             , "testOutputResultTemplate"
             , "testOutputResultRDFXML"
             , "testOutputResultRDFN3"
             ],
         "component":
             [ "testComponents"
+            , "testQueryDaemon"
+            , "testLocalSparqlEndpoint"
             ],
         "integration":
             [ "testIntegration"